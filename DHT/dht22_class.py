@@ -8,45 +8,98 @@
  author_email: cversek@gmail.com
 """
 import time
+from collections import OrderedDict
 from ctypes import byref, sizeof, c_int, c_float
                    
 from lib import DHTLibrary, ERROR_CORRUPTED_READ, ERROR_BAD_DATA_CHECKSUM, ERROR_NO_RESPONSE
+from clock import monotonic
 
 ###############################################################################
 DEBUG = True
 DEFAULT_READ_ATTEMPTS = 10
 NO_RESPONSE_DELAY = 0.4 #seconds
+MIN_READ_INTERVAL = 2.0 #seconds, the sensor must not be polled more often
 ###############################################################################
+class ReadStats(object):
+    """ counters of the reads of a sensor, 'retries' is the histogram of 
+        the number of attempts needed by the successful reads
+    """
+    def __init__(self):
+        self.reads           = 0
+        self.successes       = 0
+        self.failures        = 0
+        self.checksum_errors = 0
+        self.no_responses    = 0
+        self.corrupted       = 0
+        self.retries         = {}
+        
+    @property
+    def success_rate(self):
+        return float(self.successes)/self.reads if self.reads else None
+        
+    def summary(self):
+        result = OrderedDict()
+        result['reads']           = self.reads
+        result['successes']       = self.successes
+        result['failures']        = self.failures
+        result['success_rate']    = self.success_rate
+        result['checksum_errors'] = self.checksum_errors
+        result['no_responses']    = self.no_responses
+        result['corrupted']       = self.corrupted
+        result['retries']         = sorted(self.retries.items())
+        return result
+        
 class DHT22(object):
-    _libdht = DHTLibrary.getDll(debug=DEBUG)
-    def __init__(self, pin):
+    def __init__(self, pin, min_interval = MIN_READ_INTERVAL):
         self.pin = pin
+        self.min_interval = min_interval
+        self.stats = ReadStats()
+        self._libdht = DHTLibrary.getDll(debug=DEBUG)
+        self._last_response = None #monotonic time of the last sensor response
         
     def read(self, attempts = DEFAULT_READ_ATTEMPTS):
+        """ read (humidity, temperature), retrying up to 'attempts' times;
+            requests wait out 'min_interval' after the last response of the
+            sensor, so this may block for seconds
+        """
         humidity    = c_float()
         temperature = c_float()
         res = None
-        
+        stats = self.stats
+        stats.reads += 1
         for i in range(attempts):
+            #rate limit the requests
+            if not self._last_response is None:
+                wait = self._last_response + self.min_interval - monotonic()
+                if wait > 0:
+                    time.sleep(wait)
             res = self._libdht.read_dht22(c_int(self.pin), 
                                     byref(humidity), 
                                     byref(temperature)
                                     )
+            if res != ERROR_NO_RESPONSE.value:
+                self._last_response = monotonic()
             if res == 0: # the checksum matches, read was good
                 break
             elif res == ERROR_NO_RESPONSE.value:
+                stats.no_responses += 1
                 if DEBUG:
                     print "no response - delaying %0.2f seconds" % NO_RESPONSE_DELAY
                 time.sleep(NO_RESPONSE_DELAY)
             elif res == ERROR_BAD_DATA_CHECKSUM.value:
+                stats.checksum_errors += 1
                 if DEBUG:
                     print "bad checksum"
                 time.sleep(0)
+            elif res == ERROR_CORRUPTED_READ.value:
+                stats.corrupted += 1
             if DEBUG:
                 print "retry #%d" % (i+1)
         else:
-            raise IOError("read failed after %d attempts" % (READ_ATTEMPTS,))
-            
+            stats.failures += 1
+            raise IOError("read failed after %d attempts" % (attempts,))
+        stats.successes += 1
+        stats.retries[i] = stats.retries.get(i, 0) + 1
         return (humidity.value, temperature.value)
 
 ###############################################################################
@@ -9,6 +9,7 @@
 """
 import sys, os
 from ctypes import CDLL, cdll, c_int
+import backend
 ###############################################################################
 THIS_PATH = os.path.dirname(os.path.abspath(__file__))
 LIB_NAME  = "libdht.so"
@@ -49,7 +50,10 @@ class DHTLibrary:
     @staticmethod
     def getDll(debug = False):
         if DHTLibrary.__dll is None:
-            if sys.platform == 'linux2':
+            if backend.is_simulated():
+                from sim.dht import SimDHTLibrary
+                DHTLibrary.__dll = SimDHTLibrary()
+            elif sys.platform == 'linux2':
                 DHTLibrary.__dll = cdll.LoadLibrary(LIB_PATH)
             else:
                 raise RuntimeError("Platform not supported")
@@ -0,0 +1,119 @@
+"""
+ DHT.poller.py
+
+ Background polling of a DHT22 sensor: a thread keeps reading the sensor
+ at the fastest rate it allows, so that callers get the last good reading
+ from 'latest()' without blocking on the sensor's slow retry loop.
+"""
+import time, threading
+
+from clock import monotonic
+from dht22_class import MIN_READ_INTERVAL
+
+###############################################################################
+DEFAULT_TTL = 30.0 #seconds, age after which a reading is considered stale
+###############################################################################
+class DHT22Poller(object):
+    """ polls the 'dht' (a 'DHT22' object) every 'interval' seconds on a
+        background thread; readings older than 'ttl' seconds are stale
+    """
+    def __init__(self, dht, ttl = DEFAULT_TTL, interval = MIN_READ_INTERVAL):
+        self.dht      = dht
+        self.ttl      = ttl
+        self.interval = interval
+        self.errors   = 0
+        self._value     = None #(humidity, temperature)
+        self._timestamp = None #wall clock time of the reading
+        self._t_mono    = None #monotonic time of the reading
+        self._lock    = threading.Lock()
+        self._stop    = threading.Event()
+        self._thread  = None
+
+    @property
+    def stats(self):
+        """ read statistics of the sensor (see 'DHT22.stats')
+        """
+        return self.dht.stats
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target = self._run, name = "DHT22Poller")
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if not self._thread is None:
+            while self._thread.is_alive():
+                self._thread.join(0.1)
+            self._thread = None
+
+    def latest(self):
+        """ get the last good reading as ((humidity, temperature), timestamp, age),
+            the value is None if there is no reading yet or it is older
+            than 'ttl' seconds
+        """
+        with self._lock:
+            value, timestamp, t_mono = self._value, self._timestamp, self._t_mono
+        if t_mono is None:
+            return (None, None, None)
+        age = monotonic() - t_mono
+        if not self.ttl is None and age > self.ttl:
+            value = None
+        return (value, timestamp, age)
+
+    def _run(self):
+        while not self._stop.is_set():
+            t_start = monotonic()
+            try:
+                value = self.dht.read()
+            except IOError:
+                self.errors += 1
+            else:
+                with self._lock:
+                    self._value     = value
+                    self._timestamp = time.time()
+                    self._t_mono    = monotonic()
+            #the sensor itself enforces its minimum interval between reads
+            self._stop.wait(max(self.interval - (monotonic() - t_start), 0.0))
+
+###############################################################################
+# TEST CODE
+###############################################################################
+if __name__ == "__main__":
+    import backend
+    backend.select("sim")
+    import dht22_class
+    from lib import DHTLibrary
+    from dht22_class import DHT22
+    dht22_class.DEBUG = False
+    DHTLibrary.setup('BCM')
+    sim = DHTLibrary.getDll()
+    sim.min_interval = 0.2
+    sim.read_time    = 0.0
+    dht = DHT22(pin = 4, min_interval = 0.2)
+    poller = DHT22Poller(dht, ttl = 1.0, interval = 0.2)
+    assert poller.latest() == (None, None, None)
+    poller.start()
+    time.sleep(3.0)
+    #non-blocking
+    t1 = time.time()
+    value, timestamp, age = poller.latest()
+    assert time.time() - t1 < 0.01
+    print "latest: %r, age = %0.3f s" % (value, age)
+    assert not value is None and age < 1.0
+    poller.stop()
+    stats = dht.stats.summary()
+    for key, val in stats.items():
+        print "%s = %r" % (key, val)
+    #reads respect the minimum interval of the sensor
+    assert stats['reads'] <= 3.0/0.2 + 1
+    assert stats['successes'] + stats['failures'] == stats['reads']
+    assert sum(count for retries, count in stats['retries']) == stats['successes']
+    #readings go stale
+    time.sleep(1.1)
+    value, timestamp, age = poller.latest()
+    assert value is None and age > 1.0
+    print "all tests passed"
@@ -0,0 +1,2 @@
+from lib import SPIBBLibrary
+from native_spi import NativeSPI
@@ -0,0 +1,55 @@
+"""
+ SPIBB.lib.py
+ 
+ Python interface to the LibSPIBB driver for clocking bit-banged (software)
+ SPI frames from C.
+
+ author: Craig Wm. Versek, Pioneer Valley Open Science
+ author_email: cversek@gmail.com
+"""
+import sys, os
+from ctypes import CDLL, cdll, c_int, c_void_p, c_char_p, CFUNCTYPE
+###############################################################################
+THIS_PATH = os.path.dirname(os.path.abspath(__file__))
+LIB_NAME  = "libspibb.so"
+LIB_PATH  = os.path.sep.join((THIS_PATH,LIB_NAME))
+
+# C library definitions
+PINMODE_BCM  = 0
+PINMODE_PHYS = 1
+
+ERROR_NO_WIRINGPI           = c_int(-1)
+ERROR_WIRINGPI_SETUP_FAILED = c_int(-2)
+ERROR_BAD_PINMODE           = c_int(-3)
+
+WRITE_FUNC = CFUNCTYPE(None, c_int, c_int)
+READ_FUNC  = CFUNCTYPE(c_int, c_int)
+###############################################################################
+class SPIBBLibrary:
+    __dll = None
+    @staticmethod
+    def getDll():
+        """ load the shared library, raises OSError if it has not been built
+            (see the Makefile) or RuntimeError if the platform is unsupported
+        """
+        if SPIBBLibrary.__dll is None:
+            if sys.platform.startswith('linux'):
+                dll = cdll.LoadLibrary(LIB_PATH)
+            else:
+                raise RuntimeError("Platform not supported")
+            dll.spibb_setup.argtypes  = [c_int]
+            dll.spibb_set_io.argtypes = [WRITE_FUNC, READ_FUNC]
+            dll.spibb_set_io.restype  = None
+            dll.spibb_set_half_period.argtypes = [c_int]
+            dll.spibb_set_half_period.restype  = None
+            dll.spibb_transfer.argtypes = [c_int, c_int, c_int, c_int, 
+                                           c_char_p, c_void_p, c_int]
+            SPIBBLibrary.__dll = dll
+        return SPIBBLibrary.__dll
+
+###############################################################################
+# TEST CODE
+###############################################################################
+if __name__ == "__main__":
+    libspibb = SPIBBLibrary.getDll()
+    print "loaded %s" % LIB_PATH
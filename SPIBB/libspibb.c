@@ -0,0 +1,142 @@
+/*
+   libspibb - A Raspberry-Pi wiringPi based library for clocking whole 
+              bit-banged (software) SPI frames in a single foreign function
+              call.  This library is safe to access from a foreign function 
+              interface in languages like Python and will not crash the 
+              interpreter on error conditions.
+              
+              Author: cversek@gmail.com  
+              
+              Attribution:  The clocking sequence matches the Python 
+                  implementation in 'comm_spi.py', 
+                  ref. git://gist.github.com/3151375.git
+              
+              Note: This code must be compiled on the Raspberry Pi or in a
+                    suitable cross-compiler or emulation environment.
+*/
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
+#ifndef SPIBB_NO_WIRINGPI
+#include <wiringPi.h>
+#else
+#define HIGH 1
+#define LOW  0
+#endif
+#include "libspibb.h"
+
+static spibb_write_fn write_callback = NULL;
+static spibb_read_fn  read_callback  = NULL;
+static int half_period = 0;
+
+static inline void pin_write(int pin, int value)
+{
+  if (write_callback != NULL){
+    write_callback(pin, value);
+    return;
+  }
+#ifndef SPIBB_NO_WIRINGPI
+  digitalWrite(pin, value);
+#endif
+}
+
+static inline int pin_read(int pin)
+{
+  if (read_callback != NULL){
+    return read_callback(pin);
+  }
+#ifndef SPIBB_NO_WIRINGPI
+  return digitalRead(pin);
+#else
+  return 0;
+#endif
+}
+
+static inline void wait_half_period(void)
+{
+#ifndef SPIBB_NO_WIRINGPI
+  if (half_period > 0) delayMicroseconds(half_period);
+#endif
+}
+
+//
+// Setup the wiringPi library with the same pin numbering scheme as the
+// Python side, PINMODE_BCM (GPIO.BCM) or PINMODE_PHYS (GPIO.BOARD)
+int spibb_setup(int pinmode)
+{
+#ifdef SPIBB_NO_WIRINGPI
+  return ERROR_NO_WIRINGPI;
+#else
+  int res;
+  if (pinmode == PINMODE_BCM){
+    res = wiringPiSetupGpio();
+  }
+  else if (pinmode == PINMODE_PHYS){
+    res = wiringPiSetupPhys();
+  }
+  else {
+    return ERROR_BAD_PINMODE;
+  }
+  if (res == -1){
+    perror("Setup of wiringPi failed\n");
+    return ERROR_WIRINGPI_SETUP_FAILED;
+  }
+  return 0;
+#endif
+}
+
+//
+// Redirect the pin IO through callbacks, passing NULL restores wiringPi
+void spibb_set_io(spibb_write_fn write_fn, spibb_read_fn read_fn)
+{
+  write_callback = write_fn;
+  read_callback  = read_fn;
+}
+
+//
+// Limit the clock rate by waiting 'usecs' after each clock edge
+void spibb_set_half_period(int usecs)
+{
+  half_period = usecs;
+}
+
+//
+// Transfer 'len' bytes MSB first within a single chip select cycle
+int spibb_transfer(int clockpin, int mosipin, int misopin, int cspin,
+                   const uint8_t *tx, uint8_t *rx, int len)
+{
+  int i;
+  int bit;
+  int mosi_level = -1;
+  uint8_t mask, inp_byte;
+  
+  //start transmission by toggling chip select low
+  pin_write(cspin, HIGH);
+  pin_write(clockpin, LOW);  //start clock low
+  pin_write(cspin, LOW);     //bring CS low
+  
+  for (i = 0; i < len; i++){
+    inp_byte = 0;
+    for (mask = 0x80; mask != 0; mask >>= 1){
+      //send the output bit, the line only needs to change on transitions
+      bit = (tx[i] & mask) ? HIGH : LOW;
+      if (bit != mosi_level){
+        pin_write(mosipin, bit);
+        mosi_level = bit;
+      }
+      //tick the clock up - pushes output, latches input
+      pin_write(clockpin, HIGH);
+      wait_half_period();
+      if (pin_read(misopin)) inp_byte |= mask;
+      //tick the clock down - get ready for next cycle
+      pin_write(clockpin, LOW);
+      wait_half_period();
+    }
+    rx[i] = inp_byte;
+  }
+  
+  //finish transmission by toggling chip select
+  pin_write(cspin, HIGH);
+  return 0;
+}
@@ -0,0 +1,37 @@
+/*
+   libspibb - A Raspberry-Pi wiringPi based library for clocking whole 
+              bit-banged (software) SPI frames in a single foreign function
+              call.  This library is safe to access from a foreign function 
+              interface in languages like Python and will not crash the 
+              interpreter on error conditions.
+              
+              The pin IO may be redirected through callbacks (see 
+              'spibb_set_io') so that the clocking can be verified against
+              a simulated GPIO module; building with -DSPIBB_NO_WIRINGPI 
+              produces a library which only supports this mode.
+              
+              Note: This code must be compiled on the Raspberry Pi or in a
+                    suitable cross-compiler or emulation environment.
+*/
+#ifndef LIB_SPIBB_H
+#define LIB_SPIBB_H
+
+#include <stdint.h>
+
+#define PINMODE_BCM  0
+#define PINMODE_PHYS 1
+
+#define ERROR_NO_WIRINGPI           -1
+#define ERROR_WIRINGPI_SETUP_FAILED -2
+#define ERROR_BAD_PINMODE           -3
+
+typedef void (*spibb_write_fn)(int pin, int value);
+typedef int  (*spibb_read_fn)(int pin);
+
+extern int  spibb_setup(int pinmode);
+extern void spibb_set_io(spibb_write_fn write_fn, spibb_read_fn read_fn);
+extern void spibb_set_half_period(int usecs);
+extern int  spibb_transfer(int clockpin, int mosipin, int misopin, int cspin,
+                           const uint8_t *tx, uint8_t *rx, int len);
+
+#endif //LIB_SPIBB_H
@@ -0,0 +1,63 @@
+"""
+ SPIBB.native_spi.py
+ 
+ Bit-banged SPI engine which clocks each frame through a single call into
+ the LibSPIBB driver.
+
+ author: Craig Wm. Versek, Pioneer Valley Open Science
+ author_email: cversek@gmail.com
+"""
+from ctypes import create_string_buffer
+
+from lib import SPIBBLibrary, PINMODE_BCM, PINMODE_PHYS, WRITE_FUNC, READ_FUNC
+
+###############################################################################
+DEFAULT_HALF_PERIOD = 1 #microseconds, keeps the clock under the MCP3008's 1.35MHz rating
+###############################################################################
+class NativeSPI(object):
+    """ 'pinmode' is either 'BCM' or 'BOARD' matching the RPi.GPIO scheme 
+        that was used to set up the pins.  When a 'gpio' module is supplied, 
+        the pin IO is routed through its 'output' and 'input' functions
+        instead of wiringPi, e.g. to drive a simulated GPIO module.
+    """
+    def __init__(self, clockpin, mosipin, misopin, cspin, 
+                 pinmode     = "BCM",
+                 gpio        = None,
+                 half_period = DEFAULT_HALF_PERIOD,
+                ):
+        self._libspibb = dll = SPIBBLibrary.getDll()
+        self._pins = (clockpin, mosipin, misopin, cspin)
+        if gpio is None:
+            if   pinmode == "BCM":
+                res = dll.spibb_setup(PINMODE_BCM)
+            elif pinmode == "BOARD":
+                res = dll.spibb_setup(PINMODE_PHYS)
+            else:
+                raise ValueError("'pinmode' must be either 'BCM' or 'BOARD'")
+            if res != 0:
+                raise RuntimeError("libspibb setup failed with error %d" % res)
+            self._callbacks = None
+            dll.spibb_set_io(WRITE_FUNC(), READ_FUNC())
+        else:
+            #keep references to the callbacks alive as long as this object
+            output = gpio.output
+            input  = gpio.input
+            self._callbacks = (WRITE_FUNC(lambda pin, value: output(pin, bool(value))),
+                               READ_FUNC(lambda pin: 1 if input(pin) else 0),
+                              )
+            dll.spibb_set_io(*self._callbacks)
+        dll.spibb_set_half_period(half_period)
+        self._bufs = {}
+        
+    def transfer(self, out_bytes):
+        """ transfer bytes in a single chip select cycle
+        """
+        out_bytes = str(bytearray(out_bytes))
+        num = len(out_bytes)
+        rx_buf = self._bufs.get(num)
+        if rx_buf is None:
+            rx_buf = self._bufs[num] = create_string_buffer(num)
+        clockpin, mosipin, misopin, cspin = self._pins
+        self._libspibb.spibb_transfer(clockpin, mosipin, misopin, cspin,
+                                      out_bytes, rx_buf, num)
+        return bytearray(rx_buf.raw)
@@ -0,0 +1,238 @@
+""" Acquisition from several ADC chips as if they were one: 'ADCGroup'
+    provides the scan interface of a single ADC ('make_plan', 'scan'), so
+    that 'adcsampler.Application' records one merged, time-aligned stream.
+
+    The channels of the chips are numbered consecutively, the first chip
+    holding 0..NUM_CHANNELS-1, the second NUM_CHANNELS.., and so on.  Scans
+    are interleaved across the chips, each bus (see 'comm_spi.bus_lock')
+    being held for one pass over its chips.
+
+    Devices are described on the command line of 'adcsampler.py' by
+        MODEL:BUS:CS:CHANNELS[:MODES]
+    where BUS is either the software SPI pins "CLK,MOSI,MISO" with the CS
+    pin, or a spidev bus "/dev/spidevN" with the chip select number, e.g.
+        mcp3008:18,24,23:25:0-7
+        mcp3008:/dev/spidev0:1:0,1,2:s,d,s
+"""
+################################################################################
+from collections import OrderedDict
+import numpy as np
+
+DEFAULT_INTERLEAVE = 1 #subsamples scanned from one chip before the next
+################################################################################
+def parse_channels(text):
+    """ parse channel lists like "0,1,2" or "0-3,6"
+    """
+    channels = []
+    for item in text.split(','):
+        if '-' in item:
+            first, last = item.split('-')
+            channels += range(int(first), int(last) + 1)
+        else:
+            channels.append(int(item))
+    return channels
+
+def parse_device_spec(spec):
+    """ parse the device description "MODEL:BUS:CS:CHANNELS[:MODES]" into an
+        OrderedDict with the keys 'model', 'spi' ("software" or "hardware"),
+        'pins' (clock, mosi, miso) or 'device' (spidev path), 'cs',
+        'channels' and 'modes'
+    """
+    fields = spec.split(':')
+    if not len(fields) in (4, 5):
+        raise ValueError, "device %r must be given as MODEL:BUS:CS:CHANNELS[:MODES]" % spec
+    model, bus, cs, channels = fields[:4]
+    result = OrderedDict()
+    result['model'] = model.lower()
+    if bus.startswith('/'):
+        result['spi']    = "hardware"
+        result['device'] = "%s.%d" % (bus, int(cs))
+    else:
+        pins = map(int, bus.split(','))
+        if len(pins) != 3:
+            raise ValueError, "software SPI bus of device %r must be the pins CLK,MOSI,MISO" % spec
+        result['spi']  = "software"
+        result['pins'] = tuple(pins)
+    result['cs']       = int(cs)
+    result['channels'] = parse_channels(channels)
+    if len(fields) == 5 and fields[4]:
+        modes = fields[4].split(',')
+    else:
+        modes = []
+    if len(modes) > len(result['channels']):
+        raise ValueError, "device %r has more modes than channels" % spec
+    #fill in missing modes as single-ended
+    result['modes'] = modes + ['s']*(len(result['channels']) - len(modes))
+    return result
+
+################################################################################
+class GroupPlan(object):
+    """ A precompiled scan across the chips of an 'ADCGroup', built by
+        'ADCGroup.make_plan': a 'ScanPlan' for every chip involved and the
+        columns of the merged scan which its values go to.
+    """
+    def __init__(self, channels, modes, parts, buses):
+        self.channels = tuple(channels)
+        self.modes    = tuple(modes)
+        self.parts    = tuple(parts)   #(chip index, plan, column indices)
+        self.buses    = tuple(buses)   #(bus lock, indices of its parts)
+        self._scratch = {}
+
+    def __len__(self):
+        return len(self.channels)
+
+    def scratch(self, index, n):
+        """ get a reusable float buffer of shape (n, len(plan of part 'index'))
+        """
+        buff = self._scratch.get((index, n))
+        if buff is None:
+            plan = self.parts[index][1]
+            buff = self._scratch[(index, n)] = np.empty((n, len(plan)))
+        return buff
+
+################################################################################
+class ADCGroup(object):
+    """ Interface to the list of ADC objects 'adcs' (e.g. 'MCP3008ADC',
+        set up on their buses) as one ADC with consecutively numbered
+        channels; 'interleave' subsamples are scanned from a chip at a time.
+    """
+    def __init__(self, adcs, interleave = DEFAULT_INTERLEAVE):
+        assert len(adcs) > 0
+        assert interleave > 0
+        self.adcs       = list(adcs)
+        self.interleave = interleave
+        models = []
+        for adc in self.adcs:
+            if not adc.MODEL in models:
+                models.append(adc.MODEL)
+        self.MODEL          = "+".join(models)
+        self.BIT_RESOLUTION = max(adc.BIT_RESOLUTION for adc in self.adcs)
+        self.NUM_CHANNELS   = sum(adc.NUM_CHANNELS for adc in self.adcs)
+        vrefs = [adc.vref for adc in self.adcs]
+        self.vref = vrefs[0] if len(set(vrefs)) == 1 else vrefs
+        #first channel number of each chip
+        self.offsets = []
+        offset = 0
+        for adc in self.adcs:
+            self.offsets.append(offset)
+            offset += adc.NUM_CHANNELS
+
+    def locate(self, chan):
+        """ get the (chip index, chip channel) of the group channel 'chan'
+        """
+        for index in range(len(self.adcs) - 1, -1, -1):
+            if chan >= self.offsets[index]:
+                local = chan - self.offsets[index]
+                if local < self.adcs[index].NUM_CHANNELS:
+                    return index, local
+                break
+        raise ValueError, "'chan' must be in %r" % range(self.NUM_CHANNELS)
+
+    def channel(self, index, chan):
+        """ get the group channel of channel 'chan' of chip 'index'
+        """
+        return self.offsets[index] + chan
+
+    def make_plan(self, channels, modes = None):
+        """ validate and precompile a scan of the group 'channels' with
+            matching 'modes' (default all single-ended)
+        """
+        if modes is None:
+            modes = ['s']*len(channels)
+        if len(modes) != len(channels):
+            raise ValueError, "'modes' must match 'channels' in length"
+        #split the scan by chip, keeping the chips in order
+        chip_chans = OrderedDict()
+        for column, (chan, mode) in enumerate(zip(channels, modes)):
+            index, local = self.locate(chan)
+            chip_chans.setdefault(index, []).append((column, local, mode))
+        parts = []
+        buses = []
+        for index, items in sorted(chip_chans.items()):
+            columns, chans, chip_modes = zip(*items)
+            adc  = self.adcs[index]
+            plan = adc.make_plan(list(chans), list(chip_modes))
+            parts.append((index, plan, list(columns)))
+            #group the parts by the bus they are read from
+            for lock, part_indices in buses:
+                if lock is adc.lock:
+                    part_indices.append(len(parts) - 1)
+                    break
+            else:
+                buses.append((adc.lock, [len(parts) - 1]))
+        return GroupPlan(channels, modes, parts, buses)
+
+    def scan(self, plan, n = 1, out = None):
+        """ run the group scan 'plan' 'n' times, returning the voltage scaled
+            values in the float array 'out' (allocated if not specified) of
+            shape (n, len(plan))
+        """
+        if out is None:
+            out = np.empty((n, len(plan)))
+        adcs  = self.adcs
+        parts = plan.parts
+        step  = min(self.interleave, n)
+        for start in range(0, n, step):
+            stop = min(start + step, n)
+            #hold each bus for one pass over its chips
+            for lock, part_indices in plan.buses:
+                with lock:
+                    for part_index in part_indices:
+                        index, chip_plan, columns = parts[part_index]
+                        buff = plan.scratch(part_index, stop - start)
+                        adcs[index].scan(chip_plan, stop - start, out = buff)
+                        out[start:stop, columns] = buff
+        return out
+
+    def describe(self):
+        """ list of the chip models and their channel ranges, for metadata
+        """
+        return [(adc.MODEL, offset, offset + adc.NUM_CHANNELS - 1)
+                for adc, offset in zip(self.adcs, self.offsets)]
+
+################################################################################
+# TEST CODE
+################################################################################
+if __name__ == "__main__":
+    import backend
+    from mcp3008adc import MCP3008ADC
+    from sim.mcp3008 import SimMCP3008, constant
+    backend.select("sim")
+    GPIO = backend.get_gpio()
+
+    spec = parse_device_spec("mcp3008:18,24,23:25:0-2,7:s,d")
+    assert spec['pins'] == (18,24,23) and spec['cs'] == 25
+    assert spec['channels'] == [0,1,2,7] and spec['modes'] == ['s','d','s','s']
+    spec = parse_device_spec("MCP3008:/dev/spidev0:1:3")
+    assert spec['device'] == "/dev/spidev0.1" and spec['spi'] == "hardware"
+
+    #four chips sharing clock, MOSI and MISO on separate chip selects
+    CLK, MOSI, MISO = 18, 24, 23
+    cspins = [25, 8, 7, 12]
+    adcs = []
+    for cs_index, cspin in enumerate(cspins):
+        chip = SimMCP3008(clockpin = CLK, mosipin = MOSI, misopin = MISO, cspin = cspin,
+                          noise = 0.0)
+        for chan in range(8):
+            chip.set_channel(chan, constant(0.1*(cs_index*8 + chan) % 3.0), noise = 0.0)
+        chip.connect(GPIO)
+        adc = MCP3008ADC()
+        adc.setup_software_spi(clockpin = CLK, mosipin = MOSI, misopin = MISO,
+                               cspin = cspin, pinmode = GPIO.BCM)
+        adcs.append(adc)
+    assert all(adc.lock is adcs[0].lock for adc in adcs)
+    group = ADCGroup(adcs)
+    assert group.NUM_CHANNELS == 32
+    assert group.locate(9) == (1, 1) and group.channel(3, 7) == 31
+    #channels in any order across the chips
+    channels = [31, 0, 9, 17, 8, 30]
+    plan = group.make_plan(channels)
+    vals = group.scan(plan, n = 3)
+    expected = [min(int(0.1*chan % 3.0*1024/3.3), 1023)*adcs[0].scale for chan in channels]
+    assert np.allclose(vals, [expected]*3, atol = adcs[0].scale*1.01), (vals, expected)
+    #into a transposed view, as used by 'adcsampler.Application'
+    out = np.empty((len(channels), 5))
+    group.scan(plan, n = 5, out = out.T)
+    assert np.allclose(out.T, [expected]*5, atol = adcs[0].scale*1.01)
+    print group.describe()
+    print "all tests passed"
@@ -3,13 +3,31 @@ import os,sys,time
 from collections import OrderedDict
 import numpy as np
 from mcp3008adc import MCP3008ADC
+from csvdata import CSVWriter, DEFAULT_PRECISION
+from bindata import BinaryWriter
+import metrics
+from clock import monotonic
+from scheduler import Scheduler
+from writerthread import ThreadedWriter, POLICIES, DEFAULT_POLICY, DEFAULT_QUEUE_SIZE
+from sinks import FanOut
+from workers import AcquisitionWorker, WorkerPool, DEFAULT_CAPACITY as DEFAULT_RING_CAPACITY,\
+                    DEFAULT_STALL_TIMEOUT
+from oversampling import adaptive_mean, DEFAULT_MIN_SAMPLES
+from deadband import DeadbandWriter, METHODS as DEADBAND_METHODS, DEFAULT_METHOD as DEFAULT_DEADBAND_METHOD,\
+                     DEFAULT_HEARTBEAT
+from decimation import FILTERS, make_decimator, DEFAULT_FACTOR, DEFAULT_CIC_ORDER,\
+                       DEFAULT_CIC_DELAY, DEFAULT_FIR_TAPS
 
 ADCS = {'mcp3008': MCP3008ADC}
 
     
-DEFAULT_OUTPUT_FILE = "./data.csv"
+OUTPUT_FORMATS      = {'csv': "./data.csv", 'bin': "./data.bin"} #default output files
+DEFAULT_FORMAT      = "csv"
 DEFAULT_VERBOSE     = True
 DEFAULT_BUFFSIZE    = 1
+SCHEDULES           = ("delay", "fixed")
+DEFAULT_SCHEDULE    = "delay"
+DEFAULT_BLOCK_SIZE  = 1000 #scans per block read in the streaming mode
 ################################################################################
 class Application:
     def __init__(self, adc, channels, modes, delay, output_file, 
@@ -18,126 +36,502 @@ class Application:
                  csv_delimiter = ",",
                  csv_newline   = "\n",
                  verbose       = False,
+                 precision     = DEFAULT_PRECISION,
+                 writer        = None,
+                 schedule      = DEFAULT_SCHEDULE,
+                 queue_size    = DEFAULT_QUEUE_SIZE,
+                 policy        = DEFAULT_POLICY,
+                 sinks         = (),
+                 target_error  = None,
+                 min_samp_size = DEFAULT_MIN_SAMPLES,
+                 deadband        = None,
+                 deadband_method = DEFAULT_DEADBAND_METHOD,
+                 rel_deadband    = 0.0,
+                 heartbeat       = DEFAULT_HEARTBEAT,
                  ):
+        """ records are written to the text 'output_file' (CSV format)
+            unless a 'writer' object is specified (see 'bindata.BinaryWriter')
+            
+            'schedule' is "delay" to sleep 'delay' seconds after each sample,
+            or "fixed" to fire the samples every 'delay' seconds on a 
+            monotonic timeline (see 'scheduler.Scheduler'), the run statistics
+            are then written to the trailer of the output
+            
+            unless 'queue_size' is 0, the records are written by a separate
+            thread fed through a queue of 'queue_size' buffers with the 
+            back-pressure 'policy' (see 'writerthread.ThreadedWriter')
+            
+            the records are also published to the named 'sinks', a sequence
+            of (name, sink), e.g. a 'sinks.ThingspeakSink', so that several
+            consumers share one reading of the hardware (see 'sinks.FanOut')
+            
+            with a 'target_error' (volts), each sample averages only as many
+            subsamples (at least 'min_samp_size', at most the 'samp_size' of
+            'sample') as it takes for the standard error of every channel's
+            mean to reach the target, the count used is recorded in the
+            column "samp_n" (see 'oversampling.adaptive_mean')
+            
+            with a 'deadband' (volts, or a mapping of column names to volts)
+            only the records with significant changes of the channels are
+            written and published, at least one every 'heartbeat' seconds,
+            such that the channels can be reconstructed within the deadband
+            (plus 'rel_deadband' times their values) by the 'deadband_method'
+            (see 'deadband.DeadbandWriter')
+        """
+        assert schedule in SCHEDULES
         self.adc       = adc
         self.channels  = channels
         self.modes     = modes
-        self.buffer    = []
+        self.plan      = adc.make_plan(channels, modes)
         self.delay       = delay
         self.output_file = output_file
         self.buff_size   = buff_size
         self.store_error = store_error
         self.csv_delimiter   = csv_delimiter
         self.csv_newline     = csv_newline
+        self.precision       = precision
+        self.schedule        = schedule
+        self.scheduler       = None
+        self.pool            = None
+        self.target_error    = target_error
+        self.min_samp_size   = min_samp_size
         self.verbose   = verbose
+        if writer is None:
+            writer = CSVWriter(output_file,
+                               delimiter = csv_delimiter,
+                               newline   = csv_newline,
+                               precision = precision,
+                              )
+        if queue_size > 0:
+            writer = ThreadedWriter(writer, queue_size = queue_size, policy = policy)
+        self.writer    = writer
+        self.sinks     = list(sinks)
+        self.output    = FanOut(writer, self.sinks) if self.sinks else writer
+        if not deadband is None:
+            self.output = DeadbandWriter(self.output, deadband,
+                                         rel_tolerance = rel_deadband,
+                                         method        = deadband_method,
+                                         heartbeat     = heartbeat,
+                                        )
+        #names of the record columns
+        self.columns   = ["t_samp", "t_err"]
+        for chan in channels:
+            self.columns += ["chan%d" % chan]
+            if store_error:
+                self.columns += ["chan%d_err" % chan]
+        if not target_error is None:
+            self.columns += ["samp_n"]
+        self._allocate_buffer(samp_size = 1)
         
+    def _allocate_buffer(self, samp_size):
+        """ preallocate the ring buffer of subsamples 
+            (samples x channels x subsamples) and the block of records
+            (samples x columns) which they are reduced into
+        """
+        num_chans = len(self.channels)
+        self._subsamps = np.empty((self.buff_size, num_chans, samp_size))
+        self._records  = np.empty((self.buff_size, len(self.columns)))
+        self._count    = 0 #number of samples held in the buffer
+        self._reduced  = False #the records are reduced as they are read
         
-    def sample(self, samp_size = 1, samp_num = None):
+    def _start_metadata(self):
+        """ metadata common to the acquisition modes
+        """
         adc = self.adc
-        channels     = self.channels
-        modes        = self.modes
-        num_chans    = len(channels)
-        chan_indices = range(num_chans) 
-        buff_size    = self.buff_size
-        delay        = self.delay
-        #collect metadata and write it to the file header
         metadata = OrderedDict()
-        metadata['start_timestamp'] = t0 = time.time()
+        metadata['start_timestamp'] = time.time()
         metadata['adc_model']       = adc.MODEL
         metadata['adc_bit_res']     = adc.BIT_RESOLUTION
         metadata['adc_vref']        = adc.vref     
-        metadata['channels']        = channels
-        metadata['modes']           = modes
-        metadata['samp_size']       = samp_size
-        metadata['samp_num']        = samp_num
-        metadata['delay']           = delay
-        metadata['store_error']     = self.store_error
+        if hasattr(adc, 'describe'):
+            metadata['adc_devices'] = adc.describe()
+        metadata['channels']        = self.channels
+        metadata['modes']           = self.modes
+        return metadata
+        
+    def _begin(self, metadata):
         self.write_header(metadata)
         if self.verbose:
             print "Starting aquistion with the following settings:"
             for key,val in metadata.items():
                 print "\t%s = %r" % (key,val)
             print "Beginning to sample"
+        
+    def sample(self, samp_size = 1, samp_num = None):
+        adc = self.adc
+        plan         = self.plan
+        buff_size    = self.buff_size
+        delay        = self.delay
+        #collect metadata and write it to the file header
+        metadata = self._start_metadata()
+        metadata['samp_size']       = samp_size
+        metadata['samp_num']        = samp_num
+        metadata['delay']           = delay
+        metadata['store_error']     = self.store_error
+        metadata['schedule']        = self.schedule
+        adaptive = not self.target_error is None
+        if adaptive:
+            metadata['target_error']  = self.target_error
+            metadata['min_samp_size'] = min(self.min_samp_size, samp_size)
+        self._begin(metadata)
         #begin sampling
+        if adaptive:
+            self._allocate_buffer(1)
+            self._reduced = True
+            scratch  = np.empty((samp_size, len(self.channels)))
+            read_block = lambda n: adc.scan(plan, n, out = scratch[:n])
+            num_vals = len(self.channels)*(2 if self.store_error else 1)
+        else:
+            self._allocate_buffer(samp_size)
+        subsamps = self._subsamps
+        records  = self._records
+        #sample times are measured on the monotonic clock, relative to the
+        #wall clock 'start_timestamp'
+        t0_mono   = monotonic()
+        scheduler = None
+        if self.schedule == "fixed":
+            scheduler = self.scheduler = Scheduler(delay)
+            scheduler.start(t0_mono)
         try:
             i = 0
             while i < samp_num or samp_num is None:
-                t1 = time.time()
-                subsamps = [[] for chan in range(num_chans)]
-                for j in range(samp_size):
-                    for index,chan,mode in zip(chan_indices,channels,modes):
-                        subsamp = adc.read(chan, mode = mode)
-                        subsamps[index].append(subsamp)
-                t2 = time.time()
-                t_samp = (t1+t2)/2.0 - t0
-                t_err  = (t2-t1)/2.0
-                record = [t_samp, t_err]
-                #convert subsample to array for processing
-                subsamps = np.array(subsamps)
-                sample = subsamps.mean(axis=1)  #average columnwise
-                if self.store_error:
-                    err = subsamps.std(axis=1)  #std.dev. columnwise
-                    for s,e in zip(sample,err):
-                        record += [s,e]
+                if not scheduler is None:
+                    scheduler.wait()
+                k = self._count
+                t1 = monotonic()
+                if adaptive:
+                    #read batches until the channels are settled
+                    means, stds, n = adaptive_mean(read_block, self.target_error,
+                                                   min_samples = min(self.min_samp_size, samp_size),
+                                                   max_samples = samp_size)
+                    if self.store_error:
+                        records[k,2:2 + num_vals:2] = means
+                        records[k,3:2 + num_vals:2] = stds
+                    else:
+                        records[k,2:2 + num_vals] = means
+                    records[k,-1] = n #samp_n
                 else:
-                    record += list(sample)
-                self.buffer.append(record)
+                    #read the whole subsample block as one batch of transactions,
+                    #filling the buffer slot as (subsamples x channels)
+                    adc.scan(plan, samp_size, out = subsamps[k].T)
+                    n = samp_size
+                t2 = monotonic()
+                if metrics.ENABLED:
+                    metrics.record("sample.scan", t2 - t1, items = n)
+                records[k,0] = (t1+t2)/2.0 - t0_mono #t_samp
+                records[k,1] = (t2-t1)/2.0           #t_err
+                self._count = k + 1
                 i += 1
-                if i % buff_size == 0:
+                if self._count == buff_size:
                     if self.verbose:
-                        print "%d samples collected, flushing buffer..." % i
+                        print "%d samples collected, flushing buffer (%d queued)..." % (i, getattr(self.output, 'depth', 0))
                     self.flush_buffer()
-                #do nothing for a while
-                time.sleep(delay)
+                if metrics.ENABLED:
+                    #per-sample phases: read (scan), buffer (including the
+                    #reduce and output of a full buffer) and their total
+                    t3 = monotonic()
+                    metrics.record("sample.buffer", t3 - t2)
+                    metrics.record("sample.total", t3 - t1)
+                if scheduler is None:
+                    #do nothing for a while
+                    time.sleep(delay)
+                else:
+                    scheduler.done()
+        except KeyboardInterrupt:
+            return i
+        finally:
+            self.close()
+            
+    def sample_workers(self, samp_size = 1, samp_num = None,
+                       capacity      = DEFAULT_RING_CAPACITY,
+                       stall_timeout = DEFAULT_STALL_TIMEOUT,
+                      ):
+        """ like 'sample', but the ADC is scanned by a worker process which
+            writes the timed subsamples of each sample into a shared ring of
+            'capacity' samples, while this process reduces and writes them
+            (see 'workers.py'); the worker is restarted if it crashes or does
+            not sample for 'stall_timeout' seconds, its restarts and ring
+            overflows are written to the trailer
+        """
+        if not self.target_error is None:
+            raise ValueError, "adaptive oversampling is not supported by the worker"
+        adc  = self.adc
+        plan = self.plan
+        buff_size = self.buff_size
+        delay     = self.delay
+        num_chans = len(self.channels)
+        #collect metadata and write it to the file header
+        metadata = self._start_metadata()
+        metadata['samp_size']       = samp_size
+        metadata['samp_num']        = samp_num
+        metadata['delay']           = delay
+        metadata['store_error']     = self.store_error
+        metadata['schedule']        = self.schedule
+        metadata['workers']         = True
+        self._begin(metadata)
+        self._allocate_buffer(1)
+        self._reduced = True
+        records = self._records
+        #the worker's record: scan start and end times, then the subsamples
+        scratch  = np.empty(2 + samp_size*num_chans)
+        subsamps = scratch[2:].reshape((samp_size, num_chans))
+        def read():
+            t1 = monotonic()
+            adc.scan(plan, samp_size, out = subsamps)
+            scratch[0] = t1
+            scratch[1] = monotonic()
+            return scratch
+        fixed = (self.schedule == "fixed")
+        worker = AcquisitionWorker("adc", read, len(scratch),
+                                   period   = delay if fixed else None,
+                                   delay    = 0.0 if fixed else delay,
+                                   capacity = capacity,
+                                  )
+        pool = self.pool = WorkerPool([worker], stall_timeout = stall_timeout)
+        #the monotonic clock is shared by the processes
+        t0_mono = monotonic()
+        pool.start()
+        try:
+            i = 0
+            while i < samp_num or samp_num is None:
+                block = pool.wait("adc", timeout = 1.0)
+                if not samp_num is None:
+                    block = block[:samp_num - i]
+                n = len(block)
+                if n == 0:
+                    continue
+                timed = metrics.ENABLED
+                if timed:
+                    t1 = monotonic()
+                #reduce the whole block of samples at once
+                reduced = np.empty((n, len(self.columns)))
+                reduced[:,0] = (block[:,0] + block[:,1])/2.0 - t0_mono #t_samp
+                reduced[:,1] = (block[:,1] - block[:,0])/2.0           #t_err
+                block = block[:,2:].reshape((n, samp_size, num_chans))
+                if self.store_error:
+                    block.mean(axis = 1, out = reduced[:,2::2])
+                    block.std(axis = 1,  out = reduced[:,3::2])
+                else:
+                    block.mean(axis = 1, out = reduced[:,2:])
+                if timed:
+                    metrics.record("sample.reduce", monotonic() - t1, items = block.size)
+                #fill the buffer, writing it whenever it is full
+                j = 0
+                while j < n:
+                    k   = self._count
+                    num = min(n - j, buff_size - k)
+                    records[k:k + num] = reduced[j:j + num]
+                    self._count = k + num
+                    j += num
+                    if self._count == buff_size:
+                        if self.verbose:
+                            print "%d samples collected, flushing buffer (%d queued)..." % (i + j, getattr(self.output, 'depth', 0))
+                        self.flush_buffer()
+                i += n
+        except KeyboardInterrupt:
+            return i
+        finally:
+            pool.stop()
+            self.close()
+            
+    def stream(self, decimator, block_size = DEFAULT_BLOCK_SIZE, samp_num = None):
+        """ read the ADC continuously in blocks of 'block_size' scans and 
+            record 'samp_num' samples (or until interrupted) of the output of 
+            'decimator' (see 'decimation.py'), at 1/decimator.factor of the
+            scan rate; 'delay', 'schedule' and 'store_error' do not apply
+        """
+        adc  = self.adc
+        plan = self.plan
+        num_chans = len(self.channels)
+        self.columns = ["t_samp", "t_err"] + ["chan%d" % chan for chan in self.channels]
+        #collect metadata and write it to the file header
+        metadata = self._start_metadata()
+        metadata['mode']        = "stream"
+        metadata['block_size']  = block_size
+        metadata['samp_num']    = samp_num
+        metadata.update(decimator.metadata())
+        self._begin(metadata)
+        #the scan times are filtered along with the values (column 0), 
+        #which time stamps the output with the delay of the filter 
+        scans    = np.empty((block_size, 1 + num_chans))
+        offsets  = (np.arange(block_size) + 0.5)/block_size
+        records  = np.empty((block_size//decimator.factor + 1, len(self.columns)))
+        self._count = 0
+        t0_mono = monotonic()
+        try:
+            i = 0
+            while i < samp_num or samp_num is None:
+                t1 = monotonic()
+                adc.scan(plan, block_size, out = scans[:,1:])
+                t2 = monotonic()
+                np.multiply(offsets, t2 - t1, out = scans[:,0])
+                scans[:,0] += t1 - t0_mono
+                out = decimator.process(scans)
+                if metrics.ENABLED:
+                    metrics.record("stream.scan", t2 - t1, items = block_size)
+                    metrics.record("stream.filter", monotonic() - t2, items = block_size)
+                n = len(out)
+                if not samp_num is None:
+                    n = min(n, samp_num - i)
+                if n > 0:
+                    block = records[:n]
+                    block[:,0]  = out[:n,0]                                  #t_samp
+                    block[:,1]  = (t2 - t1)/block_size*decimator.factor/2.0 #t_err
+                    block[:,2:] = out[:n,1:]
+                    self._write(block)
+                    i += n
+                self._flush()
+                if metrics.ENABLED:
+                    metrics.record("stream.total", monotonic() - t1, items = block_size)
+                if self.verbose:
+                    print "%d samples recorded (%d queued)..." % (i, getattr(self.output, 'depth', 0))
         except KeyboardInterrupt:
             return i
         finally:
             self.close()
             
     def write_header(self, metadata):
-        self.output_file.write("#<METADATA>")
-        self.output_file.write(self.csv_newline)
-        for key, val in metadata.items():
-            self.output_file.write("#%s = %r" % (key,val))
-            self.output_file.write(self.csv_newline)
-        self.output_file.write("#</METADATA>")
-        self.output_file.write(self.csv_newline)
-        #column descriptor
-        line = ["#t_samp (s)", "t_err(s)"]
-        for chan in self.channels:
-            line += ["chan%d" % chan]
-            if self.store_error:
-                line += ["chan%d_err" % chan]
-        self.output_file.write(self.csv_delimiter.join(line))
-        self.output_file.write(self.csv_newline)
-        self.output_file.flush()
+        self.output.write_header(metadata, self.columns)
             
             
     def flush_buffer(self):
-        for record in self.buffer:
-            line = self.csv_delimiter.join(map(str,record))
-            self.output_file.write(line)
-            self.output_file.write(self.csv_newline)
-        self.output_file.flush()
-        self.buffer = []
+        n = self._count
+        if n > 0:
+            block = self._records[:n]
+            if not self._reduced:
+                timed = metrics.ENABLED
+                if timed:
+                    t1 = monotonic()
+                #reduce the subsamples of all buffered samples in place
+                subsamps = self._subsamps[:n]
+                if self.store_error:
+                    subsamps.mean(axis=2, out = block[:,2::2])  #average columnwise
+                    subsamps.std(axis=2,  out = block[:,3::2])  #std.dev. columnwise
+                else:
+                    subsamps.mean(axis=2, out = block[:,2:])
+                if timed:
+                    metrics.record("sample.reduce", monotonic() - t1, items = subsamps.size)
+            self._write(block)
+            self._count = 0
+        self._flush()
+        
+    def _write(self, block):
+        """ hand the records to the writer (only queued when it is threaded,
+            see the "writer." stages for the actual output)
+        """
+        timed = metrics.ENABLED
+        if timed:
+            t1 = monotonic()
+        self.output.write_records(block)
+        if timed:
+            metrics.record("output.write", monotonic() - t1, items = len(block))
+            
+    def _flush(self):
+        timed = metrics.ENABLED
+        if timed:
+            t1 = monotonic()
+        self.output.flush()
+        if timed:
+            metrics.record("output.flush", monotonic() - t1)
         
     def close(self):
         self.flush_buffer()
-        self.output_file.close()
+        stats = OrderedDict()
+        if not self.scheduler is None:
+            stats.update(self.scheduler.stats())
+            self.scheduler = None
+        if not self.pool is None:
+            stats.update(self.pool.stats())
+            self.pool = None
+        if hasattr(self.output, 'drain'):
+            #wait for the queued records so that the counters are final
+            self.output.drain()
+        if hasattr(self.output, 'stats'):
+            stats.update(self.output.stats())
+        if stats:
+            if self.verbose:
+                print "Run statistics:"
+                for key,val in stats.items():
+                    print "\t%s = %r" % (key,val)
+            self.output.write_trailer(stats)
+        self.output.close()
         
         
 
 ################################################################################
 # MAIN
 ################################################################################
-import RPi.GPIO as GPIO
-#TODO these pin settings should be configurable from the commandline
-ADC_SPI_TYPE = "software"
+import backend
+from comm_spi import DEFAULT_SPEED_HZ
+from adcgroup import ADCGroup, parse_device_spec
+from thingspeak import ThingspeakUploader, DEFAULT_MIN_INTERVAL
+from sinks import ThingspeakSink, StoreSink, SocketSink
+from tsstore import TimeSeriesStore
+from rotating import RotatingCSVWriter, CODECS, DEFAULT_CODEC
+from journal import JournaledWriter, FSYNC_POLICIES, DEFAULT_FSYNC, DEFAULT_CAPACITY,\
+                    DEFAULT_COMMIT_INTERVAL, DEFAULT_FSYNC_INTERVAL
+#default pin settings, other devices are configured with '--device'
+ADC_SPI_TYPE   = "software"
+ADC_SPI_DEVICE = "/dev/spidev0.0"
 SPICLK  = 18
 SPIMISO = 23
 SPIMOSI = 24
 SPICS   = 25
-PINMODE = GPIO.BCM  #configure the pin order as Broadcom SoC channels
+PINMODE = "BCM"  #configure the pin order as Broadcom SoC channels
+JOURNAL_SUFFIX = ".journal" #readings waiting to be uploaded to Thingspeak
+RING_SUFFIX    = ".ring"    #records waiting to be committed to the output
+
+PROFILE_SUFFIX        = ".prof"     #cProfile statistics (see 'pstats')
+PROFILE_REPORT_SUFFIX = ".prof.txt" #latency histograms and the top functions
+PROFILE_TOP           = 30          #number of functions listed in the report
+
+def write_profile(profiler, path, verbose = False):
+    """ dump the statistics of the 'profiler' to 'path'+PROFILE_SUFFIX and 
+        write the latency histograms of the metrics stages and the functions
+        with the most cumulative and internal time to 'path'+PROFILE_REPORT_SUFFIX
+    """
+    import pstats
+    profiler.dump_stats(path + PROFILE_SUFFIX)
+    with open(path + PROFILE_REPORT_SUFFIX, 'w') as f:
+        f.write(metrics.format_report() + "\n\n")
+        stats = pstats.Stats(profiler, stream = f)
+        stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+        stats.sort_stats('tottime').print_stats(PROFILE_TOP)
+    if verbose:
+        print metrics.format_report()
+        print "Profile written to: %s (report %s)" % (path + PROFILE_SUFFIX, path + PROFILE_REPORT_SUFFIX)
+
+def setup_adc(spec, GPIO, spi_speed = DEFAULT_SPEED_HZ, simulate = False):
+    """ create and set up the ADC described by 'spec' (see 
+        'adcgroup.parse_device_spec'), with an emulated chip when 'simulate'
+    """
+    if simulate:
+        from sim.mcp3008 import SimMCP3008
+    adc_class = ADCS[spec['model']]
+    adc = adc_class()
+    if spec['spi'] == "software":
+        clockpin, mosipin, misopin = spec['pins']
+        if simulate:
+            SimMCP3008(clockpin = clockpin,
+                       misopin  = misopin,
+                       mosipin  = mosipin,
+                       cspin    = spec['cs'],
+                      ).connect(GPIO)
+        adc.setup_software_spi(clockpin = clockpin,
+                               misopin  = misopin,
+                               mosipin  = mosipin,
+                               cspin    = spec['cs'],
+                               pinmode  = getattr(GPIO, PINMODE),
+                              )
+    elif spec['spi'] == "hardware":
+        spi_device = spec['device']
+        if simulate:
+            from sim.spidev import FakeSpiDevFile
+            spi_device = FakeSpiDevFile(responder = SimMCP3008().respond, realtime = True)
+        adc.setup_hardware_spi(device   = spi_device,
+                               speed_hz = spi_speed,
+                              )
+    return adc
 
 if __name__ == "__main__":
     import argparse
@@ -146,6 +540,29 @@ if __name__ == "__main__":
                         help = "the type of adc chip to sample from",
                         default = "mcp3008",
                        )
+    parser.add_argument("-D", "--device", 
+                        help = "ADC device as MODEL:BUS:CS:CHANNELS[:MODES], where BUS is the software SPI pins CLK,MOSI,MISO or a spidev bus /dev/spidevN, e.g. mcp3008:18,24,23:25:0-7 (repeat for more devices, replaces --adc, --spi, --spi_device, --channels and --modes)",
+                        action = "append",
+                        default = [],
+                       )
+    parser.add_argument("--spi", 
+                        help = "SPI driver type 'software' (bit-banged GPIO) or 'hardware' (spidev)",
+                        choices = ["software","hardware"],
+                        default = ADC_SPI_TYPE,
+                       )
+    parser.add_argument("--spi_device", 
+                        help = "spidev device for hardware SPI",
+                        default = ADC_SPI_DEVICE,
+                       )
+    parser.add_argument("--spi_speed", 
+                        help = "clock rate in Hz for hardware SPI",
+                        default = DEFAULT_SPEED_HZ,
+                       )
+    parser.add_argument("--simulate", 
+                        help = "use the simulated hardware backend (see the 'sim' package), also enabled by setting %s=sim" % backend.ENV_VAR,
+                        action="store_true",
+                        default = False,
+                       )
     parser.add_argument("-c", "--channels", 
                         help = "channels to sample separated by ','",
                         default = "0",
@@ -158,64 +575,235 @@ if __name__ == "__main__":
                         help = "delay between samples in seconds",
                         default = 1.0,
                        )
+    parser.add_argument("--schedule", 
+                        help = "'delay' to sleep DELAY after each sample, 'fixed' to sample every DELAY seconds on a drift-free timeline and record jitter statistics",
+                        choices = SCHEDULES,
+                        default = DEFAULT_SCHEDULE,
+                       )
     parser.add_argument("-s", "--samp_size", 
                         help = "number of subsamples to average for each recorded sample",
                         default = 1,
                        )
+    parser.add_argument("--target_error", 
+                        help = "adaptive oversampling: stop subsampling once the standard error of every channel is within this many volts, SAMP_SIZE is then the most subsamples per sample (the count used is recorded as 'samp_n')",
+                        default = None,
+                       )
+    parser.add_argument("--min_samp_size", 
+                        help = "fewest subsamples per sample with --target_error",
+                        default = DEFAULT_MIN_SAMPLES,
+                       )
     parser.add_argument("-n", "--samp_num", 
                         help = "number of samples to collect",
                         default = None,
                        )
+    parser.add_argument("--filter", 
+                        help = "stream the ADC continuously through a decimation filter instead of averaging SAMP_SIZE subsamples every DELAY",
+                        choices = FILTERS.keys(),
+                        default = None,
+                       )
+    parser.add_argument("--factor", 
+                        help = "decimation factor of the filter",
+                        default = DEFAULT_FACTOR,
+                       )
+    parser.add_argument("--cic_order", 
+                        help = "number of stages of the 'cic' filter",
+                        default = DEFAULT_CIC_ORDER,
+                       )
+    parser.add_argument("--cic_delay", 
+                        help = "differential delay of the 'cic' filter",
+                        default = DEFAULT_CIC_DELAY,
+                       )
+    parser.add_argument("--taps", 
+                        help = "number of taps of the 'fir' low-pass filter, or a file of coefficients (one per line)",
+                        default = DEFAULT_FIR_TAPS,
+                       )
+    parser.add_argument("--block_size", 
+                        help = "number of scans read at a time by the filter",
+                        default = DEFAULT_BLOCK_SIZE,
+                       )
+    parser.add_argument("--workers", 
+                        help = "scan the ADC in a worker process, restarted if it fails, which hands the subsamples to this process through shared memory for the reduction and output (see 'workers.py')",
+                        action="store_true",
+                        default = False,
+                       )
+    parser.add_argument("--stall_timeout", 
+                        help = "restart the worker if it has not sampled for this many seconds",
+                        default = DEFAULT_STALL_TIMEOUT,
+                       )
     parser.add_argument("-b", "--buff_size", 
                         help = "number of samples to hold in memory before writing to disk",
                         default = DEFAULT_BUFFSIZE,
                        )
+    parser.add_argument("-q", "--queue_size", 
+                        help = "number of buffers queued for the writer thread, 0 writes from the sampling loop",
+                        default = DEFAULT_QUEUE_SIZE,
+                       )
+    parser.add_argument("--policy", 
+                        help = "what to do when the writer queue is full: 'block' sampling, 'drop_oldest' buffer, or 'spill' into memory",
+                        choices = POLICIES,
+                        default = DEFAULT_POLICY,
+                       )
+    parser.add_argument("--thingspeak", 
+                        help = "also upload the records to Thingspeak, with the API write key read from this file",
+                        default = None,
+                       )
+    parser.add_argument("--thingspeak_channel", 
+                        help = "Thingspeak channel id, enables bulk uploads",
+                        default = None,
+                       )
+    parser.add_argument("--thingspeak_fields", 
+                        help = "columns to upload as COLUMN=FIELD separated by ',', e.g. chan0=field1,chan1=field3 (default the channels in order to field1...field8)",
+                        default = None,
+                       )
+    parser.add_argument("--thingspeak_period", 
+                        help = "seconds of samples averaged into each upload",
+                        default = DEFAULT_MIN_INTERVAL,
+                       )
+    parser.add_argument("--store", 
+                        help = "also insert the records into a local SQLite time-series database with per-minute, hour and day rollups (see 'tsstore.py')",
+                        default = None,
+                       )
+    parser.add_argument("--socket", 
+                        help = "also broadcast the records as CSV text to the clients of a UNIX socket at this path",
+                        default = None,
+                       )
+    parser.add_argument("--deadband", 
+                        help = "only record (and publish) the samples whose channels changed significantly, by more than this many volts or COLUMN=VOLTS separated by ',' (see 'deadband.py')",
+                        default = None,
+                       )
+    parser.add_argument("--deadband_method", 
+                        help = "'swinging_door' keeps the channels within the deadband of the lines between the recorded samples, 'threshold' within the deadband of the last recorded value",
+                        choices = DEADBAND_METHODS,
+                        default = DEFAULT_DEADBAND_METHOD,
+                       )
+    parser.add_argument("--rel_deadband", 
+                        help = "widen the deadband by this fraction of the channel values",
+                        default = 0.0,
+                       )
+    parser.add_argument("--heartbeat", 
+                        help = "record a sample at least every this many seconds with --deadband",
+                        default = DEFAULT_HEARTBEAT,
+                       )
     parser.add_argument("-e", "--store_error", 
                         help = "store the errors of the samples (std. dev. of subsamples)",
                         action="store_true",
                         default = False,
                        )
+    parser.add_argument("-p", "--precision", 
+                        help = "number of decimal places of the values written to file",
+                        default = DEFAULT_PRECISION,
+                       )
     parser.add_argument("-o", "--output_file", 
-                        help = "file to store samples",
-                        default = DEFAULT_OUTPUT_FILE,
+                        help = "file to store samples (default %s)" % ", ".join("%s for %s" % (path, fmt) for fmt, path in sorted(OUTPUT_FORMATS.items())),
+                        default = None,
+                       )
+    parser.add_argument("-f", "--format", 
+                        help = "output file format, 'csv' (text) or 'bin' (binary, see 'bindata.py')",
+                        choices = sorted(OUTPUT_FORMATS.keys()),
+                        default = DEFAULT_FORMAT,
                        )                      
+    parser.add_argument("--metrics", 
+                        help = "record per-stage call counts and latencies of the hot path (SPI, ADC, reduction, output), reported every METRICS seconds to the sidecar file OUTPUT_FILE%s (and the console if verbose)" % metrics.SUFFIX,
+                        default = None,
+                       )
+    parser.add_argument("--profile", 
+                        help = "run the acquisition under cProfile with the metrics enabled, writing OUTPUT_FILE%s and a report of per-sample latency histograms and the top functions to OUTPUT_FILE%s (the writer thread is not profiled, use -q 0 to include the output)" % (PROFILE_SUFFIX, PROFILE_REPORT_SUFFIX),
+                        action="store_true",
+                        default = False,
+                       )
+    parser.add_argument("--rotate_size", 
+                        help = "start a new output segment after this many MB of CSV text, the segments are named OUTPUT_FILE with their start time and number (see 'rotating.py')",
+                        default = None,
+                       )
+    parser.add_argument("--rotate_interval", 
+                        help = "start a new output segment every this many seconds",
+                        default = None,
+                       )
+    parser.add_argument("--compress", 
+                        help = "compress the output segments with this codec as they are written, written in large blocks",
+                        choices = CODECS.keys(),
+                        default = None,
+                       )
+    parser.add_argument("--journal", 
+                        help = "buffer the records in a memory-mapped ring journal OUTPUT_FILE%s, committed to the output in large batches and recovered on the next start after a crash (replaces the writer thread); the records reach the journal every BUFF_SIZE samples, so a crash loses at most the last BUFF_SIZE samples, while a power cut loses those not yet synced by the --fsync policy" % RING_SUFFIX,
+                        action="store_true",
+                        default = False,
+                       )
+    parser.add_argument("--journal_size", 
+                        help = "capacity of the journal in records",
+                        default = DEFAULT_CAPACITY,
+                       )
+    parser.add_argument("--commit_interval", 
+                        help = "longest time in seconds between the commits of the journal, which are otherwise made when it is half full",
+                        default = DEFAULT_COMMIT_INTERVAL,
+                       )
+    parser.add_argument("--fsync", 
+                        help = "when to sync the journal and the output to the storage: 'none', every 'batch' (on each commit) or at an 'interval'",
+                        choices = FSYNC_POLICIES,
+                        default = DEFAULT_FSYNC,
+                       )
+    parser.add_argument("--fsync_interval", 
+                        help = "seconds between syncs of the 'interval' fsync policy",
+                        default = DEFAULT_FSYNC_INTERVAL,
+                       )
     parser.add_argument("-v", "--verbose", 
                         help="increase output verbosity",
                         action="store_true",
                         default = DEFAULT_VERBOSE,
                        )
     args = parser.parse_args()
-    #check the adc argument and configure the acquisition
-    adc_class = ADCS[args.adc]
-    adc = adc_class()
-    adc_spi_type = ADC_SPI_TYPE #TODO add hardware support handling
-    if adc_spi_type == "software":
-        adc.setup_software_spi(clockpin = SPICLK,
-                               misopin  = SPIMISO,
-                               mosipin  = SPIMOSI,
-                               cspin    = SPICS,
-                               pinmode  = PINMODE
-                              )
+    #select the hardware backend before anything is set up
+    if args.simulate:
+        backend.select("sim")
+    GPIO = backend.get_gpio()
+    simulate = backend.is_simulated()
+    spi_speed = int(args.spi_speed)
+    assert spi_speed > 0
+    if args.device:
+        #several devices on shared buses, sampled as one
+        specs = [parse_device_spec(spec) for spec in args.device]
+        adcs  = [setup_adc(spec, GPIO, spi_speed = spi_speed, simulate = simulate) for spec in specs]
+        if len(adcs) == 1:
+            adc = adcs[0]
+            channels = specs[0]['channels']
+            modes    = specs[0]['modes']
+        else:
+            adc = ADCGroup(adcs)
+            channels = []
+            modes    = []
+            for index, spec in enumerate(specs):
+                channels += [adc.channel(index, chan) for chan in spec['channels']]
+                modes    += spec['modes']
     else:
-        raise NotImplemented #TODO
-    #check the channels argument
-    channels = args.channels
-    channels = map(int,channels.split(','))
-    #check the modes argument
-    modes    = args.modes.split(',')
-    assert len(modes) <= len(channels)
-    #fill in missing modes as single-ended
-    if modes == ['']:
-        modes = ['s']*len(channels)
-    else:  
-        for m in modes:
-            assert m in ['s','d']
-        modes = modes + ['s']*(len(channels) - len(modes))
+        #check the channels argument
+        channels = args.channels
+        channels = map(int,channels.split(','))
+        #check the modes argument
+        modes    = args.modes.split(',')
+        assert len(modes) <= len(channels)
+        #fill in missing modes as single-ended
+        if modes == ['']:
+            modes = ['s']*len(channels)
+        else:  
+            for m in modes:
+                assert m in ['s','d']
+            modes = modes + ['s']*(len(channels) - len(modes))
+        #the single device of the --adc and --spi arguments
+        spec = {'model': args.adc, 'spi': args.spi, 'cs': SPICS,
+                'pins': (SPICLK, SPIMOSI, SPIMISO), 'device': args.spi_device}
+        adc = setup_adc(spec, GPIO, spi_speed = spi_speed, simulate = simulate)
     #check delay argument
     delay = float(args.delay)
     #check samp_size argument
     samp_size = int(args.samp_size)
     assert samp_size > 0
+    #check the adaptive oversampling arguments
+    target_error = None
+    if not args.target_error is None:
+        target_error = float(args.target_error)
+        assert target_error > 0
+    min_samp_size = int(args.min_samp_size)
+    assert min_samp_size > 0
     #check samp_num argument
     samp_num = None
     if not args.samp_num is None:
@@ -224,28 +812,122 @@ if __name__ == "__main__":
     #check buff_size argument
     buff_size = int(args.buff_size)
     assert buff_size > 0   
+    #check queue_size argument
+    queue_size = int(args.queue_size)
+    assert queue_size >= 0
+    #check the filter arguments
+    if not args.filter is None:
+        factor = int(args.factor)
+        assert factor > 0
+        block_size = int(args.block_size)
+        assert block_size > 0
+        taps = args.taps
+        if str(taps).isdigit():
+            taps = int(taps)
+        else:
+            taps = np.loadtxt(taps, ndmin = 1)
+        decimator = make_decimator(args.filter,
+                                   factor = factor,
+                                   order  = int(args.cic_order),
+                                   delay  = int(args.cic_delay),
+                                   taps   = taps,
+                                  )
+    #check the worker arguments
+    stall_timeout = float(args.stall_timeout)
+    assert stall_timeout > 0
+    if args.workers and not (args.filter is None and target_error is None):
+        parser.error("--workers does not support --filter or --target_error")
+    #check the deadband arguments
+    deadband = None
+    if not args.deadband is None:
+        if "=" in args.deadband:
+            deadband = dict((name, float(val)) for name, val in
+                            (item.split("=") for item in args.deadband.split(",")))
+        else:
+            deadband = float(args.deadband)
+    rel_deadband = float(args.rel_deadband)
+    assert rel_deadband >= 0
+    heartbeat = float(args.heartbeat)
+    assert heartbeat > 0
+    #check metrics argument
+    metrics_interval = None
+    if not args.metrics is None:
+        metrics_interval = float(args.metrics)
+        assert metrics_interval > 0
+    #check precision argument
+    precision = int(args.precision)
+    assert precision >= 0
     #check output file argument
-    output_file = None
+    output_path = args.output_file
+    if output_path is None:
+        output_path = OUTPUT_FORMATS[args.format]
+    #check the rotation arguments
+    rotate = not (args.rotate_size is None and args.rotate_interval is None and args.compress is None)
+    if rotate and args.format != "csv":
+        parser.error("rotating and compressed output is only supported for the 'csv' format")
     output_mode = None
-    if os.path.isfile(args.output_file):
+    if rotate:
+        output_mode = "rotate"   #each segment is a new file
+    elif os.path.isfile(output_path):
         print "-"*20
         res = ""
         while not res in ['A','a','O','o','Q','q']:
-            res = raw_input("Output file '%s' already exists, (A)ppend/(O)verwrite/(Q)uit?: " % args.output_file)
+            res = raw_input("Output file '%s' already exists, (A)ppend/(O)verwrite/(Q)uit?: " % output_path)
             if res in ['A','a']:
-                output_file = open(args.output_file,'a')
                 output_mode = "append"
             elif res in ['O','o']:
-                output_file = open(args.output_file,'w')
                 output_mode = "overwrite"
             elif res in ['Q','q']:
                 sys.exit(0)
     else:
-        output_file = open(args.output_file,'w')
         output_mode = 'create'
+    output_file = None
+    writer      = None
+    if rotate:
+        writer = RotatingCSVWriter(output_path,
+                                   max_bytes   = None if args.rotate_size is None else int(float(args.rotate_size)*2**20),
+                                   max_seconds = None if args.rotate_interval is None else float(args.rotate_interval),
+                                   codec       = DEFAULT_CODEC if args.compress is None else args.compress,
+                                   precision   = precision,
+                                  )
+    elif args.format == "csv":
+        output_file = open(output_path, 'a' if output_mode == "append" else 'w')
+    elif args.format == "bin":
+        writer = BinaryWriter(output_path, append = (output_mode == "append"))
                      
+    if args.journal:
+        if writer is None:
+            writer = CSVWriter(output_file, precision = precision)
+        writer = JournaledWriter(writer, output_path + RING_SUFFIX,
+                                 capacity        = int(args.journal_size),
+                                 commit_interval = float(args.commit_interval),
+                                 fsync           = args.fsync,
+                                 fsync_interval  = float(args.fsync_interval),
+                                )
+        #the journal batches the output, which is written inline
+        queue_size = 0
+        if writer.records_recovered and args.verbose:
+            print "Recovered %d records from the journal %s" % (writer.records_recovered, writer.path)
     if args.verbose:
-        print "Writing (mode=\"%s\") output file: %s" % (output_mode,args.output_file)
+        print "Writing (mode=\"%s\", format=\"%s\") output file: %s" % (output_mode,args.format,output_path)
+    #the other consumers of the records, each with its own queue which drops
+    #the oldest records rather than holding up the sampling
+    sinks = []
+    if not args.thingspeak is None:
+        api_write_key = open(args.thingspeak).read().strip()
+        fields = None
+        if not args.thingspeak_fields is None:
+            fields = OrderedDict(item.split("=") for item in args.thingspeak_fields.split(","))
+        uploader = ThingspeakUploader(api_write_key, output_path + JOURNAL_SUFFIX,
+                                      channel_id = args.thingspeak_channel)
+        sinks.append(("thingspeak", ThingspeakSink(uploader, fields = fields,
+                                                   period = float(args.thingspeak_period))))
+    if not args.store is None:
+        sinks.append(("store", StoreSink(TimeSeriesStore(args.store))))
+    if not args.socket is None:
+        sinks.append(("socket", SocketSink(args.socket, precision = precision)))
+    sinks = [(name, ThreadedWriter(sink, queue_size = max(queue_size, 1), policy = "drop_oldest"))
+             for name, sink in sinks]
         
     #configure the application
     app = Application(adc         = adc,
@@ -256,10 +938,53 @@ if __name__ == "__main__":
                       output_file = output_file,
                       store_error = args.store_error,
                       verbose     = args.verbose,
+                      precision   = precision,
+                      writer      = writer,
+                      schedule    = args.schedule,
+                      queue_size  = queue_size,
+                      policy      = args.policy,
+                      sinks       = sinks,
+                      target_error  = target_error,
+                      min_samp_size = min_samp_size,
+                      deadband        = deadband,
+                      deadband_method = args.deadband_method,
+                      rel_deadband    = rel_deadband,
+                      heartbeat       = heartbeat,
                       )
     
+    reporter = None
+    if args.profile or not metrics_interval is None:
+        metrics.enable()
+    if not metrics_interval is None:
+        reporter = metrics.Reporter(interval = metrics_interval,
+                                    stream   = sys.stdout if args.verbose else None,
+                                    path     = output_path + metrics.SUFFIX,
+                                   ).start()
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
     #start acquisition
-    app.sample(samp_size = samp_size, 
-               samp_num  = samp_num,
-              )
+    try:
+        if args.workers:
+            app.sample_workers(samp_size     = samp_size,
+                               samp_num      = samp_num,
+                               stall_timeout = max(stall_timeout, 2*delay),
+                              )
+        elif args.filter is None:
+            app.sample(samp_size = samp_size, 
+                       samp_num  = samp_num,
+                      )
+        else:
+            app.stream(decimator  = decimator,
+                       block_size = block_size,
+                       samp_num   = samp_num,
+                      )
+    finally:
+        if not profiler is None:
+            profiler.disable()
+            write_profile(profiler, output_path, verbose = args.verbose)
+        if not reporter is None:
+            reporter.stop()
     
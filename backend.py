@@ -0,0 +1,44 @@
+""" Selection of the hardware interface backend: the Raspberry Pi GPIO pins
+    ('rpi') or the pin-level hardware simulator in the 'sim' package ('sim').
+    The backend defaults to the value of the environment variable
+    OPENLABMONITOR_BACKEND and may be overridden with 'select' (e.g. from a
+    command line flag) before any hardware is set up.
+"""
+################################################################################
+import os
+
+ENV_VAR         = "OPENLABMONITOR_BACKEND"
+BACKENDS        = ("rpi", "sim")
+DEFAULT_BACKEND = "rpi"
+
+_backend = None
+################################################################################
+def select(name = None):
+    """ set the backend 'name', if not specified it is taken from the 
+        environment
+    """
+    global _backend
+    if name is None:
+        name = os.environ.get(ENV_VAR, DEFAULT_BACKEND)
+    if not name in BACKENDS:
+        raise ValueError("backend must be one of %r, got %r" % (BACKENDS, name))
+    _backend = name
+    return name
+    
+def get_backend():
+    if _backend is None:
+        select()
+    return _backend
+    
+def is_simulated():
+    return get_backend() == "sim"
+    
+def get_gpio():
+    """ get the GPIO module of the selected backend, which provides the 
+        RPi.GPIO interface
+    """
+    if is_simulated():
+        from sim import GPIO
+    else:
+        import RPi.GPIO as GPIO
+    return GPIO
@@ -0,0 +1,281 @@
+""" Binary data file format for 'adcsampler.py'.  The file is a sequence of 
+    self-describing segments (one per acquisition session), each made of
+      prelude     : magic "OLMBIN01", header size (uint32), record size 
+                    (uint32), number of records (uint64), little-endian
+      header text : the same '#<METADATA>' block as the CSV format and a
+                    '#<COLUMNS>' block of '#name = dtype' lines
+      padding     : to align the records on HEADER_ALIGN bytes
+      records     : fixed-width little-endian records
+    The records are appended through a memory map of a preallocated extent,
+    the record count in the prelude is updated after every write, so that 
+    a reader never sees more records than have been written.
+    Run statistics (trailers) are appended to the text sidecar "<file>.stats"
+    as '#<RUNSTATS>' blocks, tagged with the offset of their segment.
+"""
+################################################################################
+import os, mmap, struct
+from collections import OrderedDict
+import numpy as np
+
+from csvdata import format_metadata, parse_metadata_line, METADATA_BEGIN,\
+                    METADATA_END, RUNSTATS_BEGIN, RUNSTATS_END, TIME_COLUMNS,\
+                    CSVWriter, read_csv, DEFAULT_PRECISION
+
+MAGIC          = "OLMBIN01"
+PRELUDE        = struct.Struct("<8sIIQ")
+NUM_RECORDS_OFFSET = 16
+HEADER_ALIGN   = 64
+COLUMNS_BEGIN  = "#<COLUMNS>"
+COLUMNS_END    = "#</COLUMNS>"
+NEWLINE        = "\n"
+STATS_SUFFIX   = ".stats"
+
+TIME_DTYPE          = "<f8"
+DEFAULT_VALUE_DTYPE = "<f4"
+DEFAULT_EXTENT      = 1 << 16 #bytes, file preallocation step
+################################################################################
+def make_dtype(columns, value_dtype = DEFAULT_VALUE_DTYPE):
+    """ the record layout for 'columns', timestamps are always double 
+        precision
+    """
+    fields = []
+    for name in columns:
+        if name in TIME_COLUMNS:
+            fields.append((name, TIME_DTYPE))
+        else:
+            fields.append((name, value_dtype))
+    return np.dtype(fields)
+    
+def _align(size, alignment):
+    return -(-size // alignment)*alignment
+    
+def _read_segment_header(f, offset):
+    """ read the segment header at 'offset' of the open file 'f', returns 
+        None if there is no valid segment there
+    """
+    f.seek(offset)
+    prelude = f.read(PRELUDE.size)
+    if len(prelude) < PRELUDE.size:
+        return None
+    magic, header_size, record_size, num_records = PRELUDE.unpack(prelude)
+    if magic != MAGIC:
+        return None
+    text = f.read(header_size - PRELUDE.size).rstrip("\0")
+    metadata = OrderedDict()
+    fields   = []
+    block    = None
+    for line in text.split(NEWLINE):
+        if   line in (METADATA_BEGIN, COLUMNS_BEGIN):
+            block = line
+        elif line in (METADATA_END, COLUMNS_END):
+            block = None
+        elif line.startswith("#"):
+            key, val = parse_metadata_line(line)
+            if block == METADATA_BEGIN:
+                metadata[key] = val
+            elif block == COLUMNS_BEGIN:
+                fields.append((key, val))
+    dtype = np.dtype(fields)
+    if dtype.itemsize != record_size:
+        raise IOError("corrupted segment header at offset %d" % offset)
+    return metadata, dtype, offset + header_size, num_records
+    
+def iter_segments(path):
+    """ iterate over (metadata, dtype, data_offset, num_records) of each 
+        segment of the file at 'path'
+    """
+    with open(path, 'rb') as f:
+        offset = 0
+        while True:
+            header = _read_segment_header(f, offset)
+            if header is None:
+                break
+            yield header
+            metadata, dtype, data_offset, num_records = header
+            offset = _align(data_offset + num_records*dtype.itemsize, HEADER_ALIGN)
+            
+def load(path):
+    """ load the sessions of a binary data file as a list of 
+        (metadata, records), the records are a read-only structured array
+        memory mapped from the file (zero-copy) with the column names as
+        fields
+    """
+    sessions = []
+    for metadata, dtype, data_offset, num_records in iter_segments(path):
+        if num_records > 0:
+            records = np.memmap(path, dtype = dtype, mode = 'r', 
+                                offset = data_offset, shape = (num_records,))
+        else:
+            records = np.empty((0,), dtype = dtype)
+        sessions.append((metadata, records))
+    return sessions
+    
+################################################################################
+class BinaryWriter(object):
+    """ writes sessions of records to the binary file at 'path', creating
+        (or overwriting) it unless 'append' is set; 'value_dtype' sets the 
+        storage type of the sampled values and 'extent' the number of bytes
+        by which the file is grown at a time
+    """
+    def __init__(self, path, 
+                 append      = False,
+                 value_dtype = DEFAULT_VALUE_DTYPE,
+                 extent      = DEFAULT_EXTENT,
+                ):
+        self.path        = path
+        self.value_dtype = value_dtype
+        self.extent      = extent
+        self.columns     = None
+        self._seg_start  = 0
+        if append and os.path.isfile(path):
+            self._file = open(path, 'r+b')
+            #new segments start after the last complete one
+            for metadata, dtype, data_offset, num_records in iter_segments(path):
+                self._seg_start = _align(data_offset + num_records*dtype.itemsize, HEADER_ALIGN)
+        else:
+            self._file = open(path, 'w+b')
+        self._mmap     = None
+        self._records  = None
+        self._capacity = 0
+        self._num      = 0
+        
+    def write_header(self, metadata, columns):
+        """ begin a new segment
+        """
+        self._end_segment()
+        self.columns = list(columns)
+        self._dtype  = make_dtype(self.columns, self.value_dtype)
+        lines = [format_metadata(metadata, newline = NEWLINE), COLUMNS_BEGIN + NEWLINE]
+        for name in self.columns:
+            lines.append("#%s = %r%s" % (name, self._dtype[name].str, NEWLINE))
+        lines.append(COLUMNS_END + NEWLINE)
+        text = "".join(lines)
+        header_size = _align(PRELUDE.size + len(text), HEADER_ALIGN)
+        prelude = PRELUDE.pack(MAGIC, header_size, self._dtype.itemsize, 0)
+        #discard anything (e.g. an unfinished extent) after the last segment
+        self._file.truncate(self._seg_start)
+        self._file.seek(self._seg_start)
+        self._file.write(prelude + text + "\0"*(header_size - PRELUDE.size - len(text)))
+        self._file.flush()
+        self._data_start = self._seg_start + header_size
+        self._num        = 0
+        self._capacity   = 0
+        
+    def write_records(self, block):
+        """ append the rows of the 2D array 'block'
+        """
+        n = len(block)
+        if n == 0:
+            return
+        if self._num + n > self._capacity:
+            self._grow(self._num + n)
+        dest = self._records[self._num:self._num + n]
+        for index, name in enumerate(self.columns):
+            dest[name] = block[:,index]
+        self._num += n
+        #commit the records by updating the count in the prelude
+        struct.pack_into("<Q", self._mmap, self._prelude_offset + NUM_RECORDS_OFFSET, self._num)
+        
+    def write_trailer(self, stats):
+        """ append the run statistics of the current segment to the sidecar
+        """
+        trailer = OrderedDict()
+        trailer['segment_offset'] = self._seg_start
+        trailer.update(stats)
+        with open(self.path + STATS_SUFFIX, 'a') as f:
+            f.write(format_metadata(trailer, newline = NEWLINE,
+                                    begin = RUNSTATS_BEGIN, end = RUNSTATS_END))
+        
+    def flush(self):
+        if not self._mmap is None:
+            self._mmap.flush()
+            
+    def fsync(self):
+        """ force the written records and their count to the storage device
+        """
+        self.flush()
+        os.fsync(self._file.fileno())
+            
+    def close(self):
+        self._end_segment()
+        self._file.close()
+        
+    def _grow(self, num_records):
+        record_size = self._dtype.itemsize
+        step = max(self.extent // record_size, 1)
+        capacity = _align(num_records, step)
+        self._unmap()
+        end = self._data_start + capacity*record_size
+        self._file.truncate(end)
+        #mmap offsets must be multiples of the allocation granularity
+        map_offset = (self._seg_start // mmap.ALLOCATIONGRANULARITY)*mmap.ALLOCATIONGRANULARITY
+        self._mmap = mmap.mmap(self._file.fileno(), end - map_offset, offset = map_offset)
+        self._prelude_offset = self._seg_start - map_offset
+        self._records = np.ndarray(shape = (capacity,), dtype = self._dtype, buffer = self._mmap,
+                                   offset = self._data_start - map_offset)
+        self._capacity = capacity
+        
+    def _unmap(self):
+        if not self._mmap is None:
+            self._records = None  #release the view before closing the map
+            self._mmap.flush()
+            self._mmap.close()
+            self._mmap = None
+            
+    def _end_segment(self):
+        if self.columns is None:
+            return
+        self._unmap()
+        end = self._data_start + self._num*self._dtype.itemsize
+        #release the unused part of the preallocated extent
+        self._seg_start = _align(end, HEADER_ALIGN)
+        self._file.truncate(end)
+        self._file.flush()
+        self.columns = None
+
+################################################################################
+# converters
+################################################################################
+def csv_to_binary(csv_path, bin_path, value_dtype = DEFAULT_VALUE_DTYPE, append = False):
+    writer = BinaryWriter(bin_path, append = append, value_dtype = value_dtype)
+    for metadata, columns, records in read_csv(csv_path):
+        writer.write_header(metadata, columns)
+        writer.write_records(records)
+    writer.close()
+    
+def binary_to_csv(bin_path, csv_path, precision = DEFAULT_PRECISION, append = False):
+    writer = CSVWriter(open(csv_path, 'a' if append else 'w'), precision = precision)
+    for metadata, records in load(bin_path):
+        columns = records.dtype.names
+        writer.write_header(metadata, columns)
+        block = np.empty((len(records), len(columns)))
+        for index, name in enumerate(columns):
+            block[:,index] = records[name]
+        writer.write_records(block)
+    writer.close()
+
+################################################################################
+# MAIN
+################################################################################
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = "convert adcsampler data files between the CSV and binary formats")
+    parser.add_argument("input_file",
+                        help = "file to convert, '.csv' files are converted to binary, others to CSV",
+                       )
+    parser.add_argument("output_file",
+                        help = "converted file",
+                       )
+    parser.add_argument("-p", "--precision", 
+                        help = "number of decimal places of the values written to CSV",
+                        default = DEFAULT_PRECISION,
+                       )
+    parser.add_argument("--value_dtype", 
+                        help = "storage type of the values written to binary",
+                        default = DEFAULT_VALUE_DTYPE,
+                       )
+    args = parser.parse_args()
+    if args.input_file.lower().endswith(".csv"):
+        csv_to_binary(args.input_file, args.output_file, value_dtype = args.value_dtype)
+    else:
+        binary_to_csv(args.input_file, args.output_file, precision = int(args.precision))
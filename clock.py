@@ -0,0 +1,43 @@
+""" Monotonic clock for timing and scheduling, unaffected by adjustments of
+    the system (wall) clock.  Python 2 lacks 'time.monotonic', so on Linux 
+    'clock_gettime(CLOCK_MONOTONIC)' is called through ctypes.
+"""
+################################################################################
+import time, ctypes, ctypes.util
+
+CLOCK_MONOTONIC = 1  #see linux/time.h
+
+class timespec(ctypes.Structure):
+    _fields_ = [("tv_sec" , ctypes.c_long),
+                ("tv_nsec", ctypes.c_long),
+               ]
+################################################################################
+def _load_clock_gettime():
+    for name in (ctypes.util.find_library("rt"), ctypes.util.find_library("c")):
+        if name is None:
+            continue
+        try:
+            lib = ctypes.CDLL(name, use_errno = True)
+            return lib.clock_gettime
+        except (OSError, AttributeError):
+            continue
+    return None
+
+if hasattr(time, 'monotonic'):
+    monotonic = time.monotonic
+else:
+    _clock_gettime = _load_clock_gettime()
+    if _clock_gettime is None:
+        #no monotonic source available, fall back to the wall clock
+        monotonic = time.time
+    else:
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        _ts  = timespec()
+        _ref = ctypes.byref(_ts)
+        def monotonic():
+            """ seconds from an arbitrary fixed point, never goes backwards
+            """
+            if _clock_gettime(CLOCK_MONOTONIC, _ref) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, "clock_gettime failed")
+            return _ts.tv_sec + _ts.tv_nsec*1e-9
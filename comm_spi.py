@@ -2,87 +2,414 @@
     either hardware or software (bit-banged) driver mode
 """
 ################################################################################
-import RPi.GPIO as GPIO
+import os, re, fcntl, threading
+from functools import partial
+from ctypes import Structure, sizeof, addressof, memmove, c_uint8, c_uint16, c_uint32, c_uint64
+import backend
+import metrics
+from clock import monotonic
+
+DEFAULT_SPEED_HZ        = 1000000 #MCP3008 is rated for 1.35MHz at 2.7V
+DEFAULT_SPI_MODE        = 0       #CPOL = 0, CPHA = 0
+DEFAULT_BITS_PER_WORD   = 8
+DEFAULT_MAX_BATCH_BYTES = 4096    #default 'bufsiz' parameter of the spidev driver
+
+# spidev ioctl definitions, see linux/spi/spidev.h
+_IOC_WRITE         = 1
+_IOC_NRBITS        = 8
+_IOC_TYPEBITS      = 8
+_IOC_SIZEBITS      = 14
+_IOC_TYPESHIFT     = _IOC_NRBITS
+_IOC_SIZESHIFT     = _IOC_TYPESHIFT + _IOC_TYPEBITS
+_IOC_DIRSHIFT      = _IOC_SIZESHIFT + _IOC_SIZEBITS
+
+def _IOW(type, nr, size):
+    return (_IOC_WRITE << _IOC_DIRSHIFT) | (size << _IOC_SIZESHIFT) | (type << _IOC_TYPESHIFT) | nr
+
+SPI_IOC_MAGIC = ord('k')
+
+class spi_ioc_transfer(Structure):
+    """ mirrors 'struct spi_ioc_transfer' describing a single segment of a
+        SPI_IOC_MESSAGE, buffers are passed by address
+    """
+    _fields_ = [("tx_buf"          , c_uint64),
+                ("rx_buf"          , c_uint64),
+                ("len"             , c_uint32),
+                ("speed_hz"        , c_uint32),
+                ("delay_usecs"     , c_uint16),
+                ("bits_per_word"   , c_uint8),
+                ("cs_change"       , c_uint8),
+                ("tx_nbits"        , c_uint8),
+                ("rx_nbits"        , c_uint8),
+                ("word_delay_usecs", c_uint8),
+                ("pad"             , c_uint8),
+               ]
+
+#the message size must fit in the ioctl request's size field
+SPI_MAX_TRANSFERS_PER_MESSAGE = ((1 << _IOC_SIZEBITS) - 1) // sizeof(spi_ioc_transfer)
+
+def SPI_IOC_MESSAGE(num):
+    return _IOW(SPI_IOC_MAGIC, 0, num*sizeof(spi_ioc_transfer))
+
+SPI_IOC_WR_MODE          = _IOW(SPI_IOC_MAGIC, 1, sizeof(c_uint8))
+SPI_IOC_WR_BITS_PER_WORD = _IOW(SPI_IOC_MAGIC, 3, sizeof(c_uint8))
+SPI_IOC_WR_MAX_SPEED_HZ  = _IOW(SPI_IOC_MAGIC, 4, sizeof(c_uint32))
+
+# bit value and mask of each binary place (in MSB order) for every byte value,
+# used by the software (bit-banged) driver
+BIT_MASKS = tuple(1 << i for i in range(7,-1,-1))
+BYTE_BITS = tuple(tuple((bool(byte & mask), mask) for mask in BIT_MASKS)
+                  for byte in range(256))
+
+#one lock per physical bus, shared by the drivers of all chips selected on it
+_bus_locks     = {}
+_bus_locks_mtx = threading.Lock()
+################################################################################
+def bus_lock(key):
+    """ get the re-entrant lock of the bus identified by 'key', e.g. 
+        ("spidev", "/dev/spidev0") or ("gpio", clockpin, mosipin, misopin)
+    """
+    with _bus_locks_mtx:
+        lock = _bus_locks.get(key)
+        if lock is None:
+            lock = _bus_locks[key] = threading.RLock()
+        return lock
+        
+def spidev_bus(path):
+    """ bus part of a spidev device 'path', i.e. "/dev/spidev0.1" -> "/dev/spidev0"
+    """
+    match = re.match(r"^(.*spidev\d+)\.\d+$", path)
+    if match is None:
+        return path
+    return match.group(1)
+
+################################################################################
+class SpiDevFile(object):
+    """ thin wrapper of a '/dev/spidevX.Y' character device, any object
+        providing the methods 'ioctl' and 'close' may be used in its place
+        (see 'sim.spidev.FakeSpiDevFile')
+    """
+    def __init__(self, path):
+        self.path = path
+        self._fd  = os.open(path, os.O_RDWR)
+        
+    def ioctl(self, request, arg):
+        """ 'arg' must be a mutable ctypes object, it is passed by address
+        """
+        return fcntl.ioctl(self._fd, request, arg, True)
+        
+    def close(self):
+        if not self._fd is None:
+            os.close(self._fd)
+            self._fd = None
 
 ################################################################################
 class CommSPI(object):
-    """ Provides hardware (TODO) or software (bit-banged) IO using SPI protocol
+    """ Provides hardware (spidev) or software (bit-banged) IO using SPI protocol
     """
-    def __init__(self, device = None):
-        self.transfer = None
+    def __init__(self, device = None, speed_hz = DEFAULT_SPEED_HZ):
+        self.transfer      = None
+        self.transfer_many = None
+        self.bus           = None
+        self.lock          = threading.RLock() #replaced by the bus lock on setup
+        self._dev          = None
         #by default setup the hardware SPI if device is specified
         if not device is None:
-            self.setup_hardware(device = device)
+            self.setup_hardware(device = device, speed_hz = speed_hz)
         
-    def setup_hardware(self, device):
+    def setup_hardware(self, device, 
+                       speed_hz        = DEFAULT_SPEED_HZ,
+                       mode            = DEFAULT_SPI_MODE,
+                       bits_per_word   = DEFAULT_BITS_PER_WORD,
+                       max_batch_bytes = DEFAULT_MAX_BATCH_BYTES,
+                      ):
         """ configure the driver for hardware communications at the port 
-            specified by 'device', i.e. "/dev/spidev0.0"
+            specified by 'device', i.e. "/dev/spidev0.0", or an already open
+            device object (see 'SpiDevFile');
+            'speed_hz' sets the clock rate, 'max_batch_bytes' limits the 
+            total bytes queued into a single kernel call and should not 
+            exceed the spidev driver's 'bufsiz' parameter;
+            chip selects of the same spidev bus (e.g. "/dev/spidev0.0" and
+            "/dev/spidev0.1") share the lock 'self.lock'
         """ 
-        self._device  = device
+        if isinstance(device, basestring):
+            dev = SpiDevFile(device)
+            self.bus = ("spidev", spidev_bus(device))
+        else:
+            dev = device
+            self.bus = ("spidev", id(device))
+        self.lock = bus_lock(self.bus)
+        dev.ioctl(SPI_IOC_WR_MODE         , c_uint8(mode))
+        dev.ioctl(SPI_IOC_WR_BITS_PER_WORD, c_uint8(bits_per_word))
+        dev.ioctl(SPI_IOC_WR_MAX_SPEED_HZ , c_uint32(speed_hz))
+        self._device          = device
+        self._dev             = dev
+        self._speed_hz        = speed_hz
+        self._bits_per_word   = bits_per_word
+        self._max_batch_bytes = max_batch_bytes
+        self._batch_cache     = {}
         #overload transfer with the right method
-        self.transfer = self._transfer_hardware
+        self.transfer      = self._transfer_hardware
+        self.transfer_many = self._transfer_many_hardware
     
-    def setup_software(self, clockpin, mosipin, misopin, cspin, pinmode):
+    def setup_software(self, clockpin, mosipin, misopin, cspin, pinmode, 
+                       native = None):
         """ setup the GPIO pins to perform software (bit-banged) communications;
             'pinmode' describes the pin mapping as GPIO.BOARD is fixed with respect
             to the RPi platform's spec.  whereas GPIO.BCM refers to the channels
-            for the Broadcom SoC which could change in future board revisions
+            for the Broadcom SoC which could change in future board revisions;
+            'native' selects the frame clocking engine:
+              None : use the native helper library (SPIBB) if it is available, 
+                     otherwise fall back to pure Python
+              True : require the native helper library
+              False: pure Python
+            chips sharing the clock, MOSI and MISO pins on separate 'cspin's
+            share the lock 'self.lock'
         """
+        GPIO = backend.get_gpio()
         # set up the SPI interface pins
         GPIO.setmode(pinmode)
         GPIO.setup(clockpin, GPIO.OUT)
         GPIO.setup(mosipin , GPIO.OUT)
         GPIO.setup(misopin , GPIO.IN )
-        GPIO.setup(cspin   , GPIO.OUT)
+        #deselected until the first transfer, other chips may share the bus
+        GPIO.setup(cspin   , GPIO.OUT, initial = GPIO.HIGH)
+        self.bus  = ("gpio", clockpin, mosipin, misopin)
+        self.lock = bus_lock(self.bus)
         #cache the pin settings
         self._clockpin = clockpin
         self._mosipin  = mosipin
         self._misopin  = misopin
         self._cspin    = cspin
+        #bind the pin operations once, rather than looking them up every bit
+        output = GPIO.output
+        self._pin_ops = (partial(output, cspin),
+                         partial(output, clockpin, True),
+                         partial(output, clockpin, False),
+                         partial(output, mosipin),
+                         partial(GPIO.input, misopin),
+                        )
+        self._native = None
+        if not native is False:
+            try:
+                from SPIBB import NativeSPI
+                #a simulated GPIO module can only be driven through callbacks
+                gpio = GPIO if getattr(GPIO, 'SIMULATED', False) else None
+                self._native = NativeSPI(clockpin, mosipin, misopin, cspin,
+                                         pinmode = "BCM" if pinmode == GPIO.BCM else "BOARD",
+                                         gpio    = gpio,
+                                        )
+            except (ImportError, OSError, RuntimeError):
+                if native:
+                    raise
         #overload transfer with the right method
-        self.transfer  = self._transfer_software
+        if self._native is None:
+            self.transfer  = self._transfer_software
+        else:
+            self.transfer  = self._native.transfer
+        self.transfer_many = self._transfer_many_software
         
-    def _transfer_hardware(self, bytes_out):
+    def close(self):
+        """ release the hardware device, if any
+        """
+        if not self._dev is None:
+            self._dev.close()
+            self._dev = None
+        
+    def _transfer_hardware(self, out_bytes):
         """transfer bytes using hardware SPI driver
         """ 
-        raise NotImplemented
+        return self._transfer_many_hardware([out_bytes])[0]
+        
+    def _transfer_many_hardware(self, frames):
+        """transfer a sequence of frames (each a separate chip select cycle)
+           using as few SPI_IOC_MESSAGE kernel calls as the batch limits allow
+        """
+        timed = metrics.ENABLED
+        if timed:
+            t1 = monotonic()
+        frames  = [bytearray(frame) for frame in frames]
+        results = []
+        max_num   = SPI_MAX_TRANSFERS_PER_MESSAGE
+        max_bytes = self._max_batch_bytes
+        start = 0
+        while start < len(frames):
+            #grow the batch until either limit is reached
+            stop   = start
+            nbytes = 0
+            while stop < len(frames) and stop - start < max_num:
+                if stop > start and nbytes + len(frames[stop]) > max_bytes:
+                    break
+                nbytes += len(frames[stop])
+                stop   += 1
+            results += self._submit_message(frames[start:stop])
+            start = stop
+        if timed:
+            metrics.record("spi.transfer_many", monotonic() - t1, items = len(frames))
+        return results
+        
+    def _get_message(self, lengths):
+        """ get (possibly cached) transfer buffers and segment descriptors
+            for a message with segments of 'lengths'
+        """
+        msg = self._batch_cache.get(lengths)
+        if msg is None:
+            num   = len(lengths)
+            total = sum(lengths)
+            tx_buf = (c_uint8*total)()
+            rx_buf = (c_uint8*total)()
+            xfers  = (spi_ioc_transfer*num)()
+            tx_addr = addressof(tx_buf)
+            rx_addr = addressof(rx_buf)
+            offset = 0
+            for xfer, length in zip(xfers, lengths):
+                xfer.tx_buf        = tx_addr + offset
+                xfer.rx_buf        = rx_addr + offset
+                xfer.len           = length
+                xfer.speed_hz      = self._speed_hz
+                xfer.bits_per_word = self._bits_per_word
+                #deselect between segments so each is a separate transaction
+                xfer.cs_change     = 1
+                offset += length
+            #leaving cs_change set on the final segment would hold CS active
+            xfers[num - 1].cs_change = 0
+            msg = (tx_buf, rx_buf, xfers)
+            self._batch_cache[lengths] = msg
+        return msg
+        
+    def _submit_message(self, frames):
+        lengths = tuple(len(frame) for frame in frames)
+        tx_buf, rx_buf, xfers = self._get_message(lengths)
+        data = str(bytearray().join(frames))
+        memmove(tx_buf, data, len(data))
+        timed = metrics.ENABLED
+        if timed:
+            t1 = monotonic()
+        self._dev.ioctl(SPI_IOC_MESSAGE(len(frames)), xfers)
+        if timed:
+            metrics.record("spi.ioctl", monotonic() - t1, items = len(frames))
+        inp_bytes = bytearray(rx_buf)
+        results = []
+        offset  = 0
+        for length in lengths:
+            results.append(inp_bytes[offset:offset + length])
+            offset += length
+        return results
         
     def _transfer_software(self, out_bytes):
         """transfer bytes using using bit-banged SPI 
            ref. git://gist.github.com/3151375.git
         """ 
+        cs_write, clock_high, clock_low, mosi_write, miso_read = self._pin_ops
+        byte_bits = BYTE_BITS
         #start transmission by toggling chip select low
-        GPIO.output(self._cspin, True)
-        GPIO.output(self._clockpin, False) #start clock low
-        GPIO.output(self._cspin, False)    #bring CS low
+        cs_write(True)
+        clock_low()                        #start clock low
+        cs_write(False)                    #bring CS low
         
         #perform transfer
         out_bytes = bytearray(out_bytes)   #convert strings or integer lists to one type
-        inp_bytes = bytearray()            #input buffer
-        for out_byte in out_bytes:
+        inp_bytes = bytearray(len(out_bytes)) #input buffer
+        mosi = None                        #unknown output line state
+        for index, out_byte in enumerate(out_bytes):
             inp_byte = 0
-            for i in range(7,-1,-1):       #binary places in MSB order
-                #send the output bit
-                if (2**i & out_byte) != 0:
-                    GPIO.output(self._mosipin, True)
-                else:
-                    GPIO.output(self._mosipin, False)
+            for bit, mask in byte_bits[out_byte]: #binary places in MSB order
+                #send the output bit, the line only changes on transitions
+                if bit != mosi:
+                    mosi_write(bit)
+                    mosi = bit
                 #tick the clock up - pushes output, latches input
-                GPIO.output(self._clockpin, True)
+                clock_high()
                 #read the input bit
-                if (GPIO.input(self._misopin)):
-                    inp_byte += 2**i
+                if miso_read():
+                    inp_byte |= mask
                 #tick the clock down - get ready for next cycle
-                GPIO.output(self._clockpin, False)
-	    #finished transfer of byte
-            inp_bytes.append(inp_byte)
+                clock_low()
+            #finished transfer of byte
+            inp_bytes[index] = inp_byte
             
         #finish transmission by toggling chip select     
-        GPIO.output(self._cspin, True)
+        cs_write(True)
         return inp_bytes
+        
+    def _transfer_many_software(self, frames):
+        """transfer a sequence of frames using bit-banged SPI
+        """
+        timed = metrics.ENABLED
+        if timed:
+            t1 = monotonic()
+        transfer = self.transfer
+        results  = [transfer(frame) for frame in frames]
+        if timed:
+            metrics.record("spi.transfer_many", monotonic() - t1, items = len(frames))
+        return results
  
 ################################################################################
 # TEST CODE
 ################################################################################
 if __name__ == "__main__":
-    pass
+    import random
+    
+    class RecordingSlave(object):
+        """ simulated SPI slave which records the MOSI bits latched on 
+            rising clock edges and shifts out the bits of 'reply' on MISO
+        """
+        def __init__(self, clockpin, mosipin, misopin, cspin):
+            self.pins   = (clockpin, mosipin, misopin, cspin)
+            self.levels = {clockpin: 0, mosipin: 0, cspin: 1}
+            self.reply  = bytearray()
+            self.wire   = []
+        def drive(self, pin, level):
+            clockpin, mosipin, misopin, cspin = self.pins
+            if pin == cspin and not level:
+                self.wire.append([])                    #new frame
+            if pin == clockpin and level and not self.levels[cspin]:
+                self.wire[-1].append(self.levels[mosipin]) #latch MOSI
+            self.levels[pin] = level
+        def sense(self, pin):
+            if self.levels[self.pins[3]]:
+                return None
+            index = len(self.wire[-1]) - 1
+            return int(bool(self.reply[index // 8] & BIT_MASKS[index % 8]))
+        def frames(self):
+            result = []
+            for bits in self.wire:
+                frame = bytearray()
+                for i in range(0, len(bits), 8):
+                    frame.append(sum(mask for bit, mask in zip(bits[i:i+8], BIT_MASKS) if bit))
+                result.append(frame)
+            return result
+            
+    backend.select("sim")
+    GPIO = backend.get_gpio()
+    pins = dict(clockpin = 18, misopin = 23, mosipin = 24, cspin = 25)
+    out_bytes = bytearray(range(256))
+    for native in (False, True):
+        GPIO.detach_all()
+        slave = RecordingSlave(**pins)
+        GPIO.attach(slave, listen = (18, 24, 25), drive = (23,))
+        spi = CommSPI()
+        try:
+            spi.setup_software(pinmode = GPIO.BCM, native = native, **pins)
+        except OSError:
+            print "native helper library not built, skipping (see SPIBB/Makefile)"
+            continue
+        slave.reply = bytearray(random.randint(0,255) for i in range(len(out_bytes)))
+        slave.wire  = []
+        inp_bytes = spi.transfer(out_bytes)
+        assert slave.frames() == [out_bytes]   #same bytes on the wire
+        assert inp_bytes == slave.reply
+        #multiple frames each get a chip select cycle
+        slave.wire  = []
+        slave.reply = bytearray((0x00, 0x03, 0xFF))
+        frames = [bytearray((0x01, 0x80 | (chan << 4), 0)) for chan in range(8)]
+        assert spi.transfer_many(frames) == [slave.reply]*8
+        assert slave.frames() == frames
+        print "%s engine: OK" % ("native" if native else "python")
+    #automatic selection always yields a working engine
+    spi = CommSPI()
+    spi.setup_software(pinmode = GPIO.BCM, **pins)
+    slave.reply = bytearray((0xA5,))
+    slave.wire  = []
+    assert spi.transfer((0x5A,)) == slave.reply and slave.frames() == [bytearray((0x5A,))]
+    print "all tests passed"
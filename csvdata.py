@@ -0,0 +1,160 @@
+""" Text (CSV) data file format written by 'adcsampler.py': each acquisition
+    session starts with a metadata header block
+        #<METADATA>
+        #key = repr(value)
+        ...
+        #</METADATA>
+    followed by a commented line of column labels and the delimited records.
+    A session may end with a '#<RUNSTATS>' trailer block of the same form.
+    Appending to a file adds another session.
+"""
+################################################################################
+import os, ast, gzip, bz2
+from collections import OrderedDict
+import numpy as np
+
+DEFAULT_DELIMITER = ","
+DEFAULT_NEWLINE   = "\n"
+DEFAULT_PRECISION = 6  #decimal places of the values written to file
+TIME_PRECISION    = 6  #decimal places of the timestamps written to file
+TIME_COLUMNS      = ("t_samp", "t_err")
+
+METADATA_BEGIN = "#<METADATA>"
+METADATA_END   = "#</METADATA>"
+RUNSTATS_BEGIN = "#<RUNSTATS>"
+RUNSTATS_END   = "#</RUNSTATS>"
+
+#labels of the columns with units, as they appear in the file
+COLUMN_LABELS = {'t_samp': "t_samp (s)",
+                 't_err' : "t_err(s)",
+                }
+################################################################################
+def column_label(name):
+    return COLUMN_LABELS.get(name, name)
+    
+def column_name(label):
+    """ the column name for a 'label' of the column header line
+    """
+    label = label.strip().lstrip("#").strip()
+    for name, lbl in COLUMN_LABELS.items():
+        if label == lbl:
+            return name
+    return label
+    
+def format_metadata(metadata, newline = DEFAULT_NEWLINE, 
+                    begin = METADATA_BEGIN, end = METADATA_END):
+    """ format the metadata header block
+    """
+    lines = [begin]
+    for key, val in metadata.items():
+        lines.append("#%s = %r" % (key,val))
+    lines.append(end)
+    return newline.join(lines) + newline
+    
+def parse_metadata_line(line):
+    """ parse a '#key = repr(value)' line into (key, value)
+    """
+    key, val = line.strip().lstrip("#").split("=", 1)
+    return key.strip(), ast.literal_eval(val.strip())
+
+################################################################################
+class CSVWriter(object):
+    """ writes sessions of records to the open 'output_file'
+    """
+    def __init__(self, output_file,
+                 delimiter = DEFAULT_DELIMITER,
+                 newline   = DEFAULT_NEWLINE,
+                 precision = DEFAULT_PRECISION,
+                ):
+        self.output_file = output_file
+        self.delimiter   = delimiter
+        self.newline     = newline
+        self.precision   = precision
+        self.columns     = None
+        self._record_format = None
+        
+    def write_header(self, metadata, columns):
+        self.columns = list(columns)
+        self.output_file.write(format_metadata(metadata, newline = self.newline))
+        #column descriptor
+        line = [column_label(name) for name in self.columns]
+        line[0] = "#" + line[0]
+        self.output_file.write(self.delimiter.join(line))
+        self.output_file.write(self.newline)
+        self.output_file.flush()
+        #format for a whole record (line) of the file
+        fmts = []
+        for name in self.columns:
+            if name in TIME_COLUMNS:
+                fmts.append("%%.%df" % TIME_PRECISION)
+            else:
+                fmts.append("%%.%df" % self.precision)
+        self._record_format = self.delimiter.join(fmts) + self.newline
+        
+    def write_records(self, block):
+        """ write the rows of the 2D array 'block', formatting them at once
+        """
+        n = len(block)
+        if n > 0:
+            self.output_file.write((self._record_format*n) % tuple(np.ravel(block).tolist()))
+        
+    def write_trailer(self, stats):
+        """ write the run statistics after the session's records
+        """
+        self.output_file.write(format_metadata(stats, newline = self.newline,
+                                               begin = RUNSTATS_BEGIN, end = RUNSTATS_END))
+        
+    def flush(self):
+        self.output_file.flush()
+        
+    def fsync(self):
+        """ flush and force the written records to the storage device
+        """
+        self.output_file.flush()
+        os.fsync(self.output_file.fileno())
+        
+    def close(self):
+        self.output_file.close()
+
+################################################################################
+def read_csv(input_file, delimiter = DEFAULT_DELIMITER):
+    """ read all sessions of a CSV data file (path or open file) into a list 
+        of (metadata, columns, records) where 'records' is a 2D array; paths
+        ending with ".gz" or ".bz2" are decompressed (see 'rotating.py')
+    """
+    if isinstance(input_file, basestring):
+        if input_file.endswith(".gz"):
+            input_file = gzip.open(input_file)
+        elif input_file.endswith(".bz2"):
+            input_file = bz2.BZ2File(input_file)
+        else:
+            input_file = open(input_file)
+    sessions = []
+    metadata = None
+    columns  = None
+    rows     = []
+    in_header = False
+    def end_session():
+        if not columns is None:
+            records = np.array(rows, dtype = float).reshape((len(rows), len(columns)))
+            sessions.append((metadata, columns, records))
+    for line in input_file:
+        line = line.strip()
+        if not line:
+            continue
+        if line == METADATA_BEGIN:
+            end_session()
+            metadata, columns, rows = OrderedDict(), None, []
+            in_header = True
+        elif line == METADATA_END:
+            in_header = False
+        elif line.startswith("#"):
+            if in_header:
+                key, val = parse_metadata_line(line)
+                metadata[key] = val
+            elif columns is None and not metadata is None:
+                columns = [column_name(label) for label in line.split(delimiter)]
+        elif not columns is None:
+            rows.append([float(val) for val in line.split(delimiter)])
+    end_session()
+    return sessions
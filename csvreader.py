@@ -0,0 +1,288 @@
+""" Streaming reader for the CSV data files written by 'adcsampler.py' (see
+    'csvdata.py').  A file may hold several acquisition sessions; they are 
+    found by a single pass over the file, and their byte offsets and time 
+    ranges, together with periodic checkpoints of (time, offset), are kept 
+    in a small JSON sidecar index "<file>.idx".  The index is extended 
+    incrementally when the file grows, so that listing the sessions or 
+    seeking to a time window does not rescan the whole file.
+    
+    Usage:
+        reader = CSVReader("data.csv")
+        for session in reader.sessions:
+            for chunk in reader.iter_chunks(session):
+                ...  #2D array of up to 'chunk_size' records
+        for session, chunk in reader.query(t_start, t_end):
+            ...      #records with absolute times in [t_start, t_end]
+"""
+################################################################################
+import os, json
+from collections import OrderedDict
+import numpy as np
+
+from csvdata import METADATA_BEGIN, METADATA_END, RUNSTATS_BEGIN, RUNSTATS_END,\
+                    DEFAULT_DELIMITER, parse_metadata_line, column_name
+
+INDEX_SUFFIX         = ".idx"
+INDEX_VERSION        = 2
+DEFAULT_CHUNK_SIZE   = 10000 #records
+DEFAULT_INDEX_STRIDE = 1000  #records between checkpoints
+################################################################################
+class Session(object):
+    """ location and extent of an acquisition session within the file;
+        times are absolute (seconds since the epoch), i.e. the session's 
+        'start_timestamp' plus the recorded 't_samp'
+    """
+    def __init__(self, header_offset):
+        self.header_offset = header_offset
+        self.data_offset   = None
+        self.end_offset    = None
+        self.metadata      = OrderedDict()
+        self.columns       = None
+        self.num_records   = 0
+        self.t_first       = None
+        self.t_last        = None
+        self.checkpoints   = [] #(time, byte offset) every 'stride' records
+        self.stats         = None #run statistics from the trailer, if any
+        
+    @property
+    def t0(self):
+        return self.metadata.get('start_timestamp', 0.0)
+        
+    def overlaps(self, t_start = None, t_end = None):
+        if self.t_first is None:
+            return False
+        if not t_start is None and self.t_last < t_start:
+            return False
+        if not t_end is None and self.t_first > t_end:
+            return False
+        return True
+        
+    def to_dict(self):
+        return OrderedDict(self.__dict__)
+        
+    @classmethod
+    def from_dict(cls, d):
+        session = cls(d['header_offset'])
+        session.__dict__.update(d)
+        session.checkpoints = [tuple(cp) for cp in session.checkpoints]
+        return session
+        
+    def __repr__(self):
+        return "Session(offset=%d, columns=%r, num_records=%d, t_first=%r, t_last=%r)" % \
+               (self.header_offset, self.columns, self.num_records, self.t_first, self.t_last)
+
+################################################################################
+class CSVReader(object):
+    """ 'path' is the CSV data file; if 'use_index' is set, the sidecar index
+        is loaded, brought up to date with the file and saved
+    """
+    def __init__(self, path, 
+                 delimiter = DEFAULT_DELIMITER,
+                 use_index = True,
+                 stride    = DEFAULT_INDEX_STRIDE,
+                ):
+        self.path       = path
+        self.index_path = path + INDEX_SUFFIX
+        self.delimiter  = delimiter
+        self.use_index  = use_index
+        self.stride     = stride
+        self.sessions   = []
+        self._size      = 0  #bytes of the file covered by 'sessions'
+        self.refresh()
+        
+    def refresh(self):
+        """ bring the session list up to date with the file
+        """
+        if self.use_index and not self._size:
+            self._load_index()
+        size = os.path.getsize(self.path)
+        if size < self._size or not self._index_is_valid():
+            #the file was truncated or rewritten
+            self.sessions = []
+            self._size    = 0
+        if size > self._size:
+            self._scan()
+            if self.use_index:
+                self._save_index()
+        return self.sessions
+        
+    def iter_chunks(self, session, chunk_size = DEFAULT_CHUNK_SIZE, offset = None):
+        """ lazily yield the records of 'session' as 2D arrays of up to 
+            'chunk_size' rows, starting at byte 'offset' (default the 
+            beginning of the data)
+        """
+        if offset is None:
+            offset = session.data_offset
+        if session.columns is None:
+            return
+        num_cols  = len(session.columns)
+        delimiter = self.delimiter
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            remaining = session.end_offset - offset
+            lines = []
+            while remaining > 0:
+                line = f.readline()
+                remaining -= len(line)
+                if not line.endswith("\n"):
+                    break
+                if line.startswith("#") or not line.strip():
+                    continue
+                lines.append(line)
+                if len(lines) == chunk_size:
+                    yield self._parse(lines, num_cols)
+                    lines = []
+            if lines:
+                yield self._parse(lines, num_cols)
+                
+    def iter_sessions(self, chunk_size = DEFAULT_CHUNK_SIZE):
+        """ lazily yield (session, chunks) where 'chunks' is an iterator of 
+            the session's records
+        """
+        for session in self.sessions:
+            yield session, self.iter_chunks(session, chunk_size = chunk_size)
+            
+    def query(self, t_start = None, t_end = None, chunk_size = DEFAULT_CHUNK_SIZE):
+        """ yield (session, chunk) for the records with absolute times in 
+            [t_start, t_end], seeking to the nearest checkpoint before
+            't_start' within each overlapping session
+        """
+        for session in self.sessions:
+            if not session.overlaps(t_start, t_end):
+                continue
+            offset = session.data_offset
+            if not t_start is None:
+                for t, cp_offset in session.checkpoints:
+                    if t > t_start:
+                        break
+                    offset = cp_offset
+            for chunk in self.iter_chunks(session, chunk_size = chunk_size, offset = offset):
+                t_abs = session.t0 + chunk[:,0]
+                mask = np.ones(len(chunk), dtype = bool)
+                if not t_start is None:
+                    mask &= t_abs >= t_start
+                if not t_end is None:
+                    mask &= t_abs <= t_end
+                if mask.any():
+                    yield session, chunk[mask]
+                if not t_end is None and t_abs[-1] > t_end:
+                    break
+                    
+    def _parse(self, lines, num_cols):
+        text = "".join(lines).replace("\r", "").replace("\n", self.delimiter)
+        data = np.fromstring(text, sep = self.delimiter)
+        return data.reshape((-1, num_cols))
+        
+    def _scan(self):
+        """ read the file from the end of the indexed part, continuing the 
+            last session
+        """
+        current = self.sessions[-1] if self.sessions else None
+        in_header  = False
+        in_trailer = False
+        delimiter = self.delimiter
+        stride    = self.stride
+        offset    = self._size
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            while True:
+                line = f.readline()
+                if not line.endswith("\n"):
+                    break #end of file or a partially written line
+                line_offset = offset
+                offset += len(line)
+                text = line.strip()
+                if text == METADATA_BEGIN:
+                    current = Session(line_offset)
+                    self.sessions.append(current)
+                    in_header = True
+                elif current is None:
+                    continue
+                elif in_header:
+                    if text == METADATA_END:
+                        in_header = False
+                    elif text.startswith("#"):
+                        key, val = parse_metadata_line(text)
+                        current.metadata[key] = val
+                elif current.columns is None:
+                    if text.startswith("#"):
+                        current.columns = [column_name(label) for label in text.split(delimiter)]
+                        current.data_offset = offset
+                elif text == RUNSTATS_BEGIN:
+                    current.stats = OrderedDict()
+                    in_trailer = True
+                elif in_trailer:
+                    if text == RUNSTATS_END:
+                        in_trailer = False
+                    elif text.startswith("#"):
+                        key, val = parse_metadata_line(text)
+                        current.stats[key] = val
+                elif text and not text.startswith("#"):
+                    t = current.t0 + float(text.split(delimiter, 1)[0])
+                    if current.num_records % stride == 0:
+                        current.checkpoints.append((t, line_offset))
+                    if current.t_first is None:
+                        current.t_first = t
+                    current.t_last = t
+                    current.num_records += 1
+                if not current.data_offset is None:
+                    current.end_offset = offset
+                self._size = offset
+                
+    def _index_is_valid(self):
+        """ check that the indexed sessions still begin where recorded
+        """
+        if not self.sessions:
+            return True
+        with open(self.path, 'rb') as f:
+            for session in (self.sessions[0], self.sessions[-1]):
+                f.seek(session.header_offset)
+                if f.readline().strip() != METADATA_BEGIN:
+                    return False
+        return True
+        
+    def _load_index(self):
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f, object_pairs_hook = OrderedDict)
+        except (IOError, ValueError):
+            return
+        if index.get('version') != INDEX_VERSION or index.get('stride') != self.stride:
+            return
+        self.sessions = [Session.from_dict(d) for d in index['sessions']]
+        self._size    = index['size']
+        
+    def _save_index(self):
+        index = OrderedDict()
+        index['version']  = INDEX_VERSION
+        index['stride']   = self.stride
+        index['size']     = self._size
+        index['sessions'] = [session.to_dict() for session in self.sessions]
+        tmp_path = self.index_path + ".tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f)
+            os.rename(tmp_path, self.index_path) #replace atomically
+        except (IOError, OSError):
+            pass #e.g. a read-only directory, the index is only an optimization
+
+################################################################################
+# MAIN
+################################################################################
+if __name__ == "__main__":
+    import argparse, time
+    parser = argparse.ArgumentParser(description = "list the sessions of an adcsampler CSV data file")
+    parser.add_argument("input_file",
+                        help = "CSV data file",
+                       )
+    parser.add_argument("--no_index", 
+                        help = "do not use or update the sidecar index",
+                        action = "store_true",
+                        default = False,
+                       )
+    args = parser.parse_args()
+    reader = CSVReader(args.input_file, use_index = not args.no_index)
+    for i, session in enumerate(reader.sessions):
+        print "session %d: %d records, channels = %r" % (i, session.num_records, session.metadata.get('channels'))
+        if session.num_records:
+            print "\tfrom %s to %s" % (time.ctime(session.t_first), time.ctime(session.t_last))
@@ -0,0 +1,328 @@
+""" Change-based recording: most channels sit flat for hours, so instead of
+    every record only the significant changes are passed on, such that each
+    channel can be reconstructed from them within a stated tolerance.
+
+    Methods, per channel with the tolerance E = 'tolerance' + 'rel_tolerance'
+    times the magnitude of the last passed value:
+        "threshold"     - a record is passed when a channel moved more than
+                          E from its last passed value, reconstructed by
+                          holding the last value ('reconstruct' with "hold")
+        "swinging_door" - a record is passed when no straight line from the
+                          last passed record stays within E of every record
+                          since, reconstructed by linear interpolation; this
+                          also compresses slow ramps, at the cost of passing
+                          each record one record late
+    A record is passed when any one of the channels needs it (the others
+    ride along), and at least every 'heartbeat' seconds, so a silent output
+    still shows the acquisition is alive.  The first and last records of a
+    session are always passed.
+"""
+################################################################################
+from collections import OrderedDict
+import numpy as np
+
+METHODS           = ("threshold", "swinging_door")
+DEFAULT_METHOD    = "swinging_door"
+DEFAULT_HEARTBEAT = 900.0 #seconds
+################################################################################
+def reconstruct(t, t_passed, values_passed, method = DEFAULT_METHOD):
+    """ values at the times 't' of a channel passed at 't_passed' with
+        'values_passed' by the 'method'
+    """
+    t = np.asarray(t, dtype = float)
+    if method == "swinging_door":
+        return np.interp(t, t_passed, values_passed)
+    index = np.searchsorted(t_passed, t, side = 'right') - 1
+    return np.asarray(values_passed)[np.maximum(index, 0)]
+
+################################################################################
+class Threshold(object):
+    """ decides whether the vector of 'values' at time 't' differs from the
+        last significant one by more than the tolerance (a scalar or one per
+        value) or 'heartbeat' seconds have passed since
+    """
+    def __init__(self, tolerance,
+                 rel_tolerance = 0.0,
+                 heartbeat     = DEFAULT_HEARTBEAT,
+                ):
+        self.tolerance     = np.asarray(tolerance, dtype = float)
+        self.rel_tolerance = rel_tolerance
+        self.heartbeat     = heartbeat
+        self.reset()
+
+    def reset(self):
+        self._t_ref = None
+        self._ref   = None
+
+    def significant(self, t, values):
+        """ True if the 'values' are significant, they then become the
+            reference of the next ones
+        """
+        values = np.asarray(values, dtype = float)
+        if self._ref is None or _changed(values, self._ref, self._limit()) or \
+           (not self.heartbeat is None and t - self._t_ref >= self.heartbeat):
+            self._t_ref = t
+            self._ref   = values.copy()
+            return True
+        return False
+
+    def _limit(self):
+        return self.tolerance + self.rel_tolerance*np.abs(self._ref)
+
+def _changed(values, ref, limit):
+    """ a value moved beyond the limit, or became or stopped being NaN
+    """
+    with np.errstate(invalid = 'ignore'):
+        if (np.abs(values - ref) > limit).any():
+            return True
+    return (np.isnan(values) != np.isnan(ref)).any()
+
+################################################################################
+class DeadbandWriter(object):
+    """ wraps the 'writer' (or a 'sinks.FanOut') passing on only the
+        significant records of the 'columns' (by default the "chan..."
+        values, not their errors); 'tolerance' is a scalar or a mapping of
+        column names to tolerances
+    """
+    def __init__(self, writer, tolerance,
+                 rel_tolerance = 0.0,
+                 method        = DEFAULT_METHOD,
+                 heartbeat     = DEFAULT_HEARTBEAT,
+                 columns       = None,
+                ):
+        if not method in METHODS:
+            raise ValueError, "'method' must be in %r" % (METHODS,)
+        self.writer        = writer
+        self.tolerance     = tolerance
+        self.rel_tolerance = rel_tolerance
+        self.method        = method
+        self.heartbeat     = heartbeat
+        self.filter_columns = columns
+        self.columns       = None
+        #counters
+        self.records_in  = 0
+        self.records_out = 0
+        self._prev = None
+
+    @property
+    def depth(self):
+        return getattr(self.writer, 'depth', 0)
+
+    def write_header(self, metadata, columns):
+        self._finish()
+        self.columns = list(columns)
+        names = self.filter_columns
+        if names is None:
+            names = [name for name in self.columns if name.startswith("chan") and not name.endswith("_err")]
+        tolerances = OrderedDict()
+        for name in names:
+            if isinstance(self.tolerance, dict):
+                tolerances[name] = float(self.tolerance.get(name, 0.0))
+            else:
+                tolerances[name] = float(self.tolerance)
+        self._indices = [self.columns.index(name) for name in tolerances]
+        self._tol     = np.array(tolerances.values())
+        metadata = OrderedDict(metadata)
+        metadata['deadband_method']        = self.method
+        metadata['deadband_tolerance']     = dict(tolerances)
+        metadata['deadband_rel_tolerance'] = self.rel_tolerance
+        metadata['deadband_heartbeat']     = self.heartbeat
+        self.writer.write_header(metadata, self.columns)
+        self._anchor = None #last passed record
+        self._prev   = None #last record, not yet passed
+
+    def write_records(self, block):
+        n = len(block)
+        if n == 0:
+            return
+        self.records_in += n
+        if self.method == "swinging_door":
+            passed = self._swinging_door(block)
+        else:
+            passed = self._threshold(block)
+        if passed:
+            passed = np.array(passed)
+            self.records_out += len(passed)
+            self.writer.write_records(passed)
+
+    def write_trailer(self, stats):
+        self._finish()
+        self.writer.write_trailer(stats)
+
+    def flush(self):
+        self.writer.flush()
+
+    def drain(self):
+        """ pass the pending last record, then wait for the writer
+        """
+        self._finish()
+        if hasattr(self.writer, 'drain'):
+            self.writer.drain()
+
+    def stats(self):
+        result = OrderedDict()
+        result['deadband_records_in']  = self.records_in
+        result['deadband_records_out'] = self.records_out
+        if hasattr(self.writer, 'stats'):
+            result.update(self.writer.stats())
+        return result
+
+    def close(self):
+        self._finish()
+        self.writer.close()
+
+    #---------------------------------------------------------------------------
+    def _finish(self):
+        """ pass the last record of the session, if it is pending
+        """
+        if not self._prev is None:
+            self.records_out += 1
+            self.writer.write_records(self._prev[np.newaxis])
+            self._prev = None
+
+    def _pass(self, row, passed):
+        """ make the 'row' the new anchor
+        """
+        self._anchor = row
+        self._limit  = self._tol + self.rel_tolerance*np.abs(row[self._indices])
+        self._lower  = np.full(len(self._indices), -np.inf) #slopes allowed from the anchor
+        self._upper  = np.full(len(self._indices),  np.inf)
+        self._prev   = None
+        passed.append(row)
+
+    def _threshold(self, block):
+        passed = []
+        indices = self._indices
+        for row in block:
+            if self._anchor is None or _changed(row[indices], self._anchor[indices], self._limit) or \
+               (not self.heartbeat is None and row[0] - self._anchor[0] >= self.heartbeat):
+                self._pass(row.copy(), passed)
+            else:
+                self._prev = row.copy()
+        return passed
+
+    def _swinging_door(self, block):
+        """ the slopes from the anchor to the records since are narrowed
+            to those keeping every one of them within the tolerance, the
+            previous record is passed as soon as a record's slope falls
+            outside, i.e. no line to it would fit the records in between
+        """
+        passed = []
+        indices = self._indices
+        for row in block:
+            row = row.copy()
+            if self._anchor is None:
+                self._pass(row, passed)
+                continue
+            values = row[indices]
+            anchor = self._anchor[indices]
+            dt = row[0] - self._anchor[0]
+            if dt <= 0 or (np.isnan(values) != np.isnan(anchor)).any():
+                #not a line, start over from this record
+                if not self._prev is None:
+                    passed.append(self._prev)
+                self._pass(row, passed)
+                continue
+            with np.errstate(invalid = 'ignore'):
+                slopes = (values - anchor)/dt
+                fits = not ((slopes < self._lower) | (slopes > self._upper)).any()
+            if not fits:
+                #the previous record fits by construction, it becomes the anchor
+                prev = self._prev
+                self._pass(prev, passed)
+                anchor = prev[indices]
+                dt = row[0] - prev[0]
+            if not self.heartbeat is None and row[0] - self._anchor[0] >= self.heartbeat:
+                self._pass(row, passed)
+                continue
+            #narrow the door by this record's tolerance band (NaN are ignored)
+            self._lower = np.fmax(self._lower, (values - self._limit - anchor)/dt)
+            self._upper = np.fmin(self._upper, (values + self._limit - anchor)/dt)
+            self._prev  = row
+        return passed
+
+################################################################################
+# TEST CODE
+################################################################################
+if __name__ == "__main__":
+    import time
+
+    class ListWriter(object):
+        def write_header(self, metadata, columns):
+            self.metadata = metadata
+            self.columns  = columns
+            self.blocks   = []
+        def write_records(self, block):
+            self.blocks.append(np.array(block))
+        def write_trailer(self, stats):
+            self.trailer = stats
+        def flush(self):
+            pass
+        def close(self):
+            pass
+        def records(self):
+            return np.concatenate(self.blocks)
+
+    #a day at 1 Hz of two mostly flat channels, steps, a ramp and noise
+    rng = np.random.RandomState(0)
+    n = 86400
+    t = np.arange(n, dtype = float)
+    chan0 = 1.0 + 0.002*rng.randn(n)
+    chan0[30000:] += 0.5
+    chan1 = np.clip((t - 50000)/20000.0, 0.0, 1.0) + 0.002*rng.randn(n)
+    chan1[70000:70005] = np.nan
+    records = np.column_stack((t, np.full(n, 1e-4), chan0, chan1, np.full(n, 0.001)))
+    columns = ["t_samp", "t_err", "chan0", "chan1", "chan1_err"]
+    tolerance = 0.01
+    for method in METHODS:
+        writer = ListWriter()
+        deadband = DeadbandWriter(writer, tolerance = tolerance, method = method, heartbeat = 3600.0)
+        deadband.write_header(OrderedDict([('start_timestamp', 0.0)]), columns)
+        t1 = time.time()
+        for i in range(0, n, 60):
+            deadband.write_records(records[i:i+60])
+        t2 = time.time()
+        deadband.drain() #as 'adcsampler.Application.close' does
+        deadband.write_trailer(deadband.stats())
+        passed = writer.records()
+        stats = writer.trailer
+        print "%s: passed %d of %d records in %0.2f s" % (method, len(passed), n, t2 - t1)
+        assert stats['deadband_records_in'] == n and stats['deadband_records_out'] == len(passed)
+        assert writer.metadata['deadband_tolerance'] == OrderedDict([("chan0", 0.01), ("chan1", 0.01)])
+        assert len(passed) < n//100
+        #the passed records are unchanged records, the first and last included
+        assert (np.diff(passed[:,0]) > 0).all() and passed[0,0] == 0 and passed[-1,0] == n - 1
+        assert np.allclose(passed, records[passed[:,0].astype(int)], equal_nan = True)
+        #the heartbeat
+        assert np.diff(passed[:,0]).max() <= 3600
+        #every channel is reconstructed within the tolerance
+        for index in (2, 3):
+            ok = ~np.isnan(records[:,index])
+            values = reconstruct(t[ok], passed[:,0], passed[:,index], method = method)
+            error  = np.abs(values - records[ok,index])
+            assert np.nanmax(error) <= tolerance + 1e-12, (method, index, np.nanmax(error))
+    #a ramp is what the swinging door saves, its ends are enough
+    ramp = np.column_stack((t[:1000], 0.001*t[:1000]))
+    for method, num in (("threshold", 99), ("swinging_door", 2)):
+        writer = ListWriter()
+        deadband = DeadbandWriter(writer, tolerance = 0.01, method = method, heartbeat = None)
+        deadband.write_header(OrderedDict(), ["t_samp", "chan0"])
+        deadband.write_records(ramp)
+        deadband.close()
+        assert len(writer.records()) == num, (method, len(writer.records()))
+    #per-column tolerances, relative tolerance
+    writer = ListWriter()
+    deadband = DeadbandWriter(writer, tolerance = {"chan0": 0.1}, rel_tolerance = 0.01, method = "threshold")
+    deadband.write_header(OrderedDict(), columns)
+    deadband.write_records(records)
+    deadband.close()
+    assert writer.metadata['deadband_tolerance'] == OrderedDict([("chan0", 0.1), ("chan1", 0.0)])
+    #the threshold of uploads
+    threshold = Threshold([0.1, 0.5], heartbeat = 60.0)
+    assert threshold.significant(0.0, [20.0, 50.0])
+    assert not threshold.significant(10.0, [20.05, 50.4])
+    assert threshold.significant(20.0, [20.15, 50.4])
+    assert not threshold.significant(30.0, [20.2, 50.0])
+    assert threshold.significant(80.0, [20.2, 50.0])
+    assert threshold.significant(90.0, [20.2, np.nan])
+    print "all tests passed"
@@ -0,0 +1,334 @@
+""" Crash-safe buffering of records: 'JournaledWriter' appends every block
+    of records to a fixed-size ring journal memory-mapped from a file (no
+    system call per block) and commits them to the real writer in large
+    batches, every 'commit_records' records or 'commit_interval' seconds.
+    Records which were journaled but not committed when the program died
+    are recovered into the output, as a session of their own marked
+    'recovered', the next time a journal is opened at the same path.
+
+    Journal file layout (little endian):
+        prelude  - magic, number of columns, length of the header text,
+                   capacity (records), committed and written sequence
+                   numbers (records since the journal was created)
+        header   - the session's metadata block and column names as text
+                   (see 'csvdata.format_metadata'), padded to HEADER_SIZE
+        ring     - 'capacity' records of float64, record 'seq' in slot
+                   seq % capacity
+    The written counter is only advanced after the records are copied in,
+    and the committed counter only after the writer has them (and has
+    synced them, depending on the policy).
+
+    A crash of the program loses nothing that was written to the journal,
+    whose pages stay in the OS page cache (the acquisition writes them every
+    buffer, so at most one buffer of samples is lost).  A power cut loses
+    what was not synced, by the 'fsync' policy:
+        "none"     - no explicit syncs, up to the OS writeback delay is lost
+        "batch"    - the output and then the journal are synced on every
+                     commit, the records since the last commit are lost
+        "interval" - the journal and the output are synced every
+                     'fsync_interval' seconds
+    Syncs are never made per record, as they would cost a write to the card
+    each.
+"""
+################################################################################
+import os, mmap, struct
+from collections import OrderedDict
+import numpy as np
+
+from clock import monotonic
+from csvdata import format_metadata, parse_metadata_line, METADATA_BEGIN, METADATA_END
+
+MAGIC       = "OLMRING1"
+PRELUDE     = struct.Struct("<8sIIQQQ") #magic, num_columns, header_len, capacity, committed, written
+COMMITTED_OFFSET = 24
+WRITTEN_OFFSET   = 32
+HEADER_SIZE = 64*1024   #bytes reserved for the prelude and header text
+NEWLINE     = "\n"
+
+FSYNC_POLICIES          = ("none", "batch", "interval")
+DEFAULT_FSYNC           = "batch"
+DEFAULT_CAPACITY        = 65536 #records
+DEFAULT_COMMIT_INTERVAL = 60.0  #seconds
+DEFAULT_FSYNC_INTERVAL  = 10.0  #seconds
+################################################################################
+def format_journal_header(metadata, columns):
+    lines = [format_metadata(metadata, newline = NEWLINE)]
+    for name in columns:
+        lines.append("#%s%s" % (name, NEWLINE))
+    return "".join(lines)
+
+def parse_journal_header(text):
+    metadata = OrderedDict()
+    columns  = []
+    in_header = False
+    for line in text.splitlines():
+        if line == METADATA_BEGIN:
+            in_header = True
+        elif line == METADATA_END:
+            in_header = False
+        elif in_header:
+            key, val = parse_metadata_line(line)
+            metadata[key] = val
+        elif line.startswith("#"):
+            columns.append(line[1:])
+    return metadata, columns
+
+def read_journal(path):
+    """ get the uncommitted session of the journal at 'path' as
+        (metadata, columns, records), or None if there is nothing to recover
+    """
+    if not os.path.isfile(path) or os.path.getsize(path) < HEADER_SIZE:
+        return None
+    with open(path, 'rb') as f:
+        prelude = f.read(PRELUDE.size)
+        magic, num_columns, header_len, capacity, committed, written = PRELUDE.unpack(prelude)
+        if magic != MAGIC or num_columns == 0 or written <= committed:
+            return None
+        metadata, columns = parse_journal_header(f.read(header_len))
+        #the ring may have been overwritten beyond its capacity
+        first = max(committed, written - capacity)
+        ring = np.memmap(f, dtype = np.float64, mode = 'r', offset = HEADER_SIZE,
+                         shape = (capacity, num_columns))
+        slots = np.arange(first, written) % capacity
+        records = np.array(ring[slots])
+        del ring
+    return metadata, columns, records
+
+################################################################################
+class JournaledWriter(object):
+    """ wraps the 'writer' (see 'csvdata.CSVWriter', 'bindata.BinaryWriter')
+        with a ring journal at 'path' of 'capacity' records; the writer must
+        be used from a single thread
+    """
+    def __init__(self, writer, path,
+                 capacity        = DEFAULT_CAPACITY,
+                 commit_records  = None,
+                 commit_interval = DEFAULT_COMMIT_INTERVAL,
+                 fsync           = DEFAULT_FSYNC,
+                 fsync_interval  = DEFAULT_FSYNC_INTERVAL,
+                ):
+        assert capacity > 0
+        if not fsync in FSYNC_POLICIES:
+            raise ValueError, "'fsync' must be in %r" % (FSYNC_POLICIES,)
+        self.writer          = writer
+        self.path            = path
+        self.capacity        = int(capacity)
+        self.commit_records  = self.capacity//2 if commit_records is None else min(commit_records, self.capacity)
+        self.commit_interval = commit_interval
+        self.fsync           = fsync
+        self.fsync_interval  = fsync_interval
+        self.columns         = None
+        #counters
+        self.commits           = 0
+        self.records_recovered = 0
+        self._mmap    = None
+        self._file    = None
+        self.recover()
+
+    def recover(self):
+        """ commit the records left in the journal by a previous run
+        """
+        session = read_journal(self.path)
+        if session is None:
+            return 0
+        metadata, columns, records = session
+        metadata['recovered'] = True
+        self.writer.write_header(metadata, columns)
+        self.writer.write_records(records)
+        self.writer.flush()
+        self._sync_writer()
+        os.remove(self.path)
+        self.records_recovered += len(records)
+        return len(records)
+
+    def write_header(self, metadata, columns):
+        """ commit the current session, then restart the journal with the
+            new session's header
+        """
+        self._commit()
+        self.writer.write_header(metadata, columns)
+        self.columns = list(columns)
+        text = format_journal_header(metadata, self.columns)
+        if PRELUDE.size + len(text) > HEADER_SIZE:
+            raise ValueError, "the metadata does not fit in the journal header"
+        self._unmap()
+        size = HEADER_SIZE + self.capacity*len(self.columns)*8
+        self._file = open(self.path, 'w+b')
+        self._file.truncate(size)
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+        self._mmap[PRELUDE.size:PRELUDE.size + len(text)] = text
+        self._mmap[:PRELUDE.size] = PRELUDE.pack(MAGIC, len(self.columns), len(text),
+                                                 self.capacity, 0, 0)
+        self._ring = np.ndarray(shape = (self.capacity, len(self.columns)), dtype = np.float64,
+                                buffer = self._mmap, offset = HEADER_SIZE)
+        self._committed = 0
+        self._written   = 0
+        self._t_commit  = monotonic()
+        self._t_sync    = monotonic()
+        self._sync_journal()
+
+    def write_records(self, block):
+        """ append the rows of the 2D array 'block' to the journal
+        """
+        n = len(block)
+        if n == 0:
+            return
+        if self._written - self._committed + n > self.capacity:
+            self._commit()
+            if n > self.capacity:
+                #too large for the journal, straight to the writer
+                self.writer.write_records(block)
+                return
+        start = self._written % self.capacity
+        stop  = min(start + n, self.capacity)
+        self._ring[start:stop] = block[:stop - start]
+        if stop - start < n:
+            self._ring[:n - (stop - start)] = block[stop - start:]
+        self._written += n
+        struct.pack_into("<Q", self._mmap, WRITTEN_OFFSET, self._written)
+
+    def write_trailer(self, stats):
+        self._commit()
+        self.writer.write_trailer(stats)
+
+    def flush(self):
+        """ commit when a batch is due, sync according to the policy
+        """
+        if self._mmap is None:
+            return
+        pending = self._written - self._committed
+        if pending >= self.commit_records or \
+           (pending > 0 and monotonic() - self._t_commit >= self.commit_interval):
+            self._commit()
+        if self.fsync == "interval" and monotonic() - self._t_sync >= self.fsync_interval:
+            self._sync_journal()
+            self._sync_writer()
+            self._t_sync = monotonic()
+
+    def drain(self):
+        """ commit the pending records, so that the statistics are final
+        """
+        self._commit()
+        if hasattr(self.writer, 'drain'):
+            self.writer.drain()
+
+    def stats(self):
+        result = OrderedDict()
+        result['journal_capacity']          = self.capacity
+        result['journal_fsync']             = self.fsync
+        result['journal_commits']           = self.commits
+        result['journal_records_recovered'] = self.records_recovered
+        return result
+
+    def close(self):
+        """ commit everything, then remove the journal
+        """
+        self._commit()
+        self._unmap()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        self.writer.close()
+
+    #---------------------------------------------------------------------------
+    def _commit(self):
+        if self._mmap is None or self._written == self._committed:
+            return
+        start = self._committed % self.capacity
+        stop  = self._written % self.capacity
+        if start < stop:
+            self.writer.write_records(self._ring[start:stop])
+        else:
+            self.writer.write_records(self._ring[start:])
+            self.writer.write_records(self._ring[:stop])
+        self.writer.flush()
+        if self.fsync == "batch":
+            self._sync_writer()
+        self._committed = self._written
+        struct.pack_into("<Q", self._mmap, COMMITTED_OFFSET, self._committed)
+        if self.fsync == "batch":
+            self._sync_journal()
+        self._t_commit = monotonic()
+        self.commits  += 1
+
+    def _sync_journal(self):
+        if not self._mmap is None:
+            self._mmap.flush()
+
+    def _sync_writer(self):
+        if hasattr(self.writer, 'fsync'):
+            self.writer.fsync()
+
+    def _unmap(self):
+        if not self._mmap is None:
+            self._ring = None #release the view before closing the map
+            self._mmap.close()
+            self._mmap = None
+            self._file.close()
+            self._file = None
+
+################################################################################
+# TEST CODE
+################################################################################
+if __name__ == "__main__":
+    import sys, tempfile, shutil, subprocess
+    from csvdata import CSVWriter, read_csv
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        columns = ["t_samp", "t_err", "chan0", "chan1"]
+        n = 1000
+        records = np.column_stack((np.arange(n)*0.5, np.full(n, 0.25), np.arange(n), -np.arange(n)))
+        #batches are committed, the ring wraps around
+        csv_path  = os.path.join(tmp_dir, "data.csv")
+        ring_path = csv_path + ".ring"
+        writer = JournaledWriter(CSVWriter(open(csv_path, 'w')), ring_path,
+                                 capacity = 300, commit_records = 200)
+        writer.write_header(OrderedDict([('start_timestamp', 1.0)]), columns)
+        t1 = monotonic()
+        for i in range(0, n, 7):
+            writer.write_records(records[i:i+7])
+            writer.flush()
+        t2 = monotonic()
+        print "journaled %d records in %0.1f ms" % (n, (t2 - t1)*1e3)
+        assert writer.commits == n//203, writer.commits
+        #the statistics count the final commit once drained
+        writer.drain()
+        assert writer.stats()['journal_commits'] == n//203 + 1
+        writer.close()
+        assert not os.path.exists(ring_path)
+        (metadata, cols, recs), = read_csv(csv_path)
+        assert cols == columns and np.allclose(recs, records)
+        #a process killed before its last commit
+        script = """
+import sys, os
+sys.path.insert(0, %r)
+import numpy as np
+from collections import OrderedDict
+from csvdata import CSVWriter
+from journal import JournaledWriter
+writer = JournaledWriter(CSVWriter(open(%r, 'w')), %r, capacity = 500, commit_records = 400)
+writer.write_header(OrderedDict([('start_timestamp', 2.0)]), %r)
+records = np.load(%r)
+for i in range(0, len(records), 10):
+    writer.write_records(records[i:i+10])
+    writer.flush()
+os._exit(1) #no close
+""" % (os.path.dirname(os.path.abspath(__file__)), csv_path, ring_path, columns,
+       os.path.join(tmp_dir, "records.npy"))
+        np.save(os.path.join(tmp_dir, "records.npy"), records)
+        assert subprocess.call([sys.executable, "-c", script]) == 1
+        (metadata, cols, recs), = read_csv(csv_path)
+        num_committed = len(recs)
+        assert num_committed == 800 and os.path.exists(ring_path)
+        #the next start recovers the rest
+        writer = JournaledWriter(CSVWriter(open(csv_path, 'a')), ring_path)
+        assert writer.records_recovered == n - num_committed
+        writer.close()
+        sessions = read_csv(csv_path)
+        assert len(sessions) == 2
+        metadata, cols, recovered = sessions[1]
+        assert metadata['recovered'] and metadata['start_timestamp'] == 2.0
+        assert np.allclose(np.concatenate((sessions[0][2], recovered)), records)
+        print "recovered %d records" % len(recovered)
+    finally:
+        shutil.rmtree(tmp_dir)
+    print "all tests passed"
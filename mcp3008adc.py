@@ -3,9 +3,44 @@
 """
 ################################################################################
 import time, os
-from comm_spi import CommSPI
+import numpy as np
+from comm_spi import CommSPI, DEFAULT_SPEED_HZ
+import metrics
+from clock import monotonic
 
 DEFAULT_VREF = 3.3
+################################################################################ 
+class ScanPlan(object):
+    """ A precompiled scan of 'channels' (with matching 'modes') built by
+        'MCP3008ADC.make_plan'.  The command frames are computed once, so
+        that repeated scans only need to submit them.
+    """
+    def __init__(self, channels, modes, frames):
+        self.channels = tuple(channels)
+        self.modes    = tuple(modes)
+        self._frames  = tuple(frames)
+        self._blocks  = {}   #frame sequences for 'n' repeated scans
+        self._scratch = {}   #raw count buffers for 'n' repeated scans
+        
+    def __len__(self):
+        return len(self.channels)
+        
+    def frames(self, n = 1):
+        """ get the sequence of frames for 'n' repeated scans
+        """
+        block = self._blocks.get(n)
+        if block is None:
+            block = self._blocks[n] = list(self._frames)*n
+        return block
+        
+    def scratch(self, n = 1):
+        """ get a reusable raw count buffer of shape (n, len(plan))
+        """
+        buff = self._scratch.get(n)
+        if buff is None:
+            buff = self._scratch[n] = np.empty((n, len(self)), dtype = np.uint16)
+        return buff
+
 ################################################################################ 
 class MCP3008ADC(object):
     """ Interface for MCP3008 8-Channel 10-Bit A/D Converters
@@ -16,29 +51,49 @@ class MCP3008ADC(object):
         
         Software mode SPI (bit-banged) can configured using 
         'setup_software_spi'.  
+        
+        Repeated multi-channel reads should use a 'ScanPlan' from 
+        'make_plan' with 'read_many' or 'scan'.
+        
+        Every read holds the lock of the SPI bus, 'lock', which is shared 
+        with the other chips on the same bus.
     """
     NUM_CHANNELS   = 8
     MODEL          = 'MCP3008'
     BIT_RESOLUTION = 10
+    MODES          = ('s','d')
     def __init__(self, 
                  spi_device = None, 
                  vref = DEFAULT_VREF,
+                 spi_speed_hz = DEFAULT_SPEED_HZ,
                 ):
-        self._spi = CommSPI(device = spi_device)
+        self._spi = CommSPI(device = spi_device, speed_hz = spi_speed_hz)
         self.vref       = float(vref)
         self.resolution = 2**self.BIT_RESOLUTION - 1
         self.scale      = self.vref/self.resolution
+        #precompute the frame for every channel and mode
+        self._frames = {}
+        for chan in range(self.NUM_CHANNELS):
+            for mode in self.MODES:
+                self._frames[(chan, mode)] = self._frame(chan, mode)
         
-    def setup_hardware_spi(self, device):
+    def setup_hardware_spi(self, device, speed_hz = DEFAULT_SPEED_HZ):
         """ configure the driver for hardware communications at the port 
-            specified by 'device', i.e. "/dev/spidev0.0"
+            specified by 'device', i.e. "/dev/spidev0.0", with the clock
+            rate 'speed_hz'
         """ 
-        self._spi.setup_hardware(device)
+        self._spi.setup_hardware(device, speed_hz = speed_hz)
     
-    def setup_software_spi(self, clockpin, mosipin, misopin, cspin, pinmode):
+    def setup_software_spi(self, clockpin, mosipin, misopin, cspin, pinmode,
+                           native = None):
         """ setup the GPIO pins to perform software (bit-banged) communications
         """ 
-        self._spi.setup_software(clockpin, mosipin, misopin, cspin, pinmode)
+        self._spi.setup_software(clockpin, mosipin, misopin, cspin, pinmode,
+                                 native = native)
+        
+    @property
+    def lock(self):
+        return self._spi.lock
         
     def read(self, chan, mode = 's'):
         """ get the ADC voltage scaled value in specified 'mode':
@@ -58,6 +113,62 @@ class MCP3008ADC(object):
                    e.g. chan = 0 => CH0 = IN+, CH1 = IN-
                         chan = 1 => CH0 = IN-, CH1 = IN+
         """
+        frame = self._frames.get((chan, mode))
+        if frame is None:
+            self._command(chan, mode) #raises the appropriate error
+        timed = metrics.ENABLED
+        if timed:
+            t1 = monotonic()
+        with self._spi.lock:
+            bytes_in = self._spi.transfer(frame)
+        #data is in 2nd and 3rd bytes (?,?,?,?,?,0,B9,B8), (B7,B6,B5,B4,B3,B2,B1,B0)
+        raw_val = ((bytes_in[1] & 0b11) << 8) + bytes_in[2]
+        if timed:
+            metrics.record("adc.read_raw", monotonic() - t1)
+        return raw_val
+        
+    def make_plan(self, channels, modes = None):
+        """ validate and precompile a scan of 'channels' with matching 
+            'modes' (default all single-ended) 
+        """
+        if modes is None:
+            modes = ['s']*len(channels)
+        if len(modes) != len(channels):
+            raise ValueError, "'modes' must match 'channels' in length"
+        frames = [self._frame(chan, mode) for chan, mode in zip(channels, modes)]
+        return ScanPlan(channels, modes, frames)
+        
+    def read_many(self, plan, n = 1, out = None):
+        """ run the scan 'plan' 'n' times, the raw ADC values are filled into
+            the uint16 array 'out' (allocated if not specified) of 
+            shape (n, len(plan)); the transactions are queued together so that
+            a hardware SPI driver can submit them in a single kernel call.
+        """
+        timed = metrics.ENABLED
+        if timed:
+            t1 = monotonic()
+        if out is None:
+            out = np.empty((n, len(plan)), dtype = np.uint16)
+        with self._spi.lock:
+            bytes_in = bytearray().join(self._spi.transfer_many(plan.frames(n)))
+        data = np.frombuffer(bytes_in, dtype = np.uint8).reshape((n, len(plan), 3))
+        #data is in 2nd and 3rd bytes (?,?,?,?,?,0,B9,B8), (B7,B6,B5,B4,B3,B2,B1,B0)
+        np.bitwise_and(data[:,:,1], 0b11, out = out)
+        out <<= 8
+        out |= data[:,:,2]
+        if timed:
+            metrics.record("adc.read_many", monotonic() - t1, items = out.size)
+        return out
+        
+    def scan(self, plan, n = 1, out = None):
+        """ run the scan 'plan' 'n' times, returning the voltage scaled values
+            in the float array 'out' (allocated if not specified) of 
+            shape (n, len(plan))
+        """
+        raw = self.read_many(plan, n, out = plan.scratch(n))
+        return np.multiply(raw, self.scale, out = out)
+        
+    def _command(self, chan, mode):
         if not chan in range(self.NUM_CHANNELS):
             raise ValueError, "'chan' must be in %r" % range(self.NUM_CHANNELS)
         #command byte is (sgl/diff,D2,D1,D0,X,X,X,X)
@@ -69,29 +180,18 @@ class MCP3008ADC(object):
         else:
             raise ValueError, "mode must be 's' (or 'diff'"
         cmd |= chan << 4         #D2,D1,D0
-        raw_val = self._run_transaction(cmd)
-        return raw_val
+        return cmd
         
-    def _run_transaction(self, cmd):
-        bytes_out = bytearray()
-        bytes_out.append(0x01)   #start bit
-        #command byte is (sgl/diff,D2,D1,D0,X,X,X,X)
-        bytes_out.append(cmd)
-        #extra byte to receive data
-        bytes_out.append(0)
-        #do transmit/receive
-        bytes_in = self._spi.transfer(bytes_out)
-        #data is in 2nd and 3rd bytes (?,?,?,?,?,0,B9,B8), (B7,B6,B5,B4,B3,B2,B1,B0)
-        #print " ".join(map(bin,bytes_in))
-        val  = (bytes_in[1] & 0b11) << 8
-        val += bytes_in[2]
-        return val
+    def _frame(self, chan, mode):
+        #start bit, command byte, extra byte to receive data
+        return bytearray((0x01, self._command(chan, mode), 0))
         
 ################################################################################
 # TEST CODE
 ################################################################################
 if __name__ == "__main__":
-    import RPi.GPIO as GPIO
+    import backend
+    GPIO = backend.get_gpio()
     # change these as desired - they're the pins connected from the
     # SPI port on the ADC to the Cobbler
     SPICLK  = 18
@@ -100,6 +200,13 @@ if __name__ == "__main__":
     SPICS   = 25
     PINMODE = GPIO.BCM  #configure the pin order as Broadcom SoC channels
     
+    if backend.is_simulated():
+        from sim.mcp3008 import SimMCP3008
+        SimMCP3008(clockpin = SPICLK,
+                   misopin  = SPIMISO,
+                   mosipin  = SPIMOSI,
+                   cspin    = SPICS,
+                  ).connect(GPIO)
     adc = MCP3008ADC()
     adc.setup_software_spi(clockpin = SPICLK,
                            misopin  = SPIMISO,
@@ -109,12 +216,13 @@ if __name__ == "__main__":
                           )
     
     #read SPI data from MCP3008 chip, 8 possible adc's (0 thru 7)
+    plan = adc.make_plan(range(adc.NUM_CHANNELS))
     try:
         while True:
             print "---"
             print "timestamp: %s" % time.time()
-            for i in range(adc.NUM_CHANNELS):
-                val = adc.read_single(i)
+            vals = adc.read_many(plan)[0]
+            for i, val in zip(plan.channels, vals):
                 print "chan%d: %d" % (i,val)
             #do nothing for a second
             time.sleep(1.0)
@@ -0,0 +1,278 @@
+""" Low overhead instrumentation of the acquisition hot path: every stage
+    (e.g. "spi.transfer_many", "adc.read_many", "sample.reduce",
+    "output.write") counts its calls and the items they handled (frames,
+    conversions, records) and keeps a histogram of its latency (see
+    'scheduler.LatencyStats'), from which 'samp_size', 'buff_size' and
+    'delay' can be sized.
+
+    Recording is off until 'enable' is called; the instrumented code tests
+    the module flag 'ENABLED' before reading the clock, so that a disabled
+    registry costs a global lookup per call:
+
+        timed = metrics.ENABLED
+        if timed:
+            t1 = monotonic()
+        ...work...
+        if timed:
+            metrics.record("adc.read_many", monotonic() - t1, items = n)
+
+    'snapshot' returns the statistics of all the stages and 'Reporter'
+    writes them periodically during long runs, as a text line to a stream
+    and/or a JSON line to a sidecar file (see 'SUFFIX').
+"""
+################################################################################
+import time, json, threading
+from collections import OrderedDict
+
+from clock import monotonic
+from scheduler import LatencyStats, HIST_EDGES
+
+SUFFIX           = ".metrics" #sidecar file of the reports
+DEFAULT_INTERVAL = 10.0       #seconds between reports
+
+ENABLED = False
+################################################################################
+class Stage(object):
+    """ calls, items and latency of one stage of the hot path
+    """
+    def __init__(self, name):
+        self.name    = name
+        self.calls   = 0
+        self.items   = 0
+        self.latency = LatencyStats()
+
+    def record(self, seconds, items = 1):
+        self.calls += 1
+        self.items += items
+        self.latency.record(seconds)
+
+    def stats(self):
+        latency = self.latency
+        result = OrderedDict()
+        result['calls'] = self.calls
+        result['items'] = self.items
+        result['total'] = latency.total
+        result['min']   = latency.min
+        result['mean']  = latency.mean
+        result['p50']   = latency.percentile(50)
+        result['p99']   = latency.percentile(99)
+        result['max']   = latency.max
+        return result
+
+################################################################################
+class Registry(object):
+    """ stages by name, created on their first record
+    """
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.t_start = monotonic()
+        self._lock  = threading.Lock()
+
+    def stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            with self._lock:
+                stage = self.stages.get(name)
+                if stage is None:
+                    stage = self.stages[name] = Stage(name)
+        return stage
+
+    def record(self, name, seconds, items = 1):
+        self.stage(name).record(seconds, items)
+
+    def reset(self):
+        with self._lock:
+            self.stages  = OrderedDict()
+            self.t_start = monotonic()
+
+    def snapshot(self):
+        """ statistics of every stage by name, with the 'elapsed' seconds
+            since the registry was (re)started
+        """
+        result = OrderedDict()
+        result['elapsed'] = monotonic() - self.t_start
+        for name, stage in self.stages.items():
+            result[name] = stage.stats()
+        return result
+
+registry = Registry()
+################################################################################
+def enable(reset = True):
+    global ENABLED
+    if reset:
+        registry.reset()
+    ENABLED = True
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+def record(name, seconds, items = 1):
+    registry.record(name, seconds, items)
+
+def snapshot():
+    return registry.snapshot()
+
+def format_line(snap):
+    """ one line summary of a 'snapshot', latencies in microseconds
+    """
+    parts = ["elapsed=%0.1fs" % snap['elapsed']]
+    for name, stats in snap.items():
+        if name == 'elapsed':
+            continue
+        parts.append("%s: n=%d items=%d mean=%0.1fus p99=%0.1fus max=%0.1fus" %
+                     (name, stats['calls'], stats['items'], stats['mean']*1e6,
+                      stats['p99']*1e6, stats['max']*1e6))
+    return "#metrics " + "; ".join(parts)
+
+def format_seconds(seconds):
+    if seconds is None:
+        return "-"
+    if seconds < 1e-3:
+        return "%0.1fus" % (seconds*1e6)
+    if seconds < 1.0:
+        return "%0.2fms" % (seconds*1e3)
+    return "%0.3fs" % seconds
+
+def format_histogram(stage, width = 40):
+    """ the latency histogram of 'stage', one line per non-empty bin
+        with a bar scaled to the fullest bin
+    """
+    stats = stage.stats()
+    lines = ["%s: %d calls, %d items, total %s, mean %s, p50 %s, p99 %s, max %s" %
+             (stage.name, stats['calls'], stats['items'],
+              format_seconds(stats['total']), format_seconds(stats['mean']),
+              format_seconds(stats['p50']), format_seconds(stats['p99']),
+              format_seconds(stats['max']))]
+    hist = stage.latency.hist
+    peak = max(hist)
+    if peak == 0:
+        return "\n".join(lines)
+    for index, num in enumerate(hist):
+        if num == 0:
+            continue
+        #bin 'index' holds the values from edge index-1 up to edge index
+        low  = HIST_EDGES[index - 1] if index > 0 else 0.0
+        high = HIST_EDGES[index] if index < len(HIST_EDGES) else None
+        label = "%8s - %-8s" % (format_seconds(low), format_seconds(high))
+        lines.append("    %s %8d %s" % (label, num, "#"*max(1, num*width//peak)))
+    return "\n".join(lines)
+
+def format_report(registry = registry):
+    """ latency histograms of all the stages of the 'registry'
+    """
+    snap = registry.snapshot()
+    lines = ["latency by stage over %s" % format_seconds(snap['elapsed'])]
+    for stage in registry.stages.values():
+        lines.append(format_histogram(stage))
+    return "\n".join(lines)
+
+################################################################################
+class Reporter(object):
+    """ writes a snapshot of the 'registry' every 'interval' seconds from a
+        background thread: a 'format_line' to 'stream' and/or a JSON line
+        (with the wall clock 'timestamp') appended to the file 'path'
+    """
+    def __init__(self, interval = DEFAULT_INTERVAL,
+                 stream   = None,
+                 path     = None,
+                 registry = registry,
+                ):
+        assert interval > 0
+        self.interval = float(interval)
+        self.stream   = stream
+        self.path     = path
+        self.registry = registry
+        self.reports  = 0
+        self._stop    = threading.Event()
+        self._thread  = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target = self._run, name = "metrics.Reporter")
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self, final = True):
+        """ stop the thread, then write a 'final' report
+        """
+        self._stop.set()
+        if not self._thread is None:
+            while self._thread.is_alive():
+                self._thread.join(0.1)
+            self._thread = None
+        if final:
+            self.report()
+
+    def report(self):
+        snap = self.registry.snapshot()
+        if not self.stream is None:
+            self.stream.write(format_line(snap) + "\n")
+            self.stream.flush()
+        if not self.path is None:
+            entry = OrderedDict()
+            entry['timestamp'] = time.time()
+            entry.update(snap)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+        self.reports += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+################################################################################
+# TEST CODE
+################################################################################
+if __name__ == "__main__":
+    import os, tempfile, StringIO
+    def work(n):
+        timed = ENABLED
+        if timed:
+            t1 = monotonic()
+        total = sum(xrange(n))
+        if timed:
+            record("work", monotonic() - t1, items = n)
+        return total
+    #nothing is recorded while disabled
+    work(10)
+    assert snapshot().keys() == ['elapsed']
+    #the cost of the disabled check
+    t1 = monotonic()
+    for i in xrange(100000):
+        timed = ENABLED
+        if timed:
+            pass
+    t2 = monotonic()
+    print "disabled check: %0.3f us" % ((t2 - t1)/100000*1e6)
+    enable()
+    for n in (1000, 2000, 3000):
+        work(n)
+    snap = snapshot()
+    assert snap['work']['calls'] == 3 and snap['work']['items'] == 6000
+    assert snap['work']['min'] <= snap['work']['p50'] <= snap['work']['max']
+    print format_line(snap)
+    #periodic reports to a stream and a sidecar file
+    path   = os.path.join(tempfile.mkdtemp(), "data.csv" + SUFFIX)
+    stream = StringIO.StringIO()
+    reporter = Reporter(interval = 0.1, stream = stream, path = path).start()
+    for i in range(30):
+        work(1000)
+        time.sleep(0.01)
+    reporter.stop()
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == reporter.reports >= 3, lines
+    assert all(line.startswith("#metrics ") for line in lines)
+    entries = [json.loads(line) for line in open(path)]
+    assert len(entries) == reporter.reports
+    assert entries[-1]['work']['calls'] == 33
+    report = format_report()
+    print report
+    assert report.splitlines()[1].startswith("work: 33 calls")
+    disable()
+    work(10)
+    assert snapshot()['work']['calls'] == 33
+    os.remove(path)
+    print "all tests passed"
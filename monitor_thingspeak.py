@@ -2,41 +2,30 @@
     using a voltage divider circuit.
 """
 ################################################################################
-import time
+import os, time
 import numpy as np
-import RPi.GPIO as GPIO
+import backend
 from thermistor import Thermistor
 from mcp3008adc import MCP3008ADC  #ADC for sampling
 import DHT
+from thingspeak import ThingspeakUploader
+from orchestrator import Orchestrator
+from tsstore import TimeSeriesStore
+from deadband import Threshold
 
-TIME_DELAY = 60.0 #seconds
-################################################################################
-#see example at http://australianrobotics.com.au/news/how-to-talk-to-thingspeak-with-python-a-memory-cpu-monitor
-import httplib, urllib
-HEADERS = {"Content-type": "application/x-www-form-urlencoded","Accept":"text/plain"}
-URL     = "api.thingspeak.com:80"
-
-class ThingspeakChannel(object):
-    def __init__(self, api_write_key):
-        self.api_write_key = api_write_key
-        
-    def post(self, **fields):
-        """ Post data to the channel.
-            Arguments should be specified as 'field%d', e.g.
-               obj.post(field1='1.0', field2='2.0')
-        """
-        #TODO check that the fields are labelled correctly
-        
-        #insert the API key
-        fields['key'] = self.api_write_key
-        #format the post parameters
-        params = urllib.urlencode(fields)
-        conn = httplib.HTTPConnection(URL)
-        conn.request("POST","/update",params, HEADERS)
-        response = conn.getresponse()
-        data = response.read()
-        conn.close()
-        return response, data
+TIME_DELAY = 60.0 #seconds between uploads
+DHT_PERIOD  = 30.0 #seconds between room readings
+SOIL_PERIOD = 10.0 #seconds between soil readings
+JOURNAL_PATH = "./thingspeak.journal"   #readings waiting to be uploaded
+CHANNEL_ID_FILE = ".CHANNEL_ID"         #enables bulk uploads, optional
+STORE_PATH = "./monitor.sqlite"         #local history with rollups, None to disable
+#uploads are skipped unless a field changed by more than its deadband, or
+#UPLOAD_HEARTBEAT seconds passed since the last one
+UPLOAD_DEADBAND  = [("field1", 0.2),    #room temperature, C
+                    ("field2", 1.0),    #room humidity, %
+                    ("field3", 0.1),    #soil temperature, C
+                   ]
+UPLOAD_HEARTBEAT = 900.0
 
 ################################################################################
 # Main
@@ -56,8 +45,16 @@ if __name__ == "__main__":
     SPIMISO = 23
     SPIMOSI = 24
     SPICS   = 25
+    GPIO = backend.get_gpio()
     PINMODE = GPIO.BCM  #configure the pin order as Broadcom SoC channels
     
+    if backend.is_simulated():
+        from sim.mcp3008 import SimMCP3008
+        SimMCP3008(clockpin = SPICLK,
+                   misopin  = SPIMISO,
+                   mosipin  = SPIMOSI,
+                   cspin    = SPICS,
+                  ).connect(GPIO)
     adc = MCP3008ADC()
     adc.setup_software_spi(clockpin = SPICLK,
                            misopin  = SPIMISO,
@@ -78,31 +75,74 @@ if __name__ == "__main__":
     DHT_PIN = 4
     DHT.setup(pinmode='BCM')
     dht = DHT.DHT22(DHT_PIN)
+    #keep reading the sensor in the background, readings expire after a period
+    dht_poller = DHT.DHT22Poller(dht, ttl = DHT_PERIOD).start()
                        
                        
-    #setup thingspeak channel
+    #setup thingspeak channel, readings are journaled until they are uploaded
     api_write_key = open('.API_WRITE_KEY.secret').read().strip()
-    thingspeak_channel = ThingspeakChannel(api_write_key)
+    channel_id = None
+    if os.path.isfile(CHANNEL_ID_FILE):
+        channel_id = open(CHANNEL_ID_FILE).read().strip()
+    uploader = ThingspeakUploader(api_write_key, JOURNAL_PATH, channel_id = channel_id)
+    
+    store = None
+    if not STORE_PATH is None:
+        store = TimeSeriesStore(STORE_PATH)
     
-    #read thermistor in a loop
+    #each sensor and the uploads run as periodic tasks on their own cadence,
+    #the blocking reads and uploads are done by worker threads
+    latest = {}
+    upload_threshold = Threshold([tol for field, tol in UPLOAD_DEADBAND], heartbeat = UPLOAD_HEARTBEAT)
+    skipped_uploads = [0]
+    def read_room():
+        value, timestamp, age = dht_poller.latest()
+        if value is None:
+            raise IOError("no recent DHT22 reading")
+        return value
+    def got_room(result):
+        latest['field2'], latest['field1'] = result
+        print "room_temperature: %0.2f, room_humidity: %0.2f" % (result[1], result[0])
+        if not store is None:
+            store.insert_point(time.time(), room_humidity = result[0], room_temperature = result[1])
+    def read_soil():
+        return therm.read_temperature()
+    def got_soil(T_soil):
+        latest['field3'] = T_soil
+        print "soil_temperature: %0.2f" % T_soil
+        if not store is None:
+            store.insert_point(time.time(), soil_temperature = T_soil)
+    def upload():
+        fields = dict(latest)
+        if fields:
+            values = [fields.get(field, np.nan) for field, tol in UPLOAD_DEADBAND]
+            if upload_threshold.significant(time.time(), values):
+                #upload to thingspeak (or keep for later)
+                uploader.post(**fields)
+            else:
+                skipped_uploads[0] += 1
+        stats = uploader.stats()
+        stats['unchanged'] = skipped_uploads[0]
+        return stats
+    def uploaded(stats):
+        print "---"
+        print "timestamp: %s" % time.time()
+        print "upload: %s" % ", ".join("%s=%d" % item for item in stats.items())
+    def skipped(error):
+        print "#%s - skipping this measurement" % type(error).__name__
+    orch = Orchestrator()
+    orch.add_task("room",   DHT_PERIOD,  read_room, on_result = got_room, on_error = skipped,
+                  offset = 5.0) #give the poller time for its first reading
+    orch.add_task("soil",   SOIL_PERIOD, read_soil, on_result = got_soil, on_error = skipped)
+    orch.add_task("upload", TIME_DELAY,  upload,    on_result = uploaded, 
+                  offset = min(DHT_PERIOD, SOIL_PERIOD)) #after the first readings
     try:
-        while True:
-            try:
-                H_room, T_room = dht.read() #WARNING, this may occasionally throw an IOError
-                T_soil = therm.read_temperature()
-                print "---"
-                print "timestamp: %s" % time.time()
-                print "room_temperature: %0.2f" % T_room
-                print "room_humidity: %0.2f" % H_room
-                print "soil_temperature: %0.2f" % T_soil
-                #upload to thingspeak
-                thingspeak_channel.post(field1=T_room,
-                                        field2=H_room,
-                                        field3=T_soil,
-                                       )
-                #do nothing for a second
-                time.sleep(TIME_DELAY)
-            except IOError:
-                print "#IOError - skipping this measurement"
+        orch.run()
     except KeyboardInterrupt:
         pass
+    finally:
+        dht_poller.stop()
+        orch.close()
+        uploader.close()
+        if not store is None:
+            store.close()
@@ -0,0 +1,222 @@
+""" Event loop for monitors reading several sensors at their own rates:
+    every 'PeriodicTask' fires on a fixed cadence (slot 'k' at
+    t_start + offset + k*period on the monotonic clock), its blocking work
+    (ctypes, GPIO, HTTP) runs in a pool of worker threads, and its result
+    or error is handed back to the loop thread, so that a slow sensor or
+    upload never delays the others.
+
+    A task whose previous run is still in progress when its next slot is
+    due skips that slot (counted as missed) rather than piling up runs.
+"""
+################################################################################
+import time, heapq, Queue
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from clock import monotonic
+from scheduler import LatencyStats
+
+DEFAULT_NUM_WORKERS = 4
+POLL_INTERVAL       = 0.5 #seconds, longest wait without checking for stop
+################################################################################
+class PeriodicTask(object):
+    """ run 'func()' every 'period' seconds, starting 'offset' seconds after
+        the loop starts; 'on_result(value)' and 'on_error(exc)' are called
+        in the loop thread
+    """
+    def __init__(self, name, period, func,
+                 on_result = None,
+                 on_error  = None,
+                 offset    = 0.0,
+                ):
+        assert period > 0
+        self.name      = name
+        self.period    = float(period)
+        self.func      = func
+        self.on_result = on_result
+        self.on_error  = on_error
+        self.offset    = float(offset)
+        #counters
+        self.runs      = 0
+        self.errors    = 0
+        self.missed    = 0
+        self.latency   = LatencyStats() #run time of 'func'
+        self.lateness  = LatencyStats() #start of 'func' after its slot
+        self.running   = False
+        self._slot     = 0
+
+    def stats(self):
+        result = OrderedDict()
+        result['period'] = self.period
+        result['runs']   = self.runs
+        result['errors'] = self.errors
+        result['missed'] = self.missed
+        result.update(self.latency.summary("latency_"))
+        result.update(self.lateness.summary("lateness_"))
+        return result
+
+################################################################################
+class Orchestrator(object):
+    """ runs the 'PeriodicTask's added with 'add_task' using 'num_workers'
+        threads for their work
+    """
+    def __init__(self, num_workers = DEFAULT_NUM_WORKERS):
+        self.tasks   = []
+        self._pool   = ThreadPool(num_workers)
+        self._done   = Queue.Queue() #(task, ok, value, latency)
+        self._heap   = []            #(due time, order, task)
+        self._stop   = False
+
+    def add_task(self, name, period, func, **kwargs):
+        task = PeriodicTask(name, period, func, **kwargs)
+        self.tasks.append(task)
+        return task
+
+    def stop(self):
+        """ make 'run' return, may be called from a callback or a task
+        """
+        self._stop = True
+
+    def run(self, duration = None):
+        """ run the tasks for 'duration' seconds, or until 'stop' is called
+            (or KeyboardInterrupt), then wait for the runs in progress
+        """
+        self._stop = False
+        if not self.tasks:
+            return
+        t_start = monotonic()
+        t_end   = None if duration is None else t_start + duration
+        self._heap = []
+        for order, task in enumerate(self.tasks):
+            task._slot = 0
+            heapq.heappush(self._heap, (t_start + task.offset, order, task))
+        try:
+            while not self._stop:
+                now = monotonic()
+                if not t_end is None and now >= t_end:
+                    break
+                due, order, task = self._heap[0]
+                if due <= now:
+                    heapq.heapreplace(self._heap, (self._next_due(task, t_start, now), order, task))
+                    self._fire(task, due)
+                    continue
+                #wait for results until the next slot
+                wait = due - now
+                if not t_end is None:
+                    wait = min(wait, t_end - now)
+                self._handle_results(min(wait, POLL_INTERVAL))
+        finally:
+            self._drain()
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def stats(self):
+        result = OrderedDict()
+        for task in self.tasks:
+            result[task.name] = task.stats()
+        return result
+
+    #---------------------------------------------------------------------------
+    def _next_due(self, task, t_start, now):
+        """ advance to the next slot of 'task' which is not already past
+        """
+        task._slot += 1
+        due = t_start + task.offset + task._slot*task.period
+        if due <= now:
+            skipped = int((now - due)//task.period) + 1
+            task.missed += skipped
+            task._slot  += skipped
+            due += skipped*task.period
+        return due
+
+    def _fire(self, task, due):
+        if task.running:
+            task.missed += 1
+            return
+        task.running = True
+        done = self._done
+        def work():
+            t1 = monotonic()
+            task.lateness.record(max(t1 - due, 0.0))
+            try:
+                value = task.func()
+                ok = True
+            except Exception, error:
+                value = error
+                ok = False
+            done.put((task, ok, value, monotonic() - t1))
+        self._pool.apply_async(work)
+
+    def _handle_results(self, timeout):
+        try:
+            item = self._done.get(timeout = timeout)
+        except Queue.Empty:
+            return
+        while True:
+            task, ok, value, latency = item
+            task.running = False
+            task.runs += 1
+            task.latency.record(latency)
+            if ok:
+                if not task.on_result is None:
+                    task.on_result(value)
+            else:
+                task.errors += 1
+                if not task.on_error is None:
+                    task.on_error(value)
+                else:
+                    print "#%s: %s: %s" % (task.name, type(value).__name__, value)
+            try:
+                item = self._done.get_nowait()
+            except Queue.Empty:
+                return
+
+    def _drain(self):
+        while any(task.running for task in self.tasks):
+            self._handle_results(POLL_INTERVAL)
+
+################################################################################
+# TEST CODE
+################################################################################
+if __name__ == "__main__":
+    orch = Orchestrator(num_workers = 4)
+    results = {'fast': [], 'slow': [], 'flaky': []}
+    def fast():
+        return monotonic()
+    def slow():
+        time.sleep(0.25) #e.g. a DHT22 read with retries
+        return monotonic()
+    calls = [0]
+    def flaky():
+        calls[0] += 1
+        if calls[0] % 2:
+            raise IOError("no response")
+        return calls[0]
+    errors = []
+    orch.add_task("fast",  0.05, fast,  on_result = results['fast'].append)
+    orch.add_task("slow",  0.1,  slow,  on_result = results['slow'].append)
+    orch.add_task("flaky", 0.1,  flaky, on_result = results['flaky'].append,
+                  on_error = errors.append, offset = 0.02)
+    t1 = monotonic()
+    orch.run(duration = 1.0)
+    t2 = monotonic()
+    orch.close()
+    for name, stats in orch.stats().items():
+        print "%s:" % name
+        for key, val in stats.items():
+            print "\t%s = %r" % (key, val)
+    stats = orch.stats()
+    #the fast task keeps its cadence while the slow one overruns
+    assert stats['fast']['runs'] >= 19, stats['fast']
+    assert stats['fast']['lateness_max'] < 0.02
+    gaps = [b - a for a, b in zip(results['fast'], results['fast'][1:])]
+    assert max(gaps) < 0.07, gaps
+    assert stats['slow']['missed'] > 0
+    assert stats['slow']['runs'] + stats['slow']['missed'] >= 10
+    #errors are reported, not raised
+    assert stats['flaky']['errors'] == len(errors) > 0
+    assert all(isinstance(error, IOError) for error in errors)
+    assert t2 - t1 < 1.4
+    print "all tests passed"
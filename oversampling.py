@@ -0,0 +1,90 @@
+""" Adaptive oversampling: instead of always averaging a fixed number of
+    subsamples, 'adaptive_mean' reads batches of scans only until the
+    standard error of the mean of every input is within a target (or a
+    maximum count is reached), so that quiet inputs cost a fraction of the
+    bus time of noisy ones.
+
+    After the first 'min_samples' scans, the next batch is sized from the
+    running variance to what the noisiest input still needs, at most
+    doubling the count, so a settled reading takes two or three batched
+    transactions rather than one per subsample.
+"""
+################################################################################
+import numpy as np
+
+DEFAULT_MIN_SAMPLES = 8
+DEFAULT_MAX_SAMPLES = 100
+################################################################################
+def adaptive_mean(read_block, target,
+                  min_samples = DEFAULT_MIN_SAMPLES,
+                  max_samples = DEFAULT_MAX_SAMPLES,
+                 ):
+    """ average the blocks of (scans x inputs) returned by 'read_block(n)'
+        until the standard error of every input's mean is at most 'target'
+        (a scalar, an array per input, or a function of the means returning
+        either) or 'max_samples' scans are read, returning
+        (means, standard deviations, number of scans)
+    """
+    assert 1 <= min_samples <= max_samples
+    n     = 0
+    batch = min_samples
+    sums  = None
+    while True:
+        block = np.asarray(read_block(batch), dtype = float)
+        if sums is None:
+            sums  = block.sum(axis = 0)
+            sumsq = np.square(block).sum(axis = 0)
+        else:
+            sums  += block.sum(axis = 0)
+            sumsq += np.square(block).sum(axis = 0)
+        n += batch
+        means = sums/n
+        var   = np.maximum(sumsq/n - np.square(means), 0.0)
+        if n > 1:
+            var *= n/(n - 1.0)
+        if n >= max_samples:
+            break
+        goal = target(means) if callable(target) else target
+        goal = np.broadcast_to(np.asarray(goal, dtype = float), means.shape)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            if (np.sqrt(var/n) <= goal).all():
+                break
+            #scans the noisiest input needs, a NaN goal (e.g. out of range) needs all
+            needed = np.nanmax(np.where(goal > 0, var/np.square(goal), np.inf))
+        if not np.isfinite(needed):
+            needed = max_samples
+        batch = int(min(max(np.ceil(needed) - n, 1), n, max_samples - n))
+    return means, np.sqrt(var), n
+
+################################################################################
+# TEST CODE
+################################################################################
+if __name__ == "__main__":
+    rng = np.random.RandomState(0)
+    levels = np.array([100.0, 500.0, 900.0])
+    noise  = np.array([0.0, 0.5, 4.0])
+    reads  = []
+    def read_block(n):
+        reads.append(n)
+        return np.round(levels + noise*rng.randn(n, 3))
+    #quiet inputs stop at the minimum
+    del reads[:]
+    means, stds, n = adaptive_mean(lambda n: read_block(n)[:,:2], target = 0.5, max_samples = 1000)
+    assert n == DEFAULT_MIN_SAMPLES and len(reads) == 1, (n, reads)
+    #the noisiest input sets the count
+    del reads[:]
+    means, stds, n = adaptive_mean(read_block, target = 0.5, max_samples = 1000)
+    print "target 0.5: %d scans in batches %r, std. err. %r" % (n, reads, (stds/np.sqrt(n)).round(3))
+    assert (stds/np.sqrt(n) <= 0.5).all() and n < 200 and len(reads) <= 5
+    assert np.allclose(means, levels, atol = 2.0)
+    #never beyond the maximum
+    del reads[:]
+    means, stds, n = adaptive_mean(read_block, target = 0.01, max_samples = 50)
+    assert n == 50 and sum(reads) == 50
+    #per input targets given by a function of the means
+    means, stds, n = adaptive_mean(read_block, target = lambda means: means/1000.0, max_samples = 1000)
+    assert (stds/np.sqrt(n) <= levels/1000.0 + 0.01).all()
+    #an unreachable (NaN) target reads everything
+    means, stds, n = adaptive_mean(read_block, target = np.nan, max_samples = 30)
+    assert n == 30
+    print "all tests passed"
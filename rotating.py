@@ -0,0 +1,263 @@
+""" Rotating, stream-compressed CSV output for long unattended runs: the
+    records go into a sequence of segment files, each a complete CSV data
+    file (see 'csvdata.py') starting with the session's metadata header
+    (plus its 'segment' number), so every file stands on its own.
+
+    A segment is finished when it holds 'max_bytes' of CSV text (before
+    compression, as codecs like bz2 only emit output in large chunks) or
+    after 'max_seconds', and on 'close'.  The active segment is written to
+    '<name>.part' and renamed to '<name>' once it is complete and synced,
+    so readers never see a half-written segment.  The compressed stream is
+    written to the card in whole blocks of 'block_size' bytes, independent
+    of how often the acquisition flushes its buffer; a crash loses at most
+    the last block.
+
+    Codecs are registered in 'CODECS' by name as (suffix, opener), where
+    'opener(fileobj)' returns a writable stream compressing into 'fileobj'.
+"""
+################################################################################
+import os, time, gzip, bz2
+from collections import OrderedDict
+
+from clock import monotonic
+from csvdata import CSVWriter, DEFAULT_DELIMITER, DEFAULT_NEWLINE, DEFAULT_PRECISION
+
+DEFAULT_CODEC      = "gzip"
+DEFAULT_BLOCK_SIZE = 64*1024 #bytes, a multiple of the flash erase page
+PART_SUFFIX        = ".part"
+TIME_FORMAT        = "%Y%m%d-%H%M%S"
+################################################################################
+class _BZ2Stream(object):
+    """ streaming bz2 compression into 'fileobj'
+    """
+    def __init__(self, fileobj, level = 9):
+        self.fileobj = fileobj
+        self._comp   = bz2.BZ2Compressor(level)
+
+    def write(self, data):
+        self.fileobj.write(self._comp.compress(data))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.fileobj.write(self._comp.flush())
+
+CODECS = OrderedDict([
+    ("gzip", (".gz" , lambda fileobj: gzip.GzipFile(fileobj = fileobj, mode = 'wb'))),
+    ("bz2" , (".bz2", _BZ2Stream)),
+    ("none", (""    , lambda fileobj: fileobj)),
+])
+
+def register_codec(name, suffix, opener):
+    CODECS[name] = (suffix, opener)
+
+################################################################################
+class BlockFile(object):
+    """ file writing only whole blocks of 'block_size' bytes to 'path', the
+        remainder is written by 'close' (after which the file is synced)
+    """
+    def __init__(self, path, block_size = DEFAULT_BLOCK_SIZE):
+        self.path       = path
+        self.block_size = block_size
+        self.size       = 0   #bytes accepted
+        self.blocks     = 0   #block writes to the file
+        self._file      = open(path, 'wb')
+        self._pending   = []
+        self._num_pending = 0
+
+    def write(self, data):
+        if not data:
+            return
+        self._pending.append(data)
+        self._num_pending += len(data)
+        self.size         += len(data)
+        if self._num_pending >= self.block_size:
+            data = "".join(self._pending)
+            num  = len(data) - len(data) % self.block_size
+            self._file.write(data[:num])
+            self.blocks += num // self.block_size
+            self._pending     = [data[num:]]
+            self._num_pending = len(data) - num
+
+    def flush(self):
+        pass #only whole blocks are written
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.write("".join(self._pending))
+        self._pending = []
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+class _CountingStream(object):
+    """ counts the bytes written to 'stream'
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.size   = 0
+
+    def write(self, data):
+        self.size += len(data)
+        self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        self.stream.close()
+
+################################################################################
+class RotatingCSVWriter(CSVWriter):
+    """ writes the sessions of records to segments named after 'path', e.g.
+        "data.csv" -> "data.20170101-120000.000.csv.gz" (start time, number
+        and the codec's suffix); a new segment is begun once the current one
+        holds 'max_bytes' of text or is 'max_seconds' old (either may be None)
+    """
+    def __init__(self, path,
+                 max_bytes   = None,
+                 max_seconds = None,
+                 codec       = DEFAULT_CODEC,
+                 block_size  = DEFAULT_BLOCK_SIZE,
+                 delimiter   = DEFAULT_DELIMITER,
+                 newline     = DEFAULT_NEWLINE,
+                 precision   = DEFAULT_PRECISION,
+                ):
+        if not codec in CODECS:
+            raise ValueError, "'codec' must be in %r" % CODECS.keys()
+        CSVWriter.__init__(self, None,
+                           delimiter = delimiter,
+                           newline   = newline,
+                           precision = precision,
+                          )
+        self.path        = path
+        self.max_bytes   = max_bytes
+        self.max_seconds = max_seconds
+        self.codec       = codec
+        self.block_size  = block_size
+        self.segments    = [] #paths of the finished segments
+        self._metadata   = None
+        self._index      = 0
+        self._raw        = None
+
+    def write_header(self, metadata, columns):
+        """ begin a new session in a new segment
+        """
+        self._finish_segment()
+        self._metadata = OrderedDict(metadata)
+        self.columns   = list(columns)
+        self._begin_segment()
+
+    def write_records(self, block):
+        CSVWriter.write_records(self, block)
+        if self._is_full():
+            self._finish_segment()
+            self._begin_segment()
+
+    def flush(self):
+        pass #the segment is written in whole blocks
+
+    def fsync(self):
+        pass #the segments are synced as they are finished
+
+    def close(self):
+        self._finish_segment()
+
+    def stats(self):
+        result = OrderedDict()
+        result['segments'] = len(self.segments) + (not self._raw is None)
+        result['codec']    = self.codec
+        return result
+
+    #---------------------------------------------------------------------------
+    def _segment_path(self):
+        root, ext = os.path.splitext(self.path)
+        return "%s.%s.%03d%s%s" % (root, time.strftime(TIME_FORMAT), self._index,
+                                   ext, CODECS[self.codec][0])
+
+    def _begin_segment(self):
+        suffix, opener = CODECS[self.codec]
+        self._final_path = self._segment_path()
+        self._raw     = BlockFile(self._final_path + PART_SUFFIX, block_size = self.block_size)
+        self._t_begin = monotonic()
+        self.output_file = _CountingStream(opener(self._raw))
+        metadata = OrderedDict(self._metadata)
+        metadata['segment'] = self._index
+        CSVWriter.write_header(self, metadata, self.columns)
+        self._index += 1
+
+    def _is_full(self):
+        if not self.max_bytes is None and self.output_file.size >= self.max_bytes:
+            return True
+        if not self.max_seconds is None and monotonic() - self._t_begin >= self.max_seconds:
+            return True
+        return False
+
+    def _finish_segment(self):
+        """ complete the compressed stream and move the segment into place
+        """
+        if self._raw is None:
+            return
+        self.output_file.close()
+        self._raw.close()
+        os.rename(self._raw.path, self._final_path)
+        self.segments.append(self._final_path)
+        self.output_file = None
+        self._raw = None
+
+################################################################################
+# TEST CODE
+################################################################################
+if __name__ == "__main__":
+    import glob, tempfile, shutil
+    import numpy as np
+    from csvdata import read_csv
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        rng = np.random.RandomState(0)
+        n = 20000
+        records = np.column_stack((np.arange(n)*0.1, np.full(n, 0.001), rng.rand(n), rng.rand(n)))
+        columns = ["t_samp", "t_err", "chan0", "chan1"]
+        for codec in CODECS:
+            path = os.path.join(tmp_dir, codec, "data.csv")
+            os.mkdir(os.path.dirname(path))
+            writer = RotatingCSVWriter(path, max_bytes = 200000, codec = codec, block_size = 4096)
+            writer.write_header(OrderedDict([('start_timestamp', 1500000000.0)]), columns)
+            for i in range(0, n, 10):
+                writer.write_records(records[i:i+10])
+                writer.flush()
+                #only finished segments and the active part are visible
+                parts = glob.glob(os.path.join(os.path.dirname(path), "*" + PART_SUFFIX))
+                assert len(parts) == 1
+                assert sorted(glob.glob(os.path.join(os.path.dirname(path), "data.*"))) == sorted(writer.segments + parts)
+            writer.write_trailer(OrderedDict([('samples', n)]))
+            writer.close()
+            segments = writer.segments
+            assert not glob.glob(os.path.join(os.path.dirname(path), "*" + PART_SUFFIX))
+            sizes = [os.path.getsize(segment) for segment in segments]
+            print "%s: %d segments of %s bytes" % (codec, len(segments), sizes)
+            assert len(segments) > 1
+            #every segment stands on its own and together they hold the records
+            parts = []
+            for index, segment in enumerate(segments):
+                assert segment.endswith(".csv" + CODECS[codec][0])
+                (metadata, cols, recs), = read_csv(segment)
+                assert metadata['segment'] == index and metadata['start_timestamp'] == 1500000000.0
+                assert cols == columns
+                parts.append(recs)
+            assert np.allclose(np.concatenate(parts), records, atol = 1e-6)
+        #rotation by time
+        path = os.path.join(tmp_dir, "timed.csv")
+        writer = RotatingCSVWriter(path, max_seconds = 0.1)
+        writer.write_header(OrderedDict(), columns)
+        for i in range(5):
+            writer.write_records(records[i:i+1])
+            time.sleep(0.06)
+        writer.close()
+        assert len(writer.segments) == 3, writer.segments
+    finally:
+        shutil.rmtree(tmp_dir)
+    print "all tests passed"
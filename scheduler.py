@@ -0,0 +1,145 @@
+""" Fixed rate scheduling on an absolute monotonic timeline: slot 'k' is due
+    at t_start + k*period regardless of how long the work of the previous 
+    slots took, so the sampling period does not drift.  Slots which could 
+    not be started because the work overran are counted as missed instead 
+    of silently stretching the period.
+"""
+################################################################################
+import time, bisect
+from collections import OrderedDict
+
+from clock import monotonic
+
+#histogram bin edges, 20 per decade from 1 microsecond to 100 seconds
+HIST_EDGES = [10**(e/20.0) for e in range(-120, 41)]
+################################################################################
+class LatencyStats(object):
+    """ running min/mean/max of durations (seconds) with a logarithmically 
+        binned histogram for percentile estimates
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min   = None
+        self.max   = None
+        self.hist  = [0]*(len(HIST_EDGES) + 1)
+        
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.hist[bisect.bisect_right(HIST_EDGES, value)] += 1
+        
+    @property
+    def mean(self):
+        return self.total/self.count if self.count else None
+        
+    def percentile(self, p):
+        """ upper bound of the bin holding the 'p' percentile (clipped to the
+            observed range)
+        """
+        if not self.count:
+            return None
+        target = self.count*p/100.0
+        cumulative = 0
+        for index, num in enumerate(self.hist):
+            cumulative += num
+            if cumulative >= target:
+                break
+        if index < len(HIST_EDGES):
+            return min(max(HIST_EDGES[index], self.min), self.max)
+        return self.max
+        
+    def summary(self, prefix = ""):
+        result = OrderedDict()
+        result[prefix + "min"]  = self.min
+        result[prefix + "mean"] = self.mean
+        result[prefix + "p99"]  = self.percentile(99)
+        result[prefix + "max"]  = self.max
+        return result
+
+################################################################################
+class Scheduler(object):
+    """ fires slots every 'period' seconds; call 'wait' before the work of 
+        each slot and 'done' after it
+    """
+    def __init__(self, period):
+        self.period = float(period)
+        self.jitter  = LatencyStats()  #lateness of the start of each slot
+        self.latency = LatencyStats()  #from the slot's due time until done
+        self.slots_fired  = 0
+        self.slots_missed = 0
+        self.overruns     = 0
+        self.t_start = None
+        self._slot   = 0
+        self._due    = None
+        
+    def start(self, t_start = None):
+        """ begin the timeline at monotonic time 't_start' (default now)
+        """
+        if t_start is None:
+            t_start = monotonic()
+        self.t_start = t_start
+        self._slot   = 0
+        
+    def wait(self):
+        """ sleep until the next slot is due and return its due time; slots
+            which are already over are skipped and counted as missed
+        """
+        if self.t_start is None:
+            self.start()
+        period = self.period
+        due = self.t_start + self._slot*period
+        now = monotonic()
+        if now >= due + period and period > 0:
+            #the work overran one or more whole slots
+            missed = int((now - due)//period)
+            self.slots_missed += missed
+            self._slot += missed
+            due += missed*period
+        while now < due:
+            time.sleep(due - now)
+            now = monotonic()
+        self.jitter.record(now - due)
+        self.slots_fired += 1
+        self._slot += 1
+        self._due = due
+        return due
+        
+    def done(self):
+        """ mark the end of the work of the current slot
+        """
+        now = monotonic()
+        self.latency.record(now - self._due)
+        if now > self._due + self.period:
+            self.overruns += 1
+            
+    def stats(self):
+        result = OrderedDict()
+        result['period']       = self.period
+        result['slots_fired']  = self.slots_fired
+        result['slots_missed'] = self.slots_missed
+        result['overruns']     = self.overruns
+        result.update(self.jitter.summary(prefix = "jitter_"))
+        result.update(self.latency.summary(prefix = "latency_"))
+        return result
+
+################################################################################
+# TEST CODE
+################################################################################
+if __name__ == "__main__":
+    sched = Scheduler(period = 0.01)
+    sched.start()
+    for i in range(50):
+        due = sched.wait()
+        if i == 20:
+            time.sleep(0.035) #overrun, two slots are passed and the third is late
+        sched.done()
+    for key, val in sched.stats().items():
+        print "%s = %r" % (key, val)
+    assert sched.slots_missed == 2 and sched.overruns == 1
+    #the timeline does not drift
+    assert abs(due - (sched.t_start + (50 + 2 - 1)*0.01)) < 1e-9
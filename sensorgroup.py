@@ -0,0 +1,122 @@
+""" Reading several ADC-backed sensors (e.g. 'thermistor.Thermistor') in one
+    pass: 'SensorGroup' scans the channels of all its sensors together, so
+    that they are sampled over the same time window with the fewest bus
+    transactions, and hands each sensor its column of the data to convert.
+
+    A sensor must have the attributes 'adc' and 'adc_channel' (and may have
+    'adc_mode', default 's') and a method 'convert_counts(counts)' which
+    converts (averaged, fractional) raw ADC counts to its reading.
+"""
+################################################################################
+import numpy as np
+
+DEFAULT_SAMP_NUM = 100
+################################################################################
+class VoltageSensor(object):
+    """ a linear sensor reading 'gain'*V + 'offset' from the ADC voltage 'V'
+    """
+    def __init__(self, adc, adc_channel, adc_mode = 's', gain = 1.0, offset = 0.0):
+        self.adc         = adc
+        self.adc_channel = adc_channel
+        self.adc_mode    = adc_mode
+        self.gain        = gain
+        self.offset      = offset
+
+    def convert_counts(self, counts):
+        return self.gain*np.asarray(counts)*self.adc.scale + self.offset
+
+################################################################################
+class SensorGroup(object):
+    """ Group of 'sensors' sharing one ADC, read with a single scan plan
+        holding each (channel, mode) once
+    """
+    def __init__(self, sensors):
+        self.sensors = list(sensors)
+        assert len(self.sensors) > 0
+        self.adc = self.sensors[0].adc
+        for sensor in self.sensors:
+            if not sensor.adc is self.adc:
+                raise ValueError, "the sensors of a group must share the same ADC"
+        #column of the scan of every sensor
+        inputs = []
+        self._columns = []
+        for sensor in self.sensors:
+            key = (sensor.adc_channel, getattr(sensor, 'adc_mode', 's'))
+            if not key in inputs:
+                inputs.append(key)
+            self._columns.append(inputs.index(key))
+        channels, modes = zip(*inputs)
+        self._plan = self.adc.make_plan(list(channels), list(modes))
+
+    def read_counts(self, samp_num = DEFAULT_SAMP_NUM):
+        """ scan all the inputs 'samp_num' times, returning the raw counts of
+            shape (samp_num, number of distinct inputs)
+        """
+        return self.adc.read_many(self._plan, samp_num)
+
+    def read(self, samp_num = DEFAULT_SAMP_NUM):
+        """ read all the sensors, averaging 'samp_num' interleaved scans,
+            returning their readings in the order of 'sensors'
+        """
+        counts = self.read_counts(samp_num).mean(axis = 0)
+        return [float(sensor.convert_counts(counts[column]))
+                for sensor, column in zip(self.sensors, self._columns)]
+
+################################################################################
+# TEST CODE
+################################################################################
+if __name__ == "__main__":
+    import time
+    import backend
+    from mcp3008adc import MCP3008ADC
+    from thermistor import Thermistor
+    from sim.mcp3008 import SimMCP3008
+    backend.select("sim")
+    GPIO = backend.get_gpio()
+    SPICLK  = 18
+    SPIMISO = 23
+    SPIMOSI = 24
+    SPICS   = 25
+    chip = SimMCP3008(clockpin = SPICLK,
+                      misopin  = SPIMISO,
+                      mosipin  = SPIMOSI,
+                      cspin    = SPICS,
+                      noise    = 0.0,
+                     )
+    for chan in range(8):
+        chip.set_channel(chan, 1.0 + 0.1*chan, noise = 0.0)
+    chip.connect(GPIO)
+    adc = MCP3008ADC()
+    adc.setup_software_spi(clockpin = SPICLK,
+                           misopin  = SPIMISO,
+                           mosipin  = SPIMOSI,
+                           cspin    = SPICS,
+                           pinmode  = GPIO.BCM,
+                          )
+    # calibration coeffs for RSBR-302J-Z50 Teflon-Coated 3k Thermistor
+    therms = [Thermistor(A = 3.3501, B = 0.5899, C = 0.0104, R_25C = 3000.0,
+                         R_std = 3190.0, adc = adc, adc_channel = chan)
+              for chan in range(7)]
+    volts  = VoltageSensor(adc, adc_channel = 7)
+    group = SensorGroup(therms + [volts])
+    samp_num = 20
+    chip.conversions = 0
+    t1 = time.time()
+    readings = group.read(samp_num = samp_num)
+    t2 = time.time()
+    assert chip.conversions == 8*samp_num
+    print "group: %d conversions in %0.3f s" % (chip.conversions, t2 - t1)
+    #the same readings as the sensors on their own
+    chip.conversions = 0
+    t1 = time.time()
+    single = [therm.read_temperature(samp_num = samp_num) for therm in therms]
+    t2 = time.time()
+    print "one by one: %d conversions in %0.3f s" % (chip.conversions, t2 - t1)
+    assert np.allclose(readings[:7], single)
+    assert abs(readings[7] - 1.7) < 2*adc.scale
+    for sensor, reading in zip(group.sensors, readings):
+        print "chan%d: %0.3f" % (sensor.adc_channel, reading)
+    #sensors on the same input share a column of the scan
+    group = SensorGroup([therms[0], VoltageSensor(adc, 0), therms[1]])
+    assert len(group.read_counts(1)[0]) == 2
+    print "all tests passed"
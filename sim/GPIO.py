@@ -0,0 +1,136 @@
+"""
+ sim.GPIO.py
+ 
+ Drop-in simulation of the RPi.GPIO module interface.  Simulated devices 
+ (e.g. 'sim.mcp3008.SimMCP3008') are wired to pin numbers with 'attach': 
+ they are notified of every level change of the pins they listen to through
+ their 'drive(pin, level)' method and report the level of the pins they 
+ drive through their 'sense(pin)' method (None when not driving).
+ 
+ The per call cost of the real module may be emulated by setting a latency 
+ in microseconds with the environment variable OPENLABMONITOR_SIM_LATENCY
+ or with 'set_latency'.
+"""
+import os, time
+
+SIMULATED = True
+VERSION   = "sim"
+
+# constants matching RPi.GPIO
+BOARD    = 10
+BCM      = 11
+OUT      = 0
+IN       = 1
+LOW      = 0
+HIGH     = 1
+PUD_OFF  = 20
+PUD_DOWN = 21
+PUD_UP   = 22
+
+LATENCY_ENV_VAR = "OPENLABMONITOR_SIM_LATENCY"
+###############################################################################
+_mode       = None
+_warnings   = True
+_directions = {}   #pin -> IN or OUT
+_pulls      = {}   #pin -> level of an undriven input
+_levels     = {}   #pin -> level of an output
+_listeners  = {}   #pin -> devices notified of level changes
+_drivers    = {}   #pin -> devices which may drive the level
+_latency    = float(os.environ.get(LATENCY_ENV_VAR, 0))*1e-6
+###############################################################################
+def setmode(mode):
+    global _mode
+    if not mode in (BOARD, BCM):
+        raise ValueError("An invalid mode was passed to setmode()")
+    if not _mode is None and mode != _mode:
+        raise ValueError("A different mode has already been set!")
+    _mode = mode
+    
+def getmode():
+    return _mode
+    
+def setwarnings(flag):
+    global _warnings
+    _warnings = bool(flag)
+    
+def setup(channel, direction, pull_up_down = PUD_OFF, initial = None):
+    if _mode is None:
+        raise RuntimeError("Please set pin numbering mode using GPIO.setmode(GPIO.BOARD) or GPIO.setmode(GPIO.BCM)")
+    if not direction in (IN, OUT):
+        raise ValueError("An invalid direction was passed to setup()")
+    _directions[channel] = direction
+    _pulls[channel] = HIGH if pull_up_down == PUD_UP else LOW
+    if direction == OUT:
+        _set_level(channel, LOW if initial is None else int(bool(initial)))
+        
+def output(channel, value):
+    if _latency:
+        _wait()
+    if _directions.get(channel) != OUT:
+        raise RuntimeError("The GPIO channel has not been set up as an OUTPUT")
+    _set_level(channel, int(bool(value)))
+    
+def input(channel):
+    if _latency:
+        _wait()
+    direction = _directions.get(channel)
+    if direction is None:
+        raise RuntimeError("You must setup() the GPIO channel first")
+    if direction == OUT:
+        return _levels[channel]
+    for device in _drivers.get(channel, ()):
+        level = device.sense(channel)
+        if not level is None:
+            return level
+    return _pulls[channel]
+    
+def cleanup(channel = None):
+    global _mode
+    if channel is None:
+        _directions.clear()
+        _levels.clear()
+        _pulls.clear()
+        _mode = None
+    else:
+        _directions.pop(channel, None)
+        _levels.pop(channel, None)
+        _pulls.pop(channel, None)
+        
+###############################################################################
+# simulation interface
+###############################################################################
+def attach(device, listen = (), drive = ()):
+    """ wire 'device' to the pins it 'listen's to and the pins it may 'drive'
+    """
+    for pin in listen:
+        _listeners.setdefault(pin, []).append(device)
+    for pin in drive:
+        _drivers.setdefault(pin, []).append(device)
+    return device
+    
+def detach(device):
+    for devices in _listeners.values() + _drivers.values():
+        while device in devices:
+            devices.remove(device)
+            
+def detach_all():
+    _listeners.clear()
+    _drivers.clear()
+    
+def set_latency(seconds):
+    """ emulate the cost of each 'output' and 'input' call
+    """
+    global _latency
+    _latency = float(seconds)
+    
+def _wait():
+    t_end = time.time() + _latency
+    while time.time() < t_end:
+        pass
+        
+def _set_level(channel, level):
+    if _levels.get(channel) == level:
+        return
+    _levels[channel] = level
+    for device in _listeners.get(channel, ()):
+        device.drive(channel, level)
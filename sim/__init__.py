@@ -0,0 +1,12 @@
+""" Simulated stand-ins for the Raspberry Pi hardware interfaces, so that the
+    acquisition code can be exercised and profiled without a Pi:
+    
+      sim.GPIO    - drop-in replacement for the RPi.GPIO module
+      sim.mcp3008 - pin level MCP3008 emulator with programmable waveforms
+      sim.spidev  - stand-in for a '/dev/spidevX.Y' device file
+      sim.dht     - stand-in for the LibDHT shared library
+    
+    The simulator is selected through the 'backend' module, either with the
+    environment variable OPENLABMONITOR_BACKEND=sim or the '--simulate' flag
+    of 'adcsampler.py'.
+"""
@@ -0,0 +1,83 @@
+"""
+ sim.dht.py
+ 
+ Stand-in for the LibDHT shared library (see 'DHT.lib') which simulates 
+ DHT22 sensors, including the refractory period between reads and the 
+ occasional failed read, reported through 'read_dht22's return codes.
+"""
+import time, random
+
+from DHT.lib import ERROR_BAD_DATA_CHECKSUM, ERROR_NO_RESPONSE
+from sim.mcp3008 import constant, sine
+
+DEFAULT_HUMIDITY     = sine(offset = 45.0, amplitude = 5.0, period = 3600.0) #percent
+DEFAULT_TEMPERATURE  = sine(offset = 22.0, amplitude = 1.0, period = 3600.0) #celsius
+DEFAULT_NOISE        = 0.1
+DEFAULT_MIN_INTERVAL = 2.0    #seconds, sensor does not respond more often
+DEFAULT_READ_TIME    = 0.025  #seconds, duration of the one wire exchange
+DEFAULT_NO_RESPONSE_RATE = 0.05
+DEFAULT_CHECKSUM_ERROR_RATE = 0.10
+###############################################################################
+class SimDHTLibrary(object):
+    """ provides the functions of the LibDHT shared library; 'read_dht22'
+        accepts the same ctypes arguments and fills in the values by 
+        reference
+    """
+    def __init__(self,
+                 min_interval        = DEFAULT_MIN_INTERVAL,
+                 read_time           = DEFAULT_READ_TIME,
+                 no_response_rate    = DEFAULT_NO_RESPONSE_RATE,
+                 checksum_error_rate = DEFAULT_CHECKSUM_ERROR_RATE,
+                 noise = DEFAULT_NOISE,
+                 seed  = None,
+                ):
+        self.min_interval        = min_interval
+        self.read_time           = read_time
+        self.no_response_rate    = no_response_rate
+        self.checksum_error_rate = checksum_error_rate
+        self.noise   = noise
+        self.sensors = {}
+        self._random = random.Random(seed)
+        self._t0     = time.time()
+        self._last_read = {}
+        
+    def set_sensor(self, pin, humidity, temperature):
+        """ program the sensor on 'pin' with 'humidity' and 'temperature'
+            waveforms, numbers or callables of time
+        """
+        if not callable(humidity):
+            humidity = constant(float(humidity))
+        if not callable(temperature):
+            temperature = constant(float(temperature))
+        self.sensors[pin] = (humidity, temperature)
+        
+    def setupBCM(self):
+        return 0
+        
+    def setupWiring(self):
+        return 0
+        
+    def read_dht22(self, pin, humidity, temperature):
+        pin = getattr(pin, 'value', pin)
+        if self.read_time:
+            time.sleep(self.read_time)
+        now  = time.time()
+        last = self._last_read.get(pin)
+        if not last is None and now - last < self.min_interval:
+            return ERROR_NO_RESPONSE.value
+        roll = self._random.random()
+        if roll < self.no_response_rate:
+            return ERROR_NO_RESPONSE.value
+        self._last_read[pin] = now
+        if roll < self.no_response_rate + self.checksum_error_rate:
+            return ERROR_BAD_DATA_CHECKSUM.value
+        if not pin in self.sensors:
+            self.set_sensor(pin, DEFAULT_HUMIDITY, DEFAULT_TEMPERATURE)
+        H_wave, T_wave = self.sensors[pin]
+        t = now - self._t0
+        H = H_wave(t) + self._random.gauss(0.0, self.noise)
+        T = T_wave(t) + self._random.gauss(0.0, self.noise)
+        #the sensor reports tenths
+        humidity._obj.value    = round(min(max(H, 0.0), 100.0), 1)
+        temperature._obj.value = round(T, 1)
+        return 0
@@ -0,0 +1,190 @@
+"""
+ sim.mcp3008.py
+ 
+ Pin-level emulation of the MCP3008 8-Channel 10-Bit A/D Converter's SPI 
+ protocol: the start bit, SGL/DIFF and D2..D0 bits are decoded from MOSI on
+ rising clock edges, then the null bit and B9..B0 (followed by B1..B9 LSB 
+ first) are driven onto MISO on falling clock edges.  The analog inputs are
+ programmable per channel waveforms of time plus gaussian noise.
+"""
+import time, math, random
+
+DEFAULT_VREF  = 3.3
+DEFAULT_NOISE = 0.002  #volts, standard deviation
+NUM_CHANNELS  = 8
+BIT_RESOLUTION = 10
+###############################################################################
+# waveforms, callables of the time in seconds returning volts
+###############################################################################
+def constant(volts):
+    return lambda t: volts
+    
+def sine(offset, amplitude, period, phase = 0.0):
+    omega = 2*math.pi/period
+    return lambda t: offset + amplitude*math.sin(omega*t + phase)
+    
+def square(low, high, period):
+    return lambda t: high if (t % period) < period/2.0 else low
+
+def default_waveform(chan, vref = DEFAULT_VREF):
+    """ slow sinusoids about mid-scale with increasing amplitude and period
+    """
+    return sine(offset    = 0.5*vref, 
+                amplitude = 0.05*vref*(chan + 1), 
+                period    = 10.0*(chan + 1),
+               )
+
+###############################################################################
+class SimMCP3008(object):
+    """ emulates an MCP3008 wired to the clock, MOSI, MISO and chip select
+        pins; use 'connect' to attach it to a simulated GPIO module or 
+        'respond' to answer whole frames (see 'sim.spidev.FakeSpiDevFile')
+    """
+    def __init__(self, clockpin = None, mosipin = None, misopin = None, cspin = None,
+                 vref  = DEFAULT_VREF,
+                 noise = DEFAULT_NOISE,
+                 waveforms = None,
+                 seed  = None,
+                ):
+        self.pins  = (clockpin, mosipin, misopin, cspin)
+        self.vref  = float(vref)
+        self.waveforms = {}
+        self.noise     = {}
+        for chan in range(NUM_CHANNELS):
+            self.set_channel(chan, default_waveform(chan, self.vref), noise)
+        if not waveforms is None:
+            for chan, waveform in waveforms.items():
+                self.set_channel(chan, waveform, noise)
+        self._random = random.Random(seed)
+        self._t0     = time.time()
+        self.conversions = 0
+        #pin states
+        self._clock  = 0
+        self._mosi   = 0
+        self._select = False
+        self._reset()
+        
+    def set_channel(self, chan, waveform, noise = DEFAULT_NOISE):
+        """ program the input of 'chan' as 'waveform', a number (volts) or a
+            callable of time returning volts, with gaussian 'noise'
+        """
+        if not callable(waveform):
+            waveform = constant(float(waveform))
+        self.waveforms[chan] = waveform
+        self.noise[chan]     = noise
+        
+    def voltage(self, chan, t = None):
+        """ the simulated input voltage of 'chan' at time 't'
+        """
+        if t is None:
+            t = time.time() - self._t0
+        V = self.waveforms[chan](t)
+        sigma = self.noise[chan]
+        if sigma:
+            V += self._random.gauss(0.0, sigma)
+        return V
+        
+    def convert(self, chan, single_ended = True):
+        """ the 10-bit conversion of 'chan', in differential mode the pairs
+            are (IN+ = chan, IN- = chan^1)
+        """
+        self.conversions += 1
+        V = self.voltage(chan)
+        if not single_ended:
+            V -= self.voltage(chan ^ 1)
+        code = int(math.floor(V*2**BIT_RESOLUTION/self.vref))
+        return min(max(code, 0), 2**BIT_RESOLUTION - 1)
+        
+    def connect(self, gpio = None):
+        """ attach to the simulated 'gpio' module (default 'sim.GPIO')
+        """
+        if gpio is None:
+            from sim import GPIO as gpio
+        clockpin, mosipin, misopin, cspin = self.pins
+        gpio.attach(self, listen = (clockpin, mosipin, cspin), drive = (misopin,))
+        return self
+        
+    #---------------------------------------------------------------------------
+    # pin level protocol
+    def drive(self, pin, level):
+        clockpin, mosipin, misopin, cspin = self.pins
+        if pin == cspin:
+            self._select = not level
+            self._reset()
+        elif pin == mosipin:
+            self._mosi = level
+        elif pin == clockpin:
+            self._clock = level
+            if self._select:
+                if level:
+                    self._rising_edge()
+                else:
+                    self._falling_edge()
+                    
+    def sense(self, pin):
+        if pin == self.pins[2] and self._select:
+            return self._dout
+        return None  #high impedance
+        
+    def _reset(self):
+        self._started = False
+        self._count   = 0     #clocks since the start bit
+        self._config  = []    #SGL/DIFF, D2, D1, D0
+        self._value   = 0
+        self._dout    = None
+        
+    def _rising_edge(self):
+        if not self._started:
+            #leading zeros are ignored until the start bit
+            if self._mosi:
+                self._started = True
+            return
+        self._count += 1
+        if self._count <= 4:
+            self._config.append(self._mosi)
+            if self._count == 4:
+                sgl, d2, d1, d0 = self._config
+                self._value = self.convert((d2 << 2) | (d1 << 1) | d0, 
+                                           single_ended = bool(sgl))
+                
+    def _falling_edge(self):
+        count = self._count
+        if   count < 5:
+            return
+        elif count == 5:
+            self._dout = 0                                   #null bit
+        elif count <= 15:
+            self._dout = (self._value >> (15 - count)) & 1   #B9..B0
+        elif count <= 24:
+            self._dout = (self._value >> (count - 15)) & 1   #B1..B9
+        else:
+            self._dout = 0
+            
+    #---------------------------------------------------------------------------
+    # frame level protocol
+    def respond(self, bytes_out):
+        """ clock a whole frame (one chip select cycle) through the pin level
+            protocol and return the bytes driven on MISO
+        """
+        self._select = True
+        self._reset()
+        bytes_in = bytearray(len(bytes_out))
+        for index, out_byte in enumerate(bytearray(bytes_out)):
+            inp_byte = 0
+            for i in range(7,-1,-1):
+                self._mosi = (out_byte >> i) & 1
+                self._clock_edge(1)
+                if self._dout:
+                    inp_byte |= 1 << i
+                self._clock_edge(0)
+            bytes_in[index] = inp_byte
+        self._select = False
+        self._reset()
+        return bytes_in
+        
+    def _clock_edge(self, level):
+        self._clock = level
+        if level:
+            self._rising_edge()
+        else:
+            self._falling_edge()
@@ -0,0 +1,125 @@
+"""
+ sim.spidev.py
+ 
+ Stand-in for an open '/dev/spidevX.Y' character device which decodes the
+ spidev ioctl requests issued by 'comm_spi.CommSPI' and answers each 
+ transfer segment through a 'responder' callable.
+"""
+import time
+from ctypes import sizeof, string_at, memmove
+
+from comm_spi import spi_ioc_transfer, SPI_IOC_MESSAGE, SPI_IOC_WR_MODE,\
+                     SPI_IOC_WR_BITS_PER_WORD, SPI_IOC_WR_MAX_SPEED_HZ,\
+                     _IOC_SIZESHIFT, _IOC_SIZEBITS
+
+_IOC_SIZEMASK = ((1 << _IOC_SIZEBITS) - 1) << _IOC_SIZESHIFT
+###############################################################################
+def mcp3008_responder(values):
+    """ build a responder emulating an MCP3008, 'values' maps the channel 
+        number to the raw count it should return (single-ended or 
+        differential)
+    """
+    def respond(bytes_out):
+        #command byte is (sgl/diff,D2,D1,D0,X,X,X,X), following the start bit
+        if len(bytes_out) != 3 or not (bytes_out[0] & 0x01):
+            return bytearray(len(bytes_out))
+        chan = (bytes_out[1] >> 4) & 0b111
+        val  = values.get(chan, 0)
+        return bytearray((0, (val >> 8) & 0b11, val & 0xFF))
+    return respond
+
+###############################################################################
+class FakeSpiDevFile(object):
+    """ emulates the spidev driver: records the configured mode, word size
+        and clock speed, and the number of segments in each SPI_IOC_MESSAGE
+        so that the batching can be checked; if 'realtime' is set each
+        message takes as long as clocking its bits at the segment speeds
+    """
+    def __init__(self, responder = None, realtime = False):
+        if responder is None:
+            responder = lambda bytes_out: bytearray(len(bytes_out))
+        self.responder     = responder
+        self.realtime      = realtime
+        self.mode          = None
+        self.bits_per_word = None
+        self.max_speed_hz  = None
+        self.messages      = [] #number of segments for each kernel call
+        self.closed        = False
+        
+    def ioctl(self, request, arg):
+        if self.closed:
+            raise IOError("device is closed")
+        if   request == SPI_IOC_WR_MODE:
+            self.mode = arg.value
+        elif request == SPI_IOC_WR_BITS_PER_WORD:
+            self.bits_per_word = arg.value
+        elif request == SPI_IOC_WR_MAX_SPEED_HZ:
+            self.max_speed_hz = arg.value
+        elif request & ~_IOC_SIZEMASK == SPI_IOC_MESSAGE(0):
+            size = (request & _IOC_SIZEMASK) >> _IOC_SIZESHIFT
+            num  = size // sizeof(spi_ioc_transfer)
+            xfers = (spi_ioc_transfer*num).from_buffer(arg)
+            self._run_message(xfers)
+        else:
+            raise IOError(25, "Inappropriate ioctl for device")
+        return 0
+            
+    def _run_message(self, xfers):
+        duration = 0.0
+        for index, xfer in enumerate(xfers):
+            if xfer.speed_hz > self.max_speed_hz:
+                raise IOError("segment speed exceeds the maximum")
+            if xfer.cs_change and index == len(xfers) - 1:
+                raise IOError("chip select left active after the message")
+            bytes_out = bytearray(string_at(xfer.tx_buf, xfer.len))
+            bytes_in  = bytearray(self.responder(bytes_out))
+            memmove(xfer.rx_buf, str(bytes_in), xfer.len)
+            duration += 8.0*xfer.len/(xfer.speed_hz or self.max_speed_hz)
+        if self.realtime:
+            time.sleep(duration)
+        self.messages.append(len(xfers))
+        
+    def close(self):
+        self.closed = True
+
+###############################################################################
+# TEST CODE
+###############################################################################
+if __name__ == "__main__":
+    from comm_spi import CommSPI, SPI_MAX_TRANSFERS_PER_MESSAGE
+    from mcp3008adc import MCP3008ADC
+    
+    values = dict((chan, 100*chan + 7) for chan in range(8))
+    dev = FakeSpiDevFile(responder = mcp3008_responder(values))
+    adc = MCP3008ADC()
+    adc.setup_hardware_spi(dev, speed_hz = 500000)
+    assert dev.mode == 0 and dev.bits_per_word == 8 and dev.max_speed_hz == 500000
+    #single transactions
+    for chan in range(8):
+        assert adc.read_raw(chan) == values[chan]
+    assert dev.messages == [1]*8
+    #the pin level MCP3008 model answers the same frames
+    from sim.mcp3008 import SimMCP3008
+    volts = dict((chan, 0.4*chan + 0.05) for chan in range(8))
+    sim_adc = SimMCP3008(waveforms = volts, noise = 0.0)
+    adc.setup_hardware_spi(FakeSpiDevFile(responder = sim_adc.respond))
+    plan = adc.make_plan(range(8))
+    expected = [min(int(volts[chan]*1024/sim_adc.vref), 1023) for chan in range(8)]
+    assert adc.read_many(plan, 2).tolist() == [expected]*2
+    adc.setup_hardware_spi(dev, speed_hz = 500000)
+    #a block of channel scans is a single kernel call
+    del dev.messages[:]
+    channels = range(8)
+    plan = adc.make_plan(channels)
+    raw_vals = adc.read_many(plan, 10)
+    assert raw_vals.shape == (10, 8)
+    assert (raw_vals == [values[chan] for chan in channels]).all()
+    assert dev.messages == [80]
+    #large blocks are split by the byte budget and the ioctl size field
+    del dev.messages[:]
+    volts = adc.scan(plan, 500)
+    assert abs(volts - [values[chan]*adc.scale for chan in channels]).max() < 1e-12
+    assert sum(dev.messages) == 4000
+    assert max(dev.messages) <= min(4096//3, SPI_MAX_TRANSFERS_PER_MESSAGE)
+    print "kernel calls per 4000 transactions: %d" % len(dev.messages)
+    print "all tests passed"
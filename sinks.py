@@ -0,0 +1,402 @@
+""" Fan-out of a single acquisition to several outputs ("sinks"), so that the
+    hardware is read once per sample however many consumers there are.
+
+    A sink is any object with the writer interface of 'adcsampler.py':
+        write_header(metadata, columns), write_records(block),
+        write_trailer(stats), flush(), close()
+    and optionally 'stats()' (and 'drain()'), e.g. 'csvdata.CSVWriter',
+    'bindata.BinaryWriter', 'ThingspeakSink', 'StoreSink' or 'SocketSink'.
+    A sink that
+    may block (disk, network) gets its own buffering and thread by wrapping
+    it in a 'writerthread.ThreadedWriter'.
+"""
+################################################################################
+import os, errno, socket, StringIO
+from collections import OrderedDict
+import numpy as np
+
+from csvdata import CSVWriter, DEFAULT_PRECISION
+from thingspeak import DEFAULT_MIN_INTERVAL
+
+DEFAULT_CLOSE_TIMEOUT = 10.0 #seconds to try to upload the pending readings on close
+THINGSPEAK_FIELDS     = ["field%d" % i for i in range(1, 9)]
+################################################################################
+class FanOut(object):
+    """ forwards the writer calls to the 'primary' writer and then to each
+        of the named 'sinks', a sequence of (name, sink); the statistics of
+        the sinks are prefixed with their names
+    """
+    def __init__(self, primary, sinks = ()):
+        self.primary = primary
+        self.sinks   = list(sinks)
+        self._all    = [primary] + [sink for name, sink in self.sinks]
+
+    @property
+    def columns(self):
+        return self.primary.columns
+
+    @property
+    def depth(self):
+        """ queued blocks of the primary writer
+        """
+        return getattr(self.primary, 'depth', 0)
+
+    def write_header(self, metadata, columns):
+        for sink in self._all:
+            sink.write_header(metadata, columns)
+
+    def write_records(self, block):
+        for sink in self._all:
+            sink.write_records(block)
+
+    def write_trailer(self, stats):
+        for sink in self._all:
+            sink.write_trailer(stats)
+
+    def flush(self):
+        for sink in self._all:
+            sink.flush()
+
+    def drain(self):
+        for sink in self._all:
+            if hasattr(sink, 'drain'):
+                sink.drain()
+
+    def stats(self):
+        result = OrderedDict()
+        if hasattr(self.primary, 'stats'):
+            result.update(self.primary.stats())
+        for name, sink in self.sinks:
+            if hasattr(sink, 'stats'):
+                for key, val in sink.stats().items():
+                    result["%s_%s" % (name, key)] = val
+        return result
+
+    def close(self):
+        for sink in self._all:
+            sink.close()
+
+################################################################################
+class ThingspeakSink(object):
+    """ posts the mean of the records of each 'period' seconds (of sample
+        time) to a 'thingspeak.ThingspeakUploader', 'fields' maps column
+        names to the channel's fields, by default "chan..." columns in order
+        to "field1"..."field8"
+    """
+    def __init__(self, uploader,
+                 fields        = None,
+                 period        = DEFAULT_MIN_INTERVAL,
+                 close_timeout = DEFAULT_CLOSE_TIMEOUT,
+                ):
+        self.uploader      = uploader
+        self.fields        = fields
+        self.period        = float(period)
+        self.close_timeout = close_timeout
+        self.columns       = None
+        self.posts         = 0
+
+    def write_header(self, metadata, columns):
+        self.columns = list(columns)
+        fields = self.fields
+        if fields is None:
+            names  = [name for name in self.columns if name.startswith("chan") and not name.endswith("_err")]
+            fields = OrderedDict(zip(names, THINGSPEAK_FIELDS))
+        self._indices = [self.columns.index(name) for name in fields]
+        self._keys    = list(fields.values())
+        self._t0      = metadata.get('start_timestamp', 0.0)
+        self._reset(None)
+
+    def write_records(self, block):
+        n = len(block)
+        if n == 0:
+            return
+        if self._t_begin is None:
+            self._reset(block[0,0])
+        #split the block at the ends of the periods
+        t_samp = block[:,0]
+        start = 0
+        while start < n:
+            t_end = self._t_begin + self.period
+            stop  = start + int(np.searchsorted(t_samp[start:], t_end))
+            if stop > start:
+                self._sums  += block[start:stop][:,[0] + self._indices].sum(axis = 0)
+                self._count += stop - start
+            if stop == n:
+                break
+            self._post()
+            self._reset(t_end + self.period*((t_samp[stop] - t_end)//self.period))
+            start = stop
+
+    def write_trailer(self, stats):
+        pass
+
+    def flush(self):
+        self.uploader.pump()
+
+    def stats(self):
+        result = OrderedDict()
+        result['posts'] = self.posts
+        result.update(self.uploader.stats())
+        return result
+
+    def close(self):
+        #the last, partial period
+        if not self.columns is None and self._count > 0:
+            self._post()
+        self.uploader.flush(timeout = self.close_timeout)
+        self.uploader.close()
+
+    def _reset(self, t_begin):
+        self._t_begin = t_begin
+        self._sums    = np.zeros(1 + len(self._indices))
+        self._count   = 0
+
+    def _post(self):
+        if self._count == 0:
+            return
+        means = self._sums/self._count
+        fields = dict(zip(self._keys, means[1:].tolist()))
+        self.uploader.post(timestamp = self._t0 + means[0], **fields)
+        self.posts += 1
+
+################################################################################
+class StoreSink(object):
+    """ inserts the records into a 'tsstore.TimeSeriesStore', one series per
+        "chan..." column (not the errors), batched until each 'flush'
+    """
+    def __init__(self, store):
+        self.store   = store
+        self.columns = None
+        self.records_stored = 0
+        self._blocks = []
+
+    def write_header(self, metadata, columns):
+        self._store_blocks()
+        self.columns  = list(columns)
+        self._indices = [index for index, name in enumerate(self.columns)
+                         if name.startswith("chan") and not name.endswith("_err")]
+        self._t0      = metadata.get('start_timestamp', 0.0)
+
+    def write_records(self, block):
+        if len(block) > 0:
+            self._blocks.append(np.array(block[:,[0] + self._indices]))
+
+    def write_trailer(self, stats):
+        pass
+
+    def flush(self):
+        self._store_blocks()
+
+    def stats(self):
+        result = OrderedDict()
+        result['records_stored'] = self.records_stored
+        return result
+
+    def close(self):
+        self._store_blocks()
+        self.store.close()
+
+    def _store_blocks(self):
+        if not self._blocks:
+            return
+        records = np.concatenate(self._blocks)
+        self._blocks = []
+        columns = OrderedDict((self.columns[index], records[:,i + 1])
+                              for i, index in enumerate(self._indices))
+        self.store.insert(self._t0 + records[:,0], columns)
+        self.records_stored += len(records)
+
+################################################################################
+class _Broadcaster(object):
+    """ file-like server of a UNIX stream socket at 'path', sending what is
+        written to every connected client; a new client first receives the
+        'header', a client which cannot keep up is disconnected rather than
+        slowing down the acquisition
+    """
+    def __init__(self, path):
+        self.path   = path
+        self.header = ""
+        self.clients         = []
+        self.clients_dropped = 0
+        self.bytes_sent      = 0
+        if os.path.exists(path):
+            os.remove(path) #stale socket of a previous run
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen(5)
+        self._server.setblocking(False)
+
+    def accept(self):
+        while True:
+            try:
+                client, address = self._server.accept()
+            except socket.error, error:
+                if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            client.setblocking(False)
+            self.clients.append(client)
+            if self.header:
+                self._send(client, self.header)
+
+    def begin(self, header):
+        """ start a session with 'header', sent to the current and the
+            future clients
+        """
+        self.accept()
+        self.header = header
+        for client in list(self.clients):
+            self._send(client, header)
+
+    def write(self, data):
+        self.accept()
+        for client in list(self.clients):
+            self._send(client, data)
+
+    def flush(self):
+        self.accept()
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+        self.clients = []
+        self._server.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _send(self, client, data):
+        try:
+            sent = client.send(data)
+        except socket.error:
+            sent = 0
+        self.bytes_sent += sent
+        if sent < len(data):
+            #gone, or fell behind by a whole socket buffer
+            self.clients.remove(client)
+            self.clients_dropped += 1
+            client.close()
+
+class SocketSink(CSVWriter):
+    """ broadcasts the records as CSV text (see 'csvdata.py') to the clients
+        of a UNIX stream socket at 'path', e.g. 'socat - UNIX-CONNECT:path';
+        clients connecting mid-session get the session's header first
+    """
+    def __init__(self, path,
+                 delimiter = ",",
+                 newline   = "\n",
+                 precision = DEFAULT_PRECISION,
+                ):
+        CSVWriter.__init__(self, _Broadcaster(path),
+                           delimiter = delimiter,
+                           newline   = newline,
+                           precision = precision,
+                          )
+
+    def write_header(self, metadata, columns):
+        server = self.output_file
+        buff = self.output_file = StringIO.StringIO()
+        try:
+            CSVWriter.write_header(self, metadata, columns)
+        finally:
+            self.output_file = server
+        server.begin(buff.getvalue())
+
+    def stats(self):
+        server = self.output_file
+        result = OrderedDict()
+        result['clients']         = len(server.clients)
+        result['clients_dropped'] = server.clients_dropped
+        result['bytes_sent']      = server.bytes_sent
+        return result
+
+################################################################################
+# TEST CODE
+################################################################################
+if __name__ == "__main__":
+    import tempfile, shutil
+    from csvdata import read_csv
+    class FakeUploader(object):
+        def __init__(self):
+            self.readings = []
+            self.closed   = False
+        def post(self, timestamp = None, **fields):
+            self.readings.append((timestamp, fields))
+        def pump(self):
+            return 0
+        def flush(self, timeout = None):
+            return True
+        def stats(self):
+            return OrderedDict([('queued', 0), ('sent', len(self.readings))])
+        def close(self):
+            self.closed = True
+    def read_client(client):
+        data = ""
+        while True:
+            try:
+                chunk = client.recv(65536)
+            except socket.error:
+                return data
+            if not chunk:
+                return data
+            data += chunk
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        columns  = ["t_samp", "t_err", "chan0", "chan1"]
+        metadata = OrderedDict([('start_timestamp', 1000.0), ('channels', [0, 1])])
+        t = np.arange(0.0, 100.0, 0.5)
+        records = np.column_stack((t, np.zeros_like(t), t, 2*t))
+        csv_file = StringIO.StringIO()
+        csv_file.close = lambda: None
+        uploader = FakeUploader()
+        sock_path = os.path.join(tmp_dir, "adc.sock")
+        sockets = SocketSink(sock_path)
+        early = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        early.connect(sock_path)
+        from tsstore import TimeSeriesStore
+        store_path = os.path.join(tmp_dir, "store.sqlite")
+        out = FanOut(CSVWriter(csv_file), [("thingspeak", ThingspeakSink(uploader, period = 15.0)),
+                                           ("store"     , StoreSink(TimeSeriesStore(store_path))),
+                                           ("socket"    , sockets),
+                                          ])
+        out.write_header(metadata, columns)
+        for i in range(0, len(records), 7):
+            out.write_records(records[i:i+7])
+            if i == 98:
+                #a client joining mid-session
+                late = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                late.connect(sock_path)
+            out.flush()
+        out.write_trailer(OrderedDict([('samples', len(records))]))
+        stats = out.stats()
+        print stats
+        assert stats['socket_clients'] == 2 and stats['socket_clients_dropped'] == 0
+        out.close()
+        assert uploader.closed
+        #the uploads are the means of each 15 s
+        assert stats['thingspeak_posts'] == 6
+        assert len(uploader.readings) == 7
+        for k, (timestamp, fields) in enumerate(uploader.readings):
+            mean = 15.0*k + 7.25 if k < 6 else 94.75
+            assert timestamp == 1000.0 + mean, (k, timestamp)
+            assert fields == {'field1': mean, 'field2': 2*mean}, fields
+        #every consumer got the same session
+        csv_file.seek(0)
+        (meta, cols, recs), = read_csv(csv_file)
+        assert cols == columns and np.allclose(recs, records)
+        for client in (early, late):
+            client.setblocking(False)
+            (meta, cols, recs), = read_csv(StringIO.StringIO(read_client(client)))
+            assert cols == columns
+            if client is early:
+                assert np.allclose(recs, records)
+            else:
+                assert np.allclose(recs, records[105:])
+        assert not os.path.exists(sock_path)
+        store = TimeSeriesStore(store_path)
+        assert store.series() == ["chan0", "chan1"]
+        resolution, recs = store.query("chan1", 1000.0, 1100.0)
+        assert resolution is None and np.allclose(recs[:,2], records[:,3])
+        store.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+    print "all tests passed"
@@ -3,6 +3,7 @@
 """
 ################################################################################
 import numpy as np
+from oversampling import adaptive_mean, DEFAULT_MIN_SAMPLES
 
 DEFAULT_SAMP_NUM = 100
 T_ABS = -273.15
@@ -10,10 +11,12 @@ T_ABS = -273.15
 class Thermistor(object):
     """ Configure an analog thermistor sensor with voltage divider circuit and 
         ADC.
-        The 'adc' object must provide a method matching "adc.read_raw(chan)",
-        have an attribute 'adc.scale' which converts the raw ADC counts
-        to a voltage value, and an attribute 'adc.vref' which describes the
-        voltage of the highest ADC value.
+        The 'adc' object must provide the methods "adc.make_plan(channels)"
+        and "adc.read_many(plan, n)" (see 'mcp3008adc.MCP3008ADC'), have an 
+        attribute 'adc.scale' which converts the raw ADC counts
+        to a voltage value, an attribute 'adc.vref' which describes the
+        voltage of the highest ADC value, and an attribute 'adc.resolution'
+        which is the highest ADC value.
         
         Calculations:
             If 'V_ref' is the reference voltage, 'V' is the sensed ADC voltage, 
@@ -27,6 +30,21 @@ class Thermistor(object):
                 T_celcius = T_kelvin - 273.15
             where 'R_25C' is the thermsitors nominal resistance at 25 degrees 
             Celcius.
+            
+        Lookup table:
+            The temperature of every possible ADC value is computed once, at
+            construction, into 'table'; whole arrays of raw counts are then
+            converted by indexing and averaged (fractional) counts or voltages
+            by linear interpolation between the entries.  The lowest and 
+            highest values (a shorted or an open thermistor) have no finite
+            temperature and are set to NaN, as is anything interpolated 
+            towards them or beyond the ADC range.
+            
+        Adaptive oversampling:
+            With a temperature 'resolution', 'read_temperature' stops reading
+            once the standard error of the mean count, times the local slope
+            of the table (degrees per count), is within the resolution; the 
+            number of samples used is kept in 'samp_used'.
     """
     def __init__(self, A, B, C, R_25C, R_std, adc, adc_channel):
         self._A = A
@@ -36,16 +54,72 @@ class Thermistor(object):
         self._R_std = R_std
         self.adc = adc
         self.adc_channel = adc_channel
+        self.adc_mode    = 's'
+        self._plan = adc.make_plan([adc_channel])
+        #temperature of every ADC value
+        self.codes = np.arange(adc.resolution + 1)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            V = self.codes*adc.scale
+            self.table = self.temperature(V*R_std/(adc.vref - V))
+        #shorted (code 0) and open (full scale) thermistor
+        self.table[0]  = np.nan
+        self.table[-1] = np.nan
+        self.table[~np.isfinite(self.table)] = np.nan
+        #degrees per count of every ADC value
+        self.slope = np.abs(np.gradient(self.table))
+        self.samp_used = None
         
-    def read_temperature(self, samp_num = DEFAULT_SAMP_NUM):
-        """ read the sensor and convert to temperature
-            'samp_num' - the number of ADC samples to average
+    def temperature(self, R):
+        """ convert the thermistor resistance(s) 'R' to temperature
         """
-        R = self.read_resistance(samp_num = samp_num)
         logR = np.log10(R/self._R_25C)
         T_kelvin = 1000.0/(self._A + self._B*logR + self._C*logR**2)
         return T_kelvin + T_ABS
         
+    def counts_to_temperature(self, counts):
+        """ convert raw ADC counts to temperature by table lookup, integer 
+            arrays are indexed while (fractional) floats are interpolated
+        """
+        counts = np.asarray(counts)
+        if counts.dtype.kind in 'iu':
+            return self.table.take(counts)
+        return np.interp(counts, self.codes, self.table, left = np.nan, right = np.nan)
+        
+    def convert_counts(self, counts):
+        """ sensor interface of 'sensorgroup.SensorGroup'
+        """
+        return self.counts_to_temperature(counts)
+        
+    def voltage_to_temperature(self, V):
+        """ convert (e.g. logged) ADC voltages to temperature by table 
+            interpolation
+        """
+        return self.counts_to_temperature(np.asarray(V, dtype = float)/self.adc.scale)
+        
+    def read_temperature(self, samp_num = DEFAULT_SAMP_NUM, 
+                         resolution = None,
+                         min_samp   = DEFAULT_MIN_SAMPLES,
+                        ):
+        """ read the sensor and convert to temperature
+            'samp_num'   - the number of ADC samples to average, or the most
+                           with a 'resolution'
+            'resolution' - stop sampling once the standard error of the
+                           temperature is within this many degrees, after
+                           at least 'min_samp' samples
+        """
+        if resolution is None:
+            samps = self.adc.read_many(self._plan, samp_num)
+            self.samp_used = samp_num
+            return float(self.counts_to_temperature(samps.mean()))
+        def target(means):
+            #counts of the resolution at the mean, NaN when out of range
+            return resolution/np.interp(means, self.codes, self.slope, left = np.nan, right = np.nan)
+        means, stds, n = adaptive_mean(lambda n: self.adc.read_many(self._plan, n), target,
+                                       min_samples = min(min_samp, samp_num),
+                                       max_samples = samp_num)
+        self.samp_used = n
+        return float(self.counts_to_temperature(means[0]))
+        
     def read_resistance(self, samp_num = DEFAULT_SAMP_NUM):
         """ read the resistance of the thermistor
             'samp_num' - the number of ADC samples to average
@@ -58,10 +132,8 @@ class Thermistor(object):
             'samp_num' - the number of ADC samples to average
         """
         adc  = self.adc
-        chan = self.adc_channel
         #collect samples
-        samps = [adc.read_raw(chan) for i in xrange(samp_num)]
-        samps = np.array(samps)
+        samps = adc.read_many(self._plan, samp_num)
         V = samps.mean()*adc.scale
         return V
         
@@ -70,7 +142,8 @@ class Thermistor(object):
 ################################################################################
 if __name__ == "__main__":
     import time
-    import RPi.GPIO as GPIO
+    import backend
+    GPIO = backend.get_gpio()
     from mcp3008adc import MCP3008ADC  #ADC for sampling
     
     # calibration coeffs for RSBR-302J-Z50 Teflon-Coated 3k Thermistor
@@ -89,6 +162,13 @@ if __name__ == "__main__":
     SPICS   = 25
     PINMODE = GPIO.BCM  #configure the pin order as Broadcom SoC channels
     
+    if backend.is_simulated():
+        from sim.mcp3008 import SimMCP3008
+        SimMCP3008(clockpin = SPICLK,
+                   misopin  = SPIMISO,
+                   mosipin  = SPIMOSI,
+                   cspin    = SPICS,
+                  ).connect(GPIO)
     adc = MCP3008ADC()
     adc.setup_software_spi(clockpin = SPICLK,
                            misopin  = SPIMISO,
@@ -104,6 +184,28 @@ if __name__ == "__main__":
                        adc=adc,
                        adc_channel = ADC_CHANNEL
                        )
+    #the table matches the formula for all finite codes
+    codes = therm.codes[1:-1]
+    V = codes*adc.scale
+    T_formula = therm.temperature(V*R_STD/(adc.vref - V))
+    assert np.allclose(therm.table[1:-1], T_formula)
+    assert np.isnan(therm.counts_to_temperature([0, 1023])).all()
+    assert np.allclose(therm.counts_to_temperature(codes), T_formula)
+    #fractional counts and voltages interpolate between the entries
+    T_mid = therm.counts_to_temperature(511.5)
+    assert min(therm.table[511:513]) <= T_mid <= max(therm.table[511:513])
+    assert np.allclose(therm.voltage_to_temperature(V), T_formula)
+    #vectorized conversion of a large array
+    counts = np.random.randint(1, 1023, size = 1000000).astype(np.uint16)
+    t1 = time.time()
+    therm.counts_to_temperature(counts)
+    t2 = time.time()
+    print "converted %d counts in %0.3f s" % (len(counts), t2 - t1)
+    #adaptive oversampling reads only what the resolution needs
+    T_full  = therm.read_temperature(samp_num = 200)
+    T_adapt = therm.read_temperature(samp_num = 200, resolution = 0.1)
+    print "adaptive: %0.3f with %d samples, fixed: %0.3f with 200" % (T_adapt, therm.samp_used, T_full)
+    assert therm.samp_used < 200 and abs(T_adapt - T_full) < 0.5
     #read thermistor in a loop
     try:
         while True:
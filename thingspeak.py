@@ -0,0 +1,443 @@
+""" Uploading readings to Thingspeak (https://thingspeak.com) channels.
+
+    'ThingspeakChannel' posts single updates over a kept-alive connection.
+
+    'ThingspeakUploader' never loses a reading to the network: each one is
+    appended to a small on-disk journal (JSON lines) first, so the readings
+    survive outages and restarts, and the journal is replayed in batches
+    through the bulk-update endpoint (or one update at a time when no
+    'channel_id' is given) as often as the rate limit allows, backing off
+    exponentially after failures.
+"""
+################################################################################
+import os, time, json, errno, socket, httplib, urllib
+from collections import deque, OrderedDict
+
+from clock import monotonic
+
+#see example at http://australianrobotics.com.au/news/how-to-talk-to-thingspeak-with-python-a-memory-cpu-monitor
+HEADERS      = {"Content-type": "application/x-www-form-urlencoded","Accept":"text/plain"}
+JSON_HEADERS = {"Content-type": "application/json","Accept":"application/json"}
+URL          = "api.thingspeak.com:80"
+
+DEFAULT_TIMEOUT      = 10.0  #seconds
+DEFAULT_BATCH_SIZE   = 960   #readings per bulk update (Thingspeak limit)
+DEFAULT_MIN_INTERVAL = 15.0  #seconds between updates (free account limit)
+DEFAULT_BACKOFF      = 5.0   #seconds after the first failure, doubling
+DEFAULT_MAX_BACKOFF  = 600.0 #seconds
+DEFAULT_MAX_PENDING  = 10000 #readings held in the journal
+OFFSET_SUFFIX        = ".offset"
+RATE_LIMIT_STATUS    = (429, 503)
+#errors of a kept-alive connection which the server closed while it was idle
+STALE_ERRNOS         = (errno.EPIPE, errno.ECONNRESET)
+################################################################################
+class HTTPError(IOError):
+    def __init__(self, status, reason, retry_after = None):
+        IOError.__init__(self, "HTTP %d %s" % (status, reason))
+        self.status      = status
+        self.retry_after = retry_after
+
+class KeepAliveConnection(object):
+    """ HTTP/1.1 connection to 'url' ("host:port") which is reused by the
+        requests and reopened after an error; a request on a reused
+        connection which fails before any response (the server closed the
+        idle socket) is retried once on a new connection
+    """
+    def __init__(self, url = URL, timeout = DEFAULT_TIMEOUT):
+        self.url     = url
+        self.timeout = timeout
+        self.num_connects = 0
+        self.num_retries  = 0
+        self._conn   = None
+
+    def request(self, method, path, body, headers):
+        """ send the request and return (response, data), raising 'HTTPError'
+            for an error status and IOError (or httplib.HTTPException) when
+            the connection fails
+        """
+        reused = not self._conn is None
+        try:
+            response, data = self._send(method, path, body, headers)
+        except (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error), error:
+            stale = not isinstance(error, socket.error) or error.errno in STALE_ERRNOS
+            if not (reused and stale):
+                raise
+            self.num_retries += 1
+            response, data = self._send(method, path, body, headers)
+        if response.getheader("connection", "").lower() == "close":
+            self.close()
+        if response.status >= 300:
+            retry_after = response.getheader("retry-after")
+            if not retry_after is None:
+                try:
+                    retry_after = float(retry_after)
+                except ValueError:
+                    retry_after = None
+            raise HTTPError(response.status, response.reason, retry_after)
+        return response, data
+
+    def close(self):
+        if not self._conn is None:
+            self._conn.close()
+            self._conn = None
+
+    def _send(self, method, path, body, headers):
+        if self._conn is None:
+            self._conn = httplib.HTTPConnection(self.url, timeout = self.timeout)
+            self.num_connects += 1
+        try:
+            self._conn.request(method, path, body, headers)
+            response = self._conn.getresponse()
+            data = response.read()
+        except:
+            self.close()
+            raise
+        return response, data
+
+################################################################################
+class ThingspeakChannel(object):
+    def __init__(self, api_write_key, url = URL):
+        self.api_write_key = api_write_key
+        self._conn = KeepAliveConnection(url)
+
+    def post(self, **fields):
+        """ Post data to the channel.
+            Arguments should be specified as 'field%d', e.g.
+               obj.post(field1='1.0', field2='2.0')
+        """
+        #TODO check that the fields are labelled correctly
+
+        #insert the API key
+        fields['key'] = self.api_write_key
+        #format the post parameters
+        params = urllib.urlencode(fields)
+        return self._conn.request("POST","/update",params, HEADERS)
+
+    def close(self):
+        self._conn.close()
+
+################################################################################
+def format_time(timestamp):
+    """ ISO 8601 UTC time, as accepted for 'created_at'
+    """
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp))
+
+class ThingspeakUploader(object):
+    """ Journaled, batched uploads to a Thingspeak channel: 'post' appends
+        a reading to the journal at 'journal_path' and 'pump' sends what is
+        due; pending readings of a previous run are replayed.
+    """
+    def __init__(self, api_write_key, journal_path,
+                 channel_id   = None,
+                 url          = URL,
+                 timeout      = DEFAULT_TIMEOUT,
+                 batch_size   = DEFAULT_BATCH_SIZE,
+                 min_interval = DEFAULT_MIN_INTERVAL,
+                 backoff      = DEFAULT_BACKOFF,
+                 max_backoff  = DEFAULT_MAX_BACKOFF,
+                 max_pending  = DEFAULT_MAX_PENDING,
+                ):
+        self.api_write_key = api_write_key
+        self.journal_path  = journal_path
+        self.channel_id    = channel_id
+        self.batch_size    = batch_size if not channel_id is None else 1
+        self.min_interval  = min_interval
+        self.backoff       = backoff
+        self.max_backoff   = max_backoff
+        self.max_pending   = max_pending
+        #counters
+        self.sent          = 0  #readings accepted by the server
+        self.failed        = 0  #failed requests
+        self.rate_limited  = 0  #requests refused by the rate limit
+        self.dropped       = 0  #oldest readings discarded over 'max_pending'
+        self._conn         = KeepAliveConnection(url, timeout = timeout)
+        self._failures     = 0  #consecutive failures
+        self._next_attempt = 0.0
+        self._load_journal()
+
+    @property
+    def queued(self):
+        """ number of readings waiting in the journal
+        """
+        return len(self._pending)
+
+    def post(self, timestamp = None, **fields):
+        """ journal a reading of 'fields' ('field1'...'field8', 'status', ...)
+            taken at 'timestamp' (default now) and send what is due
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        entry = OrderedDict()
+        entry['created_at'] = format_time(timestamp)
+        for key in sorted(fields):
+            entry[key] = fields[key]
+        line = json.dumps(entry) + "\n"
+        self._journal.write(line)
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._pending.append((entry, len(line)))
+        if len(self._pending) > self.max_pending:
+            self._commit(1)
+            self.dropped += 1
+        return self.pump()
+
+    def pump(self):
+        """ send the pending readings that the rate limit and the backoff
+            allow now, returning the number of readings sent
+        """
+        num_sent = 0
+        while self._pending and monotonic() >= self._next_attempt:
+            num = self._send_batch()
+            if num == 0:
+                break
+            num_sent += num
+        return num_sent
+
+    def flush(self, timeout = None):
+        """ try to send all pending readings within 'timeout' seconds,
+            returning whether the journal is empty
+        """
+        t_end = None if timeout is None else monotonic() + timeout
+        while self._pending:
+            wait = max(self._next_attempt - monotonic(), 0.0)
+            if not t_end is None and monotonic() + wait > t_end:
+                break
+            time.sleep(wait)
+            self._send_batch()
+        return not self._pending
+
+    def stats(self):
+        result = OrderedDict()
+        result['queued']       = self.queued
+        result['sent']         = self.sent
+        result['failed']       = self.failed
+        result['rate_limited'] = self.rate_limited
+        result['dropped']      = self.dropped
+        result['connects']     = self._conn.num_connects
+        result['retries']      = self._conn.num_retries
+        return result
+
+    def close(self):
+        self._conn.close()
+        self._journal.close()
+
+    #---------------------------------------------------------------------------
+    def _send_batch(self):
+        batch = [entry for entry, size in list(self._pending)[:self.batch_size]]
+        try:
+            if self.channel_id is None:
+                fields = dict(batch[0])
+                fields['key'] = self.api_write_key
+                self._conn.request("POST", "/update", urllib.urlencode(fields), HEADERS)
+            else:
+                body = json.dumps({'write_api_key': self.api_write_key,
+                                   'updates'      : batch})
+                self._conn.request("POST", "/channels/%s/bulk_update.json" % self.channel_id,
+                                   body, JSON_HEADERS)
+        except HTTPError, error:
+            if error.status in RATE_LIMIT_STATUS:
+                self.rate_limited += 1
+                delay = error.retry_after
+                if delay is None:
+                    delay = self.min_interval
+                self._next_attempt = monotonic() + max(delay, self.min_interval)
+            else:
+                self._fail()
+            return 0
+        except (IOError, socket.error, httplib.HTTPException):
+            self._fail()
+            return 0
+        self._failures = 0
+        self._next_attempt = monotonic() + self.min_interval
+        self._commit(len(batch))
+        self.sent += len(batch)
+        return len(batch)
+
+    def _fail(self):
+        self.failed    += 1
+        self._failures += 1
+        delay = min(self.backoff*2**(self._failures - 1), self.max_backoff)
+        self._next_attempt = monotonic() + delay
+
+    def _load_journal(self):
+        """ open the journal and read the readings after the sent offset
+        """
+        offset = 0
+        try:
+            with open(self.journal_path + OFFSET_SUFFIX) as f:
+                offset = int(f.read().strip() or 0)
+        except IOError:
+            pass
+        self._pending = deque()
+        if os.path.isfile(self.journal_path):
+            if offset > os.path.getsize(self.journal_path):
+                offset = 0 #the journal was truncated after everything was sent
+            with open(self.journal_path, 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith("\n"):
+                        break #unfinished write
+                    self._pending.append((json.loads(line, object_pairs_hook = OrderedDict), len(line)))
+        self._offset  = offset
+        self._journal = open(self.journal_path, 'ab')
+        #drop an unfinished line
+        end = offset + sum(size for entry, size in self._pending)
+        if self._journal.tell() > end:
+            self._journal.truncate(end)
+            self._journal.seek(end)
+
+    def _commit(self, num):
+        """ remove the 'num' oldest readings from the journal
+        """
+        for i in range(num):
+            entry, size = self._pending.popleft()
+            self._offset += size
+        if not self._pending:
+            #everything is sent, start the journal over
+            self._journal.truncate(0)
+            self._journal.seek(0)
+            self._offset = 0
+        tmp_path = self.journal_path + OFFSET_SUFFIX + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write("%d\n" % self._offset)
+        os.rename(tmp_path, self.journal_path + OFFSET_SUFFIX)
+
+################################################################################
+# TEST CODE
+################################################################################
+if __name__ == "__main__":
+    import threading, tempfile, shutil, urlparse
+    import BaseHTTPServer
+
+    class StandIn(object):
+        """ local stand-in for the Thingspeak server, answering with the
+            queued 'responses' (status, headers) and then 202
+        """
+        def __init__(self):
+            self.requests  = []
+            self.responses = []
+            self.connections = 0
+            self.drop_idle   = False
+            stand_in = self
+            class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+                protocol_version = "HTTP/1.1"
+                def setup(self):
+                    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                    stand_in.connections += 1
+                def do_POST(self):
+                    body = self.rfile.read(int(self.headers['content-length']))
+                    status, headers = 202, {}
+                    if stand_in.responses:
+                        status, headers = stand_in.responses.pop(0)
+                    if status is None: #drop the connection
+                        self.close_connection = 1
+                        return
+                    if stand_in.drop_idle:
+                        #close after answering, without 'Connection: close'
+                        self.close_connection = 1
+                    if status < 300:
+                        stand_in.requests.append((self.path, body))
+                    data = '{"success":true}' if status < 300 else "error"
+                    self.send_response(status)
+                    for key, val in headers.items():
+                        self.send_header(key, val)
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                def log_message(self, *args):
+                    pass
+            self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+            self.url = "127.0.0.1:%d" % self.server.server_address[1]
+            thread = threading.Thread(target = self.server.serve_forever)
+            thread.daemon = True
+            thread.start()
+        def readings(self):
+            result = []
+            for path, body in self.requests:
+                if path.endswith("bulk_update.json"):
+                    result += json.loads(body)['updates']
+                else:
+                    result.append(dict((k, v[0]) for k, v in urlparse.parse_qs(body).items()))
+            return result
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        journal = os.path.join(tmp_dir, "thingspeak.journal")
+        server = StandIn()
+        options = dict(channel_id = 1234, url = server.url, timeout = 1.0,
+                       min_interval = 0.0, backoff = 0.05, max_backoff = 0.2)
+        #bulk uploads over one kept-alive connection
+        up = ThingspeakUploader("KEY", journal, batch_size = 3, **options)
+        for i in range(5):
+            up.post(timestamp = 1e9 + i, field1 = i)
+        assert up.sent == 5 and up.queued == 0, up.stats()
+        assert server.connections == 1 and up.stats()['connects'] == 1
+        assert [r['field1'] for r in server.readings()] == range(5)
+        assert os.path.getsize(journal) == 0
+        #outage: readings stay journaled and survive a restart
+        server.responses = [(500, {})]*3 + [(None, {})]
+        up.post(timestamp = 1e9 + 5, field1 = 5)
+        up.post(timestamp = 1e9 + 6, field1 = 6)
+        assert up.queued == 2 and up.failed >= 1, up.stats()
+        up.close()
+        up = ThingspeakUploader("KEY", journal, **options)
+        assert up.queued == 2
+        assert up.flush(timeout = 5.0), up.stats()
+        assert [r['field1'] for r in server.readings()] == range(7)
+        assert not server.responses
+        #rate limit with Retry-After
+        server.responses = [(429, {"Retry-After": "0.2"})]
+        t1 = monotonic()
+        up.post(timestamp = 1e9 + 7, field1 = 7)
+        assert up.rate_limited == 1 and up.queued == 1
+        assert up.pump() == 0 #not due yet
+        assert up.flush(timeout = 5.0)
+        assert monotonic() - t1 >= 0.2
+        print "bulk:", up.stats()
+        up.close()
+        #single updates without a channel id
+        os.remove(journal)
+        server.requests = []
+        up = ThingspeakUploader("KEY", journal, url = server.url, min_interval = 0.0)
+        up.post(field1 = 1.5, field2 = 2.5)
+        path, body = server.requests[0]
+        assert path == "/update" and urlparse.parse_qs(body)['key'] == ["KEY"]
+        print "single:", up.stats()
+        up.close()
+        #keep-alive channel
+        channel = ThingspeakChannel("KEY", url = server.url)
+        connections = server.connections
+        for i in range(3):
+            channel.post(field1 = i)
+        assert server.connections == connections + 1
+        channel.close()
+        #a server dropping the idle connections, the requests on the stale
+        #connection are retried once on a new one
+        server.drop_idle = True
+        server.requests = []
+        os.remove(journal)
+        up = ThingspeakUploader("KEY", journal, url = server.url, min_interval = 0.0)
+        for i in range(4):
+            up.post(field1 = i)
+            time.sleep(0.05) #let the server close the socket
+        stats = up.stats()
+        print "dropped idle:", stats
+        assert stats['sent'] == 4 and stats['failed'] == 0 and stats['queued'] == 0
+        assert stats['retries'] == 3 and stats['connects'] == 4
+        assert [r['field1'] for r in server.readings()] == ["0", "1", "2", "3"]
+        up.close()
+        #a fresh connection which fails is not retried
+        channel = ThingspeakChannel("KEY", url = server.url)
+        server.responses = [(None, {})]
+        try:
+            channel.post(field1 = 0)
+        except httplib.BadStatusLine:
+            pass
+        else:
+            raise AssertionError("expected the error of the fresh connection")
+        assert channel._conn.num_retries == 0
+        channel.close()
+        server.drop_idle = False
+    finally:
+        shutil.rmtree(tmp_dir)
+    print "all tests passed"
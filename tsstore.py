@@ -0,0 +1,197 @@
+""" Local time-series store in an SQLite database: the raw samples of each
+    named series (e.g. "chan0", "soil_temperature") are kept along with
+    rollup tables of their count/sum/min/max per minute, hour and day (see
+    'RESOLUTIONS'), which are updated incrementally with every batch that
+    is inserted, so that queries over long ranges never rescan the raw data.
+
+    'query' picks the finest resolution whose number of points over the
+    requested range fits the point budget.  Times are seconds since the
+    epoch (UTC), the rollup buckets are aligned to multiples of their
+    resolution.
+"""
+################################################################################
+import sqlite3
+from collections import OrderedDict
+import numpy as np
+
+RESOLUTIONS = (60, 3600, 86400)  #seconds per bucket of the rollup tables
+DEFAULT_MAX_POINTS = 1000
+################################################################################
+class TimeSeriesStore(object):
+    """ series, raw samples and their rollups in the database at 'path'
+        (created if needed); the connection may be used from another thread
+        than the one which opened it, but from only one at a time
+    """
+    def __init__(self, path, resolutions = RESOLUTIONS):
+        self.path        = path
+        self.resolutions = tuple(sorted(resolutions))
+        self._db = sqlite3.connect(path, check_same_thread = False)
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = NORMAL")
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS series "
+                             "(id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS samples "
+                             "(series INTEGER NOT NULL, t REAL NOT NULL, value REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS samples_series_t ON samples (series, t)")
+            for res in self.resolutions:
+                self._db.execute("CREATE TABLE IF NOT EXISTS rollup_%d "
+                                 "(series INTEGER NOT NULL, bucket INTEGER NOT NULL, "
+                                 "count INTEGER, sum REAL, min REAL, max REAL, "
+                                 "PRIMARY KEY (series, bucket))" % res)
+        self._ids = dict((name, id) for id, name in self._db.execute("SELECT id, name FROM series"))
+
+    def series(self):
+        """ names of the stored series
+        """
+        return sorted(self._ids)
+
+    def insert(self, times, columns):
+        """ insert the samples taken at 'times' of the series in 'columns',
+            a mapping of names to arrays of values matching 'times', and
+            update the rollups, all in one transaction; NaN values are
+            skipped
+        """
+        times = np.asarray(times, dtype = float)
+        with self._db:
+            for name, values in columns.items():
+                values = np.asarray(values, dtype = float)
+                keep = np.isfinite(values)
+                if not keep.all():
+                    t, values = times[keep], values[keep]
+                else:
+                    t = times
+                if len(t) == 0:
+                    continue
+                id = self._series_id(name)
+                self._db.executemany("INSERT INTO samples (series, t, value) VALUES (?, ?, ?)",
+                                     zip([id]*len(t), t.tolist(), values.tolist()))
+                for res in self.resolutions:
+                    self._update_rollup(res, id, t, values)
+
+    def insert_point(self, timestamp, **values):
+        """ insert a single sample of each series in 'values'
+        """
+        self.insert([timestamp], dict((name, [val]) for name, val in values.items()))
+
+    def query(self, name, t_start, t_end, max_points = DEFAULT_MAX_POINTS):
+        """ get the samples of the series 'name' in [t_start, t_end) at the
+            finest resolution giving at most 'max_points' points (the
+            coarsest if none does), returning (resolution, records) where
+            resolution is None for the raw samples and 'records' has the
+            columns (t, count, mean, min, max), 't' being the start of the
+            bucket
+        """
+        id = self._ids.get(name)
+        if id is None:
+            raise KeyError, "no series '%s' in the store" % name
+        resolution = None
+        #only count the raw samples up to the budget
+        num = self._db.execute("SELECT COUNT(*) FROM (SELECT 1 FROM samples "
+                               "WHERE series = ? AND t >= ? AND t < ? LIMIT ?)",
+                               (id, t_start, t_end, max_points + 1)).fetchone()[0]
+        if num > max_points:
+            for res in self.resolutions:
+                resolution = res
+                if (t_end - t_start)/float(res) <= max_points:
+                    break
+        if resolution is None:
+            rows = self._db.execute("SELECT t, 1, value, value, value FROM samples "
+                                    "WHERE series = ? AND t >= ? AND t < ? ORDER BY t",
+                                    (id, t_start, t_end)).fetchall()
+        else:
+            first = int(np.floor(t_start/float(resolution)))
+            last  = int(np.ceil(t_end/float(resolution)))
+            rows = self._db.execute("SELECT bucket*%d, count, sum/count, min, max FROM rollup_%d "
+                                    "WHERE series = ? AND bucket >= ? AND bucket < ? ORDER BY bucket"
+                                    % (resolution, resolution), (id, first, last)).fetchall()
+        return resolution, np.array(rows, dtype = float).reshape((len(rows), 5))
+
+    def close(self):
+        self._db.close()
+
+    #---------------------------------------------------------------------------
+    def _series_id(self, name):
+        id = self._ids.get(name)
+        if id is None:
+            id = self._db.execute("INSERT INTO series (name) VALUES (?)", (name,)).lastrowid
+            self._ids[name] = id
+        return id
+
+    def _update_rollup(self, res, id, t, values):
+        """ merge the aggregates of the 'values' per bucket into the rollup
+        """
+        buckets, inverse = np.unique(np.floor(t/res).astype(np.int64), return_inverse = True)
+        counts = np.bincount(inverse)
+        sums   = np.bincount(inverse, weights = values)
+        mins   = np.full(len(buckets),  np.inf)
+        maxs   = np.full(len(buckets), -np.inf)
+        np.minimum.at(mins, inverse, values)
+        np.maximum.at(maxs, inverse, values)
+        table = "rollup_%d" % res
+        self._db.executemany("INSERT OR IGNORE INTO %s (series, bucket, count, sum, min, max) "
+                             "VALUES (?, ?, 0, 0.0, ?, ?)" % table,
+                             zip([id]*len(buckets), buckets.tolist(), mins.tolist(), maxs.tolist()))
+        self._db.executemany("UPDATE %s SET count = count + ?, sum = sum + ?, "
+                             "min = MIN(min, ?), max = MAX(max, ?) "
+                             "WHERE series = ? AND bucket = ?" % table,
+                             zip(counts.tolist(), sums.tolist(), mins.tolist(), maxs.tolist(),
+                                 [id]*len(buckets), buckets.tolist()))
+
+################################################################################
+# TEST CODE
+################################################################################
+if __name__ == "__main__":
+    import os, time, tempfile, shutil
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "store.sqlite")
+        store = TimeSeriesStore(path)
+        #two days of 1 Hz data in batches, as a sampler would insert them
+        rng = np.random.RandomState(0)
+        t0 = 1500000000.0 - 1500000000.0 % 86400
+        n  = 2*86400
+        t  = t0 + np.arange(n, dtype = float)
+        chan0 = np.sin(2*np.pi*np.arange(n)/3600.0) + 0.01*rng.randn(n)
+        chan1 = np.arange(n, dtype = float)
+        t1 = time.time()
+        for i in range(0, n, 600):
+            store.insert(t[i:i+600], OrderedDict([("chan0", chan0[i:i+600]),
+                                                  ("chan1", chan1[i:i+600])]))
+        t2 = time.time()
+        print "inserted %d samples in %0.2f s" % (2*n, t2 - t1)
+        store.insert_point(t0 + 10.5, soil_temperature = 21.5)
+        assert store.series() == ["chan0", "chan1", "soil_temperature"]
+        store.close()
+        #the rollups match the raw data, also after reopening
+        store = TimeSeriesStore(path)
+        for res in RESOLUTIONS:
+            resolution, records = store.query("chan0", t0, t0 + n, max_points = n//res)
+            assert resolution == res, (resolution, res)
+            assert len(records) == n//res
+            blocks = chan0.reshape((-1, res))
+            assert np.allclose(records[:,0], t0 + res*np.arange(n//res))
+            assert (records[:,1] == res).all()
+            assert np.allclose(records[:,2], blocks.mean(axis = 1))
+            assert np.allclose(records[:,3], blocks.min(axis = 1))
+            assert np.allclose(records[:,4], blocks.max(axis = 1))
+        #the resolution follows the range and the budget
+        t1 = time.time()
+        resolution, records = store.query("chan1", t0 + 100, t0 + 400)
+        t2 = time.time()
+        assert resolution is None and np.allclose(records[:,2], np.arange(100, 400))
+        print "raw query: %d points in %0.1f ms" % (len(records), (t2 - t1)*1e3)
+        t1 = time.time()
+        resolution, records = store.query("chan1", t0, t0 + n, max_points = 100)
+        t2 = time.time()
+        assert resolution == 3600 and len(records) == 48
+        print "rollup query: %d points in %0.1f ms" % (len(records), (t2 - t1)*1e3)
+        resolution, records = store.query("chan1", t0, t0 + n, max_points = 1)
+        assert resolution == 86400 and len(records) == 2
+        assert np.allclose(records[:,1:], [[86400, 43199.5, 0, 86399], [86400, 129599.5, 86400, 172799]])
+        resolution, records = store.query("soil_temperature", t0, t0 + 60)
+        assert resolution is None and records.tolist() == [[t0 + 10.5, 1, 21.5, 21.5, 21.5]]
+        store.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+    print "all tests passed"
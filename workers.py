@@ -0,0 +1,334 @@
+""" Acquisition across processes: the Pi has four cores but a single Python
+    process runs the bit-banged SPI, the reductions and the output under one
+    GIL.  An 'AcquisitionWorker' runs the reading of one bus or sensor family
+    (e.g. an MCP3008 scan, a DHT22) in a process of its own, writing records
+    of a fixed layout (float64 columns) into a 'SharedRing', from which the
+    aggregating process (the parent) reads them for reduction, conversion
+    and output.
+
+    'WorkerPool' starts the workers (forked from the parent, so hardware set
+    up before they are started is inherited), and on every 'poll' restarts
+    one which died or stopped writing for 'stall_timeout' seconds, after
+    'restart_delay' seconds, up to 'max_restarts' times.
+
+    The ring has a single producer (the worker) and a single consumer (the
+    parent), each advancing only its own counter after copying the records,
+    so no lock is shared and a worker killed at any point cannot block the
+    parent.  When the parent falls behind and the ring is full the new
+    records are dropped and counted as overflows.
+"""
+################################################################################
+import os, sys, signal, time, mmap, traceback, multiprocessing
+from collections import OrderedDict
+import numpy as np
+
+from clock import monotonic
+from scheduler import Scheduler
+
+DEFAULT_CAPACITY      = 4096  #records
+DEFAULT_STALL_TIMEOUT = 10.0  #seconds without a record before a worker is restarted
+DEFAULT_RESTART_DELAY = 1.0   #seconds
+DEFAULT_MAX_RESTARTS  = 10
+POLL_INTERVAL         = 0.01  #seconds between the checks for records
+STOP_TIMEOUT          = 5.0   #seconds to wait for a worker to stop
+HEADER_SIZE           = 64    #bytes, the counters
+#counters, uint32 so that the stores are atomic on a 32 bit CPU, compared
+#modulo 2**32
+WRITTEN, READ, OVERFLOWS = range(3)
+ALIVE_OFFSET = 16             #float64 monotonic time of the last write
+################################################################################
+class SharedRing(object):
+    """ ring of 'capacity' records of 'num_columns' float64 in anonymous shared
+        memory, inherited by the processes forked after it is created
+    """
+    def __init__(self, num_columns, capacity = DEFAULT_CAPACITY):
+        assert 0 < capacity < 2**31
+        self.num_columns = num_columns
+        self.capacity    = capacity
+        self._mmap = mmap.mmap(-1, HEADER_SIZE + capacity*num_columns*8)
+        self._counters = np.ndarray(shape = (3,), dtype = np.uint32, buffer = self._mmap)
+        self._alive    = np.ndarray(shape = (1,), dtype = np.float64, buffer = self._mmap,
+                                    offset = ALIVE_OFFSET)
+        self._records  = np.ndarray(shape = (capacity, num_columns), dtype = np.float64,
+                                    buffer = self._mmap, offset = HEADER_SIZE)
+        self._counters[:] = 0
+        self._alive[0]    = monotonic()
+
+    @property
+    def pending(self):
+        """ number of records written but not read
+        """
+        return int((self._counters[WRITTEN] - self._counters[READ]) % 2**32)
+
+    @property
+    def overflows(self):
+        return int(self._counters[OVERFLOWS])
+
+    @property
+    def last_alive(self):
+        """ monotonic time of the producer's last write (or 'touch')
+        """
+        return float(self._alive[0])
+
+    def touch(self):
+        self._alive[0] = monotonic()
+
+    def write(self, block):
+        """ producer: copy in the rows of the 2D array 'block' which fit,
+            returning their number
+        """
+        n = len(block)
+        written = int(self._counters[WRITTEN])
+        num = min(n, self.capacity - self.pending)
+        start = written % self.capacity
+        stop  = min(start + num, self.capacity)
+        self._records[start:stop] = block[:stop - start]
+        if stop - start < num:
+            self._records[:num - (stop - start)] = block[stop - start:num]
+        #publish only once the records are in place
+        self._counters[WRITTEN] = (written + num) % 2**32
+        if num < n:
+            self._counters[OVERFLOWS] = (int(self._counters[OVERFLOWS]) + n - num) % 2**32
+        self.touch()
+        return num
+
+    def read(self):
+        """ consumer: get a copy of the records written since the last read
+        """
+        num   = self.pending
+        start = int(self._counters[READ]) % self.capacity
+        stop  = min(start + num, self.capacity)
+        block = np.empty((num, self.num_columns))
+        block[:stop - start] = self._records[start:stop]
+        if stop - start < num:
+            block[stop - start:] = self._records[:num - (stop - start)]
+        self._counters[READ] = (int(self._counters[READ]) + num) % 2**32
+        return block
+
+################################################################################
+class AcquisitionWorker(object):
+    """ calls 'read()', returning a record (1D) or a block of records (2D)
+        of 'num_columns', in a process of its own, every 'period' seconds
+        on a fixed timeline (see 'scheduler.Scheduler') or continuously
+        with 'delay' seconds of sleep after each read; 'setup()' is called
+        first in every new process
+    """
+    def __init__(self, name, read, num_columns,
+                 period   = None,
+                 delay    = 0.0,
+                 setup    = None,
+                 capacity = DEFAULT_CAPACITY,
+                ):
+        self.name     = name
+        self.read     = read
+        self.period   = period
+        self.delay    = delay
+        self.setup    = setup
+        self.ring     = SharedRing(num_columns, capacity = capacity)
+        self.process  = None
+        #counters
+        self.starts   = 0
+        self.crashes  = 0
+        self.stalls   = 0
+        self.records_read = 0
+        self._t_died  = None
+
+    @property
+    def alive(self):
+        return not self.process is None and self.process.is_alive()
+
+    def start(self, stop_event):
+        sys.stdout.flush() #not to be repeated by the child
+        self.process = multiprocessing.Process(target = self._run, args = (stop_event,),
+                                               name = "AcquisitionWorker-%s" % self.name)
+        self.process.daemon = True
+        self.process.start()
+        self.ring.touch()
+        self.starts  += 1
+        self._t_died  = None
+
+    def _run(self, stop_event):
+        """ the worker process
+        """
+        #the parent handles the interrupt and stops the workers
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            if not self.setup is None:
+                self.setup()
+            scheduler = None
+            if not self.period is None:
+                scheduler = Scheduler(self.period)
+                scheduler.start()
+            ring = self.ring
+            while not stop_event.is_set():
+                if not scheduler is None:
+                    scheduler.wait()
+                block = np.asarray(self.read(), dtype = np.float64)
+                ring.write(block.reshape((-1, ring.num_columns)))
+                if scheduler is None:
+                    if self.delay > 0:
+                        time.sleep(self.delay)
+                else:
+                    scheduler.done()
+        except Exception:
+            traceback.print_exc()
+            sys.stderr.flush()
+            os._exit(1)
+
+################################################################################
+class WorkerPool(object):
+    """ starts, supervises and stops the 'workers', see the module docstring
+    """
+    def __init__(self, workers = (),
+                 stall_timeout = DEFAULT_STALL_TIMEOUT,
+                 restart_delay = DEFAULT_RESTART_DELAY,
+                 max_restarts  = DEFAULT_MAX_RESTARTS,
+                ):
+        self.workers = OrderedDict()
+        self.stall_timeout = stall_timeout
+        self.restart_delay = restart_delay
+        self.max_restarts  = max_restarts
+        self._stop = multiprocessing.Event()
+        for worker in workers:
+            self.add(worker)
+
+    def add(self, worker):
+        self.workers[worker.name] = worker
+        return worker
+
+    def start(self):
+        self._stop.clear()
+        for worker in self.workers.values():
+            if not worker.alive:
+                worker.start(self._stop)
+        return self
+
+    def poll(self):
+        """ restart the workers which died or stalled, raises RuntimeError
+            when a worker is beyond 'max_restarts'
+        """
+        now = monotonic()
+        for worker in self.workers.values():
+            if worker.process is None:
+                continue
+            if worker.alive:
+                if not self.stall_timeout is None and now - worker.ring.last_alive > self.stall_timeout:
+                    worker.stalls += 1
+                    worker.process.terminate()
+                    worker.process.join(STOP_TIMEOUT)
+                else:
+                    continue
+            elif worker._t_died is None:
+                worker.crashes += 1
+            if worker._t_died is None:
+                worker._t_died = now
+            if worker.starts - 1 >= self.max_restarts:
+                raise RuntimeError, "worker '%s' failed after %d restarts" % (worker.name, self.max_restarts)
+            if now - worker._t_died >= self.restart_delay:
+                worker.start(self._stop)
+
+    def read(self, name):
+        """ get the new records of the worker 'name'
+        """
+        worker = self.workers[name]
+        block = worker.ring.read()
+        worker.records_read += len(block)
+        return block
+
+    def wait(self, name, timeout = None):
+        """ poll, until the worker 'name' has records or 'timeout' seconds
+            pass, then read them
+        """
+        ring = self.workers[name].ring
+        t_end = None if timeout is None else monotonic() + timeout
+        while ring.pending == 0 and (t_end is None or monotonic() < t_end):
+            self.poll()
+            time.sleep(POLL_INTERVAL)
+        return self.read(name)
+
+    def stats(self):
+        result = OrderedDict()
+        for name, worker in self.workers.items():
+            result["worker_%s_restarts" % name]     = max(worker.starts - 1, 0)
+            result["worker_%s_crashes" % name]      = worker.crashes
+            result["worker_%s_stalls" % name]       = worker.stalls
+            result["worker_%s_records_read" % name] = worker.records_read
+            result["worker_%s_overflows" % name]    = worker.ring.overflows
+        return result
+
+    def stop(self, timeout = STOP_TIMEOUT):
+        """ ask the workers to stop, terminating those which do not within
+            'timeout' seconds
+        """
+        self._stop.set()
+        t_end = monotonic() + timeout
+        for worker in self.workers.values():
+            if worker.process is None:
+                continue
+            worker.process.join(max(t_end - monotonic(), 0.0))
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join()
+            worker.process = None
+
+################################################################################
+# TEST CODE
+################################################################################
+if __name__ == "__main__":
+    #the ring wraps around, overflows are counted
+    ring = SharedRing(3, capacity = 10)
+    records = np.arange(60, dtype = float).reshape((20, 3))
+    assert ring.write(records[:7]) == 7
+    assert np.array_equal(ring.read(), records[:7])
+    assert ring.write(records[7:20]) == 10 and ring.overflows == 3
+    assert np.array_equal(ring.read(), records[7:17]) and ring.pending == 0
+    #records from a worker process, written in parallel with the parent
+    count = [0]
+    def read_counter():
+        count[0] += 1
+        return [monotonic(), os.getpid(), count[0]]
+    pool = WorkerPool([AcquisitionWorker("counter", read_counter, 3, period = 0.01)])
+    pool.start()
+    time.sleep(0.5)
+    block = pool.wait("counter", timeout = 1.0)
+    print "read %d records from the worker" % len(block)
+    assert 30 < len(block) <= 60 and (block[:,1] != os.getpid()).all()
+    assert np.array_equal(block[:,2], np.arange(1, len(block) + 1))
+    assert count[0] == 0 #the parent's state is not touched
+    pool.stop()
+    #a crashed worker is restarted, a stalled one terminated and restarted
+    def read_crashing():
+        count[0] += 1
+        if count[0] > 20:
+            raise IOError("bus error")
+        return [count[0]]
+    def read_stalling():
+        count[0] += 1
+        if count[0] > 3:
+            time.sleep(60)
+        return [count[0]]
+    sys.stderr = open(os.devnull, 'w') #the crash tracebacks
+    pool = WorkerPool([AcquisitionWorker("crashing", read_crashing, 1, delay = 0.01),
+                       AcquisitionWorker("stalling", read_stalling, 1, delay = 0.01)],
+                      stall_timeout = 0.2, restart_delay = 0.1, max_restarts = 2)
+    pool.start()
+    values = {"crashing": [], "stalling": []}
+    try:
+        t_end = monotonic() + 10.0
+        while monotonic() < t_end:
+            pool.poll()
+            for name in values:
+                values[name] += pool.read(name)[:,0].tolist()
+            time.sleep(POLL_INTERVAL)
+    except RuntimeError, error:
+        print "%s" % error
+    finally:
+        sys.stderr = sys.__stderr__
+        pool.stop(timeout = 0.5)
+    stats = pool.stats()
+    for key, val in stats.items():
+        print "%s = %r" % (key, val)
+    assert stats["worker_crashing_restarts"] == 2 and stats["worker_crashing_crashes"] == 3
+    assert values["crashing"] == range(1, 21)*3
+    assert stats["worker_stalling_stalls"] >= 1 and values["stalling"][:6] == [1, 2, 3]*2
+    print "all tests passed"
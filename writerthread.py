@@ -0,0 +1,256 @@
+""" Producer/consumer decoupling of the acquisition from the disk I/O:
+    'ThreadedWriter' wraps any writer object ('csvdata.CSVWriter',
+    'bindata.BinaryWriter') with the same interface, handing the calls to a
+    dedicated thread through a bounded queue, so that a slow 'flush' (e.g.
+    on an SD card) does not stall the sampling loop.
+
+    When the queue is full the back-pressure 'policy' decides:
+        "block"       - the producer waits for the writer thread
+        "drop_oldest" - the oldest queued block of records is discarded
+        "spill"       - the queue grows in memory beyond its bound
+"""
+################################################################################
+import threading
+from collections import deque, OrderedDict
+
+import metrics
+from clock import monotonic
+
+POLICIES              = ("block", "drop_oldest", "spill")
+DEFAULT_POLICY        = "block"
+DEFAULT_QUEUE_SIZE    = 16   #blocks of records
+POLL_INTERVAL         = 0.1  #seconds, lets waits be interrupted (KeyboardInterrupt)
+################################################################################
+class ThreadedWriter(object):
+    def __init__(self, writer,
+                 queue_size = DEFAULT_QUEUE_SIZE,
+                 policy     = DEFAULT_POLICY,
+                ):
+        assert queue_size > 0
+        assert policy in POLICIES
+        self.writer     = writer
+        self.queue_size = queue_size
+        self.policy     = policy
+        #counters
+        self.max_depth       = 0
+        self.blocks_queued   = 0
+        self.blocks_spilled  = 0
+        self.records_written = 0
+        self.records_dropped = 0
+        self._queue   = deque() #(method name, args)
+        self._num_blocks = 0    #number of 'write_records' items in the queue
+        self._cond    = threading.Condition()
+        self._busy    = False
+        self._closing = False
+        self._error   = None
+        self._thread  = threading.Thread(target = self._run, name = "ThreadedWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def columns(self):
+        return self.writer.columns
+
+    @property
+    def depth(self):
+        """ number of blocks of records waiting in the queue
+        """
+        return self._num_blocks
+
+    def write_header(self, metadata, columns):
+        self._put("write_header", (metadata, list(columns)))
+
+    def write_records(self, block):
+        """ queue a copy of the 2D array 'block', the caller may reuse it
+        """
+        if len(block) > 0:
+            self._put("write_records", (block.copy(),))
+
+    def write_trailer(self, stats):
+        self._put("write_trailer", (stats,))
+
+    def flush(self):
+        self._put("flush", ())
+
+    def drain(self):
+        """ wait until all queued calls have been handed to the writer
+        """
+        with self._cond:
+            while (self._queue or self._busy) and self._thread.is_alive():
+                self._cond.wait(POLL_INTERVAL)
+        self._check_error()
+
+    def close(self):
+        """ drain the queue, stop the thread and close the writer
+        """
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        while self._thread.is_alive():
+            self._thread.join(POLL_INTERVAL)
+        self._check_error()
+        self.writer.close()
+
+    def stats(self):
+        result = OrderedDict()
+        result['writer_policy']          = self.policy
+        result['writer_queue_size']      = self.queue_size
+        result['writer_max_depth']       = self.max_depth
+        result['writer_blocks_spilled']  = self.blocks_spilled
+        result['writer_records_written'] = self.records_written
+        result['writer_records_dropped'] = self.records_dropped
+        if hasattr(self.writer, 'stats'):
+            result.update(self.writer.stats())
+        return result
+
+    def _put(self, method, args):
+        self._check_error()
+        is_block = (method == "write_records")
+        with self._cond:
+            if is_block and self._num_blocks >= self.queue_size:
+                if self.policy == "block":
+                    while self._num_blocks >= self.queue_size and self._thread.is_alive():
+                        self._cond.wait(POLL_INTERVAL)
+                elif self.policy == "drop_oldest":
+                    self._drop_oldest()
+                else: #spill
+                    self.blocks_spilled += 1
+            self._queue.append((method, args))
+            if is_block:
+                self._num_blocks   += 1
+                self.blocks_queued += 1
+                self.max_depth = max(self.max_depth, self._num_blocks)
+            self._cond.notify_all()
+
+    def _drop_oldest(self):
+        #only records are dropped, headers and trailers keep their order
+        for index, (method, args) in enumerate(self._queue):
+            if method == "write_records":
+                del self._queue[index]
+                self._num_blocks      -= 1
+                self.records_dropped  += len(args[0])
+                return
+
+    def _check_error(self):
+        if not self._error is None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        cond = self._cond
+        while True:
+            with cond:
+                while not self._queue and not self._closing:
+                    cond.wait(POLL_INTERVAL)
+                if not self._queue:
+                    return #closing and drained
+                method, args = self._queue.popleft()
+                if method == "write_records":
+                    self._num_blocks -= 1
+                self._busy = True
+                cond.notify_all()
+            try:
+                timed = metrics.ENABLED
+                if timed:
+                    t1 = monotonic()
+                getattr(self.writer, method)(*args)
+                if method == "write_records":
+                    self.records_written += len(args[0])
+                if timed:
+                    items = len(args[0]) if method == "write_records" else 1
+                    metrics.record("writer." + method, monotonic() - t1, items = items)
+            except Exception, error:
+                with cond:
+                    self._error = error
+                    self._queue.clear()
+                    self._num_blocks = 0
+                    self._busy = False
+                    cond.notify_all()
+                return
+            with cond:
+                self._busy = False
+                cond.notify_all()
+
+################################################################################
+# TEST CODE
+################################################################################
+if __name__ == "__main__":
+    import time
+    import numpy as np
+
+    class SlowWriter(object):
+        """ records the calls, taking 'delay' seconds for each flush
+        """
+        def __init__(self, delay):
+            self.delay   = delay
+            self.columns = None
+            self.calls   = []
+            self.records = []
+            self.closed  = False
+        def write_header(self, metadata, columns):
+            self.columns = columns
+            self.calls.append("write_header")
+        def write_records(self, block):
+            self.records.extend(block[:,0].tolist())
+            self.calls.append("write_records")
+        def write_trailer(self, stats):
+            self.calls.append("write_trailer")
+        def flush(self):
+            time.sleep(self.delay)
+        def close(self):
+            self.closed = True
+
+    def produce(writer, num_blocks, block_size = 10):
+        block = np.empty((block_size, 2))
+        t1 = time.time()
+        writer.write_header({}, ["t_samp", "chan0"])
+        for i in range(num_blocks):
+            block[:,0] = np.arange(i*block_size, (i+1)*block_size)
+            writer.write_records(block) #the block is reused immediately
+            writer.flush()
+        t2 = time.time()
+        writer.write_trailer({})
+        writer.close()
+        return t2 - t1
+
+    for policy in POLICIES:
+        slow = SlowWriter(delay = 0.01)
+        tw = ThreadedWriter(slow, queue_size = 4, policy = policy)
+        elapsed = produce(tw, num_blocks = 20)
+        stats = tw.stats()
+        print "policy = %r, producer time = %0.3f s" % (policy, elapsed)
+        for key, val in stats.items():
+            print "\t%s = %r" % (key,val)
+        assert slow.closed
+        assert slow.calls[0]  == "write_header"
+        assert slow.calls[-1] == "write_trailer"
+        assert stats['writer_records_written'] + stats['writer_records_dropped'] == 200
+        assert len(slow.records) == stats['writer_records_written']
+        #records are written in order and never corrupted by the reused block
+        assert slow.records == sorted(slow.records)
+        assert all(int(t) % 10 == k % 10 for k, t in enumerate(slow.records))
+        if policy == "block":
+            assert stats['writer_records_dropped'] == 0
+            assert stats['writer_max_depth'] <= 4
+        elif policy == "drop_oldest":
+            assert stats['writer_records_dropped'] > 0
+            assert stats['writer_max_depth'] <= 4
+            assert elapsed < 0.1
+        elif policy == "spill":
+            assert stats['writer_records_dropped'] == 0
+            assert stats['writer_blocks_spilled'] > 0
+            assert elapsed < 0.1
+    #errors in the writer thread surface in the producer
+    class FailingWriter(SlowWriter):
+        def write_records(self, block):
+            raise IOError("disk full")
+    tw = ThreadedWriter(FailingWriter(0.0))
+    tw.write_header({}, ["t_samp"])
+    tw.write_records(np.zeros((1,1)))
+    try:
+        tw.drain()
+    except IOError:
+        print "writer error raised in producer"
+    else:
+        raise AssertionError("error not raised")
+    print "all tests passed"